@@ -0,0 +1,128 @@
+import inspect
+from typing import Callable, Dict, NamedTuple, Tuple
+
+from Commands.SuperUserCommands import SuperUserCommands
+from Commands.UserCommands import UserCommands
+from users import SuperUser, User
+
+# shapes of arguments of commands
+WORDS = 'words'  # words separated by spaces: 'setp foo -r /path' -> ('foo', '-r', '/path')
+PATH = 'path'  # the rest of command: path (may be "quoted") and its options -> ('folder/file -z zlib',)
+TRANSFER = 'transfer'  # 'source > target' -> ('source', 'target') or ('source', None) without target
+
+ARGS = {**{name: PATH for name in ('jump', 'list', 'where', 'open', 'nefo', 'defo', 'defi', 'info', 'hash', 'sign',
+                                   'pull', 'find')},
+        **{name: TRANSFER for name in ('send', 'psend', 'delta', 'push')}}
+INTS = {'rawsend': (1,)}  # positions of WORDS arguments which must be integers (size of file)
+
+
+class Command(NamedTuple):
+    name: str
+    handler: Callable
+    args: str  # WORDS, PATH or TRANSFER
+    ints: Tuple[int, ...]
+    help: bytes  # docstring of handler
+
+
+def unquote(arg: str) -> str:
+    '''
+    '"my folder/file" -z zlib' -> 'my folder/file -z zlib'
+    '''
+    if arg[:1] == '"':
+        end = arg.find('"', 1)
+        if end != -1:
+            return arg[1:end] + arg[end + 1:]
+    return arg
+
+
+def split(command: bytes) -> Tuple[str, str]:
+    '''
+    command word and the rest of command
+    '''
+    try:
+        text = command.decode().strip()  # in case of putty
+    except UnicodeDecodeError:
+        return '', ''
+    name, _, rest = text.partition(' ')
+    return name, rest.strip()
+
+
+def parse_args(shape: str, rest: str) -> Tuple:
+    if not rest:
+        return ()
+    if shape == PATH:
+        return unquote(rest),
+    if shape == TRANSFER:
+        source, separator, target = rest.rpartition(' > ')
+        return (unquote(source.strip()), target.strip()) if separator else (unquote(rest), None)
+    return tuple(rest.split())
+
+
+class CommandRegistry:
+    '''
+    Commands of users and superusers collected once at start: every static method of UserCommands
+    (SuperUserCommands for superusers) is a command. Arguments are split by the shape declared in ARGS
+    (WORDS by default) instead of regular expressions, help is made once
+    '''
+
+    def __init__(self, user_commands: type, superuser_commands: type):
+        self.__user = self.__collect(user_commands)
+        self.__superuser = self.__collect(superuser_commands)
+        self.__user_help = self.__short_help(self.__user)
+        self.__superuser_help = self.__short_help(self.__superuser)
+
+    @staticmethod
+    def __collect(commands: type) -> Dict[str, Command]:
+        collected = dict()
+        for name in dir(commands):
+            handler = getattr(commands, name)
+            if not name.startswith('_') and inspect.iscoroutinefunction(handler):
+                collected[name] = Command(name, handler, ARGS.get(name, WORDS), INTS.get(name, ()),
+                                          (handler.__doc__ or 'No info').encode())
+        return collected
+
+    @staticmethod
+    def __short_help(commands: Dict[str, Command]) -> bytes:
+        return ('Avaliable commands:\n' + '\n'.join(sorted(commands))).encode()
+
+    def commands_of(self, user: User | SuperUser) -> Dict[str, Command]:
+        return self.__superuser if isinstance(user, SuperUser) else self.__user
+
+    def is_command(self, name: str) -> bool:
+        return name in self.__superuser
+
+    def find(self, user: User | SuperUser, name: str) -> Command | None:
+        return self.commands_of(user).get(name)
+
+    def parse(self, command: bytes) -> Tuple[str, Tuple]:
+        '''
+        command word and its arguments split by shape of command, e.g.
+        b'send "my file" > here' -> ('send', ('my file', 'here'))
+        Raises: ValueError if argument declared as integer is not integer
+        '''
+        name, rest = split(command)
+        found = self.__superuser.get(name)
+        args = parse_args(found.args if found is not None else WORDS, rest)
+        if found is not None and found.ints:
+            args = tuple(self.__integer(name, position, arg) if position in found.ints else arg
+                         for position, arg in enumerate(args))
+        return name, args
+
+    @staticmethod
+    def __integer(name: str, position: int, arg: str) -> int:
+        try:
+            return int(arg)
+        except ValueError:
+            raise ValueError(f'argument {position + 1} of {name} must be an integer') from None
+
+    def help(self, user: User | SuperUser, name: str = None) -> bytes:
+        '''
+        list of commands of user or docstring of command
+        '''
+        if name is None:
+            return self.__superuser_help if isinstance(user, SuperUser) else self.__user_help
+        command = self.find(user, name)
+        return command.help if command is not None else b'no help for you'
+
+
+commands = CommandRegistry(UserCommands, SuperUserCommands)
@@ -1,6 +1,10 @@
 from typing import Dict, List
 
-from Commands.UserCommands import Packet, UserCommands
+import utility
+from Commands.UserCommands import ERR, Packet, UserCommands
+from Metrics.MetricsCollector import metrics
+from Storage.BlobStore import blobs
+from Storage.Quotas import quotas
 from UserDataHandle.BaseSaveLoader import UserData
 
 
@@ -23,6 +27,95 @@ class SuperUserCommands(UserCommands):
         '''
         return f'{packet.user.SessionHandler.__str__()}\n{await packet.user.DataHandler.get_users()}'.encode()
 
+    @staticmethod
+    async def conn(packet: Packet) -> bytes:
+        '''
+        conn - display connections of user: 'conn foo'
+
+                e.g.:
+                Connections of "foo": 2
+                [1] ('127.0.0.1', 62394) - ../folder
+                [2] ('127.0.0.1', 62395) - ..
+        '''
+        if not packet.cmd_tail:
+            return f"[!] empty username".encode()
+        target_uid = packet.cmd_tail[0]
+        sessions = packet.user.SessionHandler.sessions_of(target_uid)
+        res = f'Connections of "{target_uid}": {len(sessions)}'
+        for snum, (addr, _user) in enumerate(sessions.items(), start=1):
+            res += f'\n[{snum}] {addr} - {_user.trim(_user.current_path)}'
+        return res.encode()
+
+    @staticmethod
+    async def kick(packet: Packet) -> bytes:
+        '''
+        kick - close all connections of user: 'kick foo', or one of them: 'kick foo 127.0.0.1:62394'
+        '''
+        if not packet.cmd_tail:
+            return f"[!] empty username".encode()
+        target_uid, *addr = packet.cmd_tail
+        if addr:
+            host, _, port = addr[0].rpartition(':')
+            if not port.isdigit():
+                return ERR.WRONG_VALUE('use kick username or kick username ip:port')
+            addr = (host, int(port))
+        kicked = packet.user.SessionHandler.kick(target_uid, addr or None)
+        return f'[>] {kicked} connections of "{target_uid}" closed'.encode()
+
+    @staticmethod
+    async def mets(packet: Packet) -> bytes:
+        '''
+        mets - display server metrics: commands count and latency, received and sent bytes,
+                active sessions and transfers in progress.
+                'mets -prom' displays metrics in Prometheus exposition format
+        '''
+        if packet.cmd_tail and packet.cmd_tail[0] == '-prom':
+            return metrics.render_prometheus().encode()
+        return metrics.render().encode()
+
+    @staticmethod
+    async def gc(packet: Packet) -> bytes:
+        '''
+        gc - remove stored files of deduplicated storage which are not linked by any user
+        '''
+        if not blobs.enabled:
+            return '[x] storage is not deduplicated'.encode()
+        removed, freed = await blobs.collect()
+        return f'[>] removed {removed} stored files, {freed} bytes freed'.encode()
+
+    @staticmethod
+    async def du(packet: Packet) -> bytes:
+        '''
+        du - space used in your home and your quota, 'du foo' - of user foo (if user was loaded)
+        '''
+        if not packet.cmd_tail:
+            return await UserCommands.du(packet)
+        usage = quotas.usage(packet.cmd_tail[0])
+        if usage is None:
+            return f'[!] usage of "{packet.cmd_tail[0]}" is not tracked, user was not loaded'.encode()
+        return f'[>] {packet.cmd_tail[0]}: {quotas.report(usage.home)}'.encode()
+
+    @staticmethod
+    async def setq(packet: Packet) -> bytes:
+        '''
+        setq - set quota of user: 'setq foo 10G' (K, M, G, T), 'setq foo 0' - unlimited,
+               'setq foo default' - quota from config
+        '''
+        try:
+            target_uid, value = packet.cmd_tail
+            quota = None if value == 'default' else utility.parse_size(value)
+        except ValueError:
+            return ERR.WRONG_VALUE('use setq username size')
+        quotas.set_quota(target_uid, quota)
+        if packet.user.SessionHandler.account(target_uid) is not None:
+            return f'"{target_uid}" quota was changed to {value}'.encode()  # saved when session is ended
+        try:
+            udata: UserData = await packet.user.DataHandler.load_user(target_uid)
+            await packet.user.DataHandler.save_user_data(udata._replace(quota=quota))
+        except Exception as E:
+            return f'[!] something went wrong {E}'.encode()
+        return f'"{target_uid}" quota was changed to {value}'.encode()
+
     @staticmethod
     async def uinf(packet: Packet) -> bytes:
         '''
@@ -40,11 +133,12 @@ class SuperUserCommands(UserCommands):
 
         target_uid, *_ = packet.cmd_tail
         user_info = f'User "{target_uid}" info:\n'
-        for _user in packet.user.SessionHandler.active_sessions.values():
-            if _user.uid == target_uid:
-                for key, value in _user.__dict__.items():
-                    user_info += f'{key} - {value}\n'
-                return f'"{user_info}"'.encode()
+        udata = packet.user.SessionHandler.user_data(target_uid)
+        if udata is not None:
+            for key, value in udata._asdict().items():
+                user_info += f'{key} - {value}\n'
+            user_info += f'connections - {len(packet.user.SessionHandler.sessions_of(target_uid))}\n'
+            return user_info.encode()
         try:
             udata: UserData = await packet.user.DataHandler.load_user(target_uid)
         except:
@@ -75,23 +169,18 @@ class SuperUserCommands(UserCommands):
             return f'[x] not enough values. Use setr username -modes path'.encode()
 
 
-        # firstly check if user is now online to add permissions in current sessions
+        # firstly check if user is now online to add permissions in current sessions (all of them share account)
         # if user is offline - download user json data file and add restriction in
-        for _user in packet.user.SessionHandler.active_sessions.values():
-            if _user.uid == target_uid:
-                _user.permissions = __add_restricts(_user.permissions, modes, *permissions)
-                return f'"{target_uid}" permissions was changed to "{_user.permissions}"'.encode()
+        account = packet.user.SessionHandler.account(target_uid)
+        if account is not None:
+            account.permissions = __add_restricts(account.permissions, modes, *permissions)
+            return f'"{target_uid}" permissions was changed to "{account.permissions}"'.encode()
 
         try:
             udata: UserData = await packet.user.DataHandler.load_user(target_uid)
-            await packet.user.DataHandler.save_user_data(UserData(uid=udata.uid,
-                                                                  current_path=udata.current_path,
-                                                                  home_path=udata.home_path,
-                                                                  permissions=__add_restricts(udata.permissions,
-                                                                                               modes,
-                                                                                               *permissions)
-                                                                  )
-                                                         )
+            await packet.user.DataHandler.save_user_data(udata._replace(permissions=__add_restricts(udata.permissions,
+                                                                                                    modes,
+                                                                                                    *permissions)))
 
         except Exception as E:
             return f'[!] something went wrong {E}'.encode()
@@ -119,23 +208,18 @@ class SuperUserCommands(UserCommands):
         except:
             return f'[x] not enough values. Use delr username -modes path'.encode()
 
-        # firstly check if user is now online to delete permissions in current sessions
+        # firstly check if user is now online to delete permissions in current sessions (all of them share account)
         # if user is offline - download user json data file and delete restriction in
-        for _user in packet.user.SessionHandler.active_sessions.values():
-            if _user.uid == target_uid:
-                _user.permissions = __del_permissions(_user.permissions, modes, *permissions)
-                return f'"{target_uid}" permissions was changed to "{_user.permissions}"'.encode()
+        account = packet.user.SessionHandler.account(target_uid)
+        if account is not None:
+            account.permissions = __del_permissions(account.permissions, modes, *permissions)
+            return f'"{target_uid}" permissions was changed to "{account.permissions}"'.encode()
 
         try:
             udata: UserData = await packet.user.DataHandler.load_user(target_uid)
-            await packet.user.DataHandler.save_user_data(UserData(uid=udata.uid,
-                                                                  current_path=udata.current_path,
-                                                                  home_path=udata.home_path,
-                                                                  permissions=__del_permissions(udata.permissions,
-                                                                                               modes,
-                                                                                               *permissions)
-                                                                  )
-                                                         )
+            await packet.user.DataHandler.save_user_data(udata._replace(permissions=__del_permissions(udata.permissions,
+                                                                                                      modes,
+                                                                                                      *permissions)))
         except Exception as E:
             return f'[!] something went wrong {E}'.encode()
         return str(udata).encode()
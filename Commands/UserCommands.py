@@ -1,11 +1,28 @@
 import asyncio
+import hashlib
+import json
+import os
 import stat
+import struct
 import time
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Generator, NamedTuple, Tuple
+from typing import AsyncGenerator, Awaitable, Callable, Generator, NamedTuple, Tuple
 
 import utility
+from Storage.BlobStore import blobs
+from Storage.DigestCache import ALGORITHMS, digests
+from Storage.FileIndex import index, mtime_bounds, size_bounds
+from Storage.Listing import DEFAULT_LIMIT, MAX_LIMIT, SORT_KEYS, format_page, page_json
+from Storage.MetadataCache import metadata
+from Storage.Mutations import changed
+from Storage.Quotas import QuotaExceeded, quotas
+from Transfer.Archive import receive_tar, tar_directory
+from Transfer.Bandwidth import bandwidth
+from Transfer.Compression import CODECS, Decoder, choose_codec, compress_file
+from Transfer.Delta import apply_delta, block_size_for, signature
+from Transfer.DiskWriter import receive_to_file, skip_data
+from Transfer.ParallelUpload import uploads
 from users import User, SuperUser
 
 
@@ -17,6 +34,8 @@ class ERR:
     OTHER: bytes = lambda e='': f'[x] something went wrong: {e}'.encode()
     UNKNOWN_COMMAND: bytes = f'[x] no such command'.encode()
     ALREADY_EXISTS: bytes = f'[x] path is already exists'.encode()
+    WRONG_VALUE: bytes = lambda e='': f'[x] wrong value: {e}'.encode()
+    QUOTA_EXCEEDED: bytes = lambda e='': f'[x] quota exceeded: {e}'.encode()
 
 
 class Packet(NamedTuple):
@@ -37,29 +56,82 @@ class UserCommands:
         '''
         where - show your current path
         '''
-        return f'[>] you are now in {utility.trim_path(path=packet.user.current_path,user_home_folder=packet.user.home_path)}'.encode()
+        return f'[>] you are now in {packet.user.trim(packet.user.current_path)}'.encode()
 
     @staticmethod
-    async def open(packet: Packet) -> Tuple[Generator, int] | bytes:
+    async def open(packet: Packet) -> Tuple[utility.FileSlice | AsyncGenerator, int] | \
+                                      Tuple[utility.FileSlice | AsyncGenerator, int, Awaitable[bytes]] | bytes:
         '''
         open - open file.
                you can use absolute path (e.g. open D:\\folder\\file or open /home/folder/file)
                or relative path (e.g. open folder). In case of relative path will be opened
                from your current directory.
+               'open file -z zlib' (or lzma) - send file compressed by blocks (see utility.CHUNKED).
+               Already compressed files (archives, images, video) are sent as is.
+               'open file -o 1024' - send file from byte 1024 (e.g. to resume interrupted download)
+               'open file -o 1024 -l 100' - send 100 bytes from byte 1024
+               'open file -head 100' or 'open file -tail 100' - send first or last 100 bytes of file
+               'open file -d sha256' (or blake2b) - after file send one more reply with digest of sent data:
+               "sha256 <hex digest>". Digest is counted in thread while file is sent or taken from cache
 
         '''
 
         if not packet.cmd_tail:
             return ERR.EMPTY_PATH
         else:
-            path = Path(utility.define_path(packet.cmd_tail[0], packet.user.current_path))
-            if Path(path).is_file():
-                if not utility.is_allowed(path, packet.user.permissions['r']):
+            arg, options = utility.extract_options(packet.cmd_tail[0], options=('z', 'o', 'l', 'head', 'tail', 'd'))
+            target = packet.user.resolve(arg)
+            path = target.path
+            if path.is_file():
+                if not packet.user.allowed(target, 'r'):
                     return ERR.PERMISSION_DENIED
-                file_size = Path(path).stat()
-                return utility.gen_chunk_read(path.__str__()), file_size.st_size
+                file_size = path.stat().st_size
+                try:
+                    offset, count = utility.file_range(file_size, **{k: int(v) for k, v in options.items()
+                                                                     if k not in ('z', 'd')})
+                except ValueError as E:
+                    return ERR.WRONG_VALUE(E)
+                algorithm = options.get('d')
+                if algorithm is not None and algorithm not in ALGORITHMS:
+                    return ERR.WRONG_VALUE(f'use one of {", ".join(ALGORITHMS)}')
+                source = utility.FileSlice(target.text, offset, count)
+                codec = choose_codec(options.get('z'), path)
+                if codec != 'none':
+                    reply = compress_file(source, codec, packet.user.chunk_sizer), utility.CHUNKED
+                else:
+                    reply = source, count
+                if algorithm is None:
+                    return reply
+
+                async def trailer() -> bytes:
+                    return f'{algorithm} {await digests.region_digest(path, algorithm, offset, count)}'.encode()
+
+                return *reply, asyncio.create_task(trailer())
             else:
-                return ERR.NOT_FOUND(packet.cmd_tail[0])
+                return ERR.NOT_FOUND(arg)
+
+    @staticmethod
+    async def pull(packet: Packet) -> Tuple[AsyncGenerator, int] | bytes:
+        '''
+        pull - download folder as tar archive: 'pull folder', 'pull folder -z zlib' (tar.gz) or '-z lzma' (tar.xz).
+               Archive is made while it is sent and is sent by blocks (see utility.CHUNKED).
+               Files and folders you have no permission to read are skipped
+        '''
+        if not packet.cmd_tail:
+            return ERR.EMPTY_PATH
+        arg, options = utility.extract_options(packet.cmd_tail[0], options=('z',))
+        target = packet.user.resolve(arg)
+        path = target.path
+        if not path.is_dir():
+            return ERR.NOT_FOUND(arg)
+        if not packet.user.allowed(target, 'r'):
+            return ERR.PERMISSION_DENIED
+        codec = options.get('z', 'none')
+        if codec not in CODECS:
+            return ERR.WRONG_VALUE(f'use one of {", ".join(CODECS)}')
+        permissions = packet.user.grants['r']
+        return tar_directory(path, lambda entry: utility.is_allowed(entry, permissions), codec,
+                             packet.user.chunk_sizer), utility.CHUNKED
 
     @staticmethod
     async def list(packet: Packet) -> bytes:
@@ -68,23 +140,81 @@ class UserCommands:
                You can use absolute path (e.g. list D:\\folder or list /home/folder)
                or relative path (e.g. list folder). In case of relative path
                you will get objects in your current directory.
+               Options:
+               -l 100 - entries on page (1000 by default),
+               -c cursor - where page starts (given at the end of previous page)
+               -s name/size/mtime/none - sorting (none - order of directory, the fastest), -r - reverse order
+               -g "*.txt" - only names matching pattern, -m - size and mtime columns, -json - reply as json
+        '''
+        arg, options = utility.extract_options(packet.cmd_tail[0] if packet.cmd_tail else '',
+                                               options=('l', 'c', 's', 'g'), flags=('r', 'm', 'json'))
+        target = packet.user.resolve(arg)
+        trimmed_path = target.trimmed
+        if not packet.user.allowed(target, 'x'):
+            return ERR.PERMISSION_DENIED
+        try:
+            limit = int(options.get('l', DEFAULT_LIMIT))
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError
+        except ValueError:
+            return ERR.WRONG_VALUE(f'limit must be from 1 to {MAX_LIMIT}')
+        cursor = options.get('c')
+        sort = options.get('s', 'name')
+        if sort not in SORT_KEYS:
+            return ERR.WRONG_VALUE(f'use one of {", ".join(SORT_KEYS)}')
+        with_stat = options.get('m', False) or options.get('json', False)
+        try:
+            page = await metadata.list_page(target.text, cursor, limit, sort, options.get('r', False),
+                                            options.get('g'), with_stat)
+        except OSError:
+            return ERR.NOT_FOUND(arg or trimmed_path)
+        except ValueError as E:  # broken cursor or cursor of other sorting
+            return ERR.WRONG_VALUE(E)
+        if options.get('json'):
+            return page_json(page, trimmed_path).encode()
+        return format_page(page, trimmed_path, with_stat).encode()
 
+    @staticmethod
+    async def find(packet: Packet) -> bytes:
         '''
-        if packet.cmd_tail:
-            path = Path(utility.define_path(packet.cmd_tail[0], packet.user.current_path))
-            trimmed_path = utility.trim_path(path=path.__str__(), user_home_folder=packet.user.home_path)
-            if not utility.is_allowed(path, packet.user.permissions['x']):
-                return ERR.PERMISSION_DENIED
-            try:
-                res = utility.walk_around_folder(path.__str__(), trimmed_path=trimmed_path)
-            except:
-                return ERR.NOT_FOUND(packet.cmd_tail[0])
-        else:
-            path = Path(packet.user.current_path)
-            trimmed_path = utility.trim_path(path=path.__str__(), user_home_folder=packet.user.home_path)
-            if not utility.is_allowed(path, packet.user.permissions['x']):
-                return ERR.PERMISSION_DENIED
-            res = utility.walk_around_folder(path.__str__(), trimmed_path=trimmed_path)
+        find - search files and folders in current folder and its subfolders by index of storage: 'find *.txt'.
+               Pattern is glob of name (case sensitive), without pattern everything is found.
+               Options:
+               -in folder - where to search, -size +1M / -size -10K - not smaller / not larger than (K, M, G, T),
+               -mtime -7 / -mtime +30 - changed within / earlier than days ago,
+               -l 100 - max amount of results, -json - reply as json
+        '''
+        if not index.enabled:
+            return ERR.OTHER('file index is disabled')
+        pattern, options = utility.extract_options(packet.cmd_tail[0] if packet.cmd_tail else '',
+                                                   options=('in', 'size', 'mtime', 'l'), flags=('json',))
+        target = packet.user.resolve(options.get('in', ''))
+        permissions = packet.user.grants['x']
+        if not packet.user.allowed(target, 'x'):
+            return ERR.PERMISSION_DENIED
+        if not target.path.is_dir():
+            return ERR.NOT_FOUND(options.get('in', ''))
+        try:
+            limit = int(options.get('l', 100))
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError(f'limit must be from 1 to {MAX_LIMIT}')
+            min_size, max_size = size_bounds(options['size']) if 'size' in options else (None, None)
+            after, before = mtime_bounds(options['mtime'], time.time()) if 'mtime' in options else (None, None)
+        except ValueError as E:
+            return ERR.WRONG_VALUE(E)
+        found = await index.find(target.text, pattern or None, min_size, max_size, after, before, limit)
+        found = [entry for entry in found if utility.is_allowed(Path(entry.path), permissions)]
+        if options.get('json'):
+            return json.dumps({'results': [{'path': packet.user.trim(entry.path),
+                                            'type': 'folder' if entry.is_dir else 'file',
+                                            'size': entry.size, 'mtime': entry.mtime} for entry in found],
+                               'complete': index.ready}).encode()
+        res = f'[>] found {len(found)} in "{target.trimmed}"'
+        if not index.ready:
+            res += ' (index is being built, results may be incomplete)'
+        for entry in found:
+            res += (f'\n{"folder>" if entry.is_dir else ">      "} .. {packet.user.trim(entry.path)}'
+                    f'{"" if entry.is_dir else f"  {entry.size} bytes"}')
         return res.encode()
 
     @staticmethod
@@ -95,15 +225,17 @@ class UserCommands:
         '''
 
         if packet.cmd_tail:
-            path = Path(utility.define_path(packet.cmd_tail[0], packet.user.current_path))
-            if not utility.is_allowed(path, packet.user.permissions['x']):
+            target = packet.user.resolve(packet.cmd_tail[0])
+            path = target.path
+            if not packet.user.allowed(target, 'x'):
                 return ERR.PERMISSION_DENIED
-            if not Path(path).exists():
+            if not path.exists():
                 try:
-                    Path(path).mkdir()
+                    path.mkdir()
                 except Exception as E:
                     return ERR.OTHER('...')
-                res = f'[>] successfully created folder "{utility.trim_path(path=path.__str__(),user_home_folder=packet.user.home_path)}"'.encode()
+                changed(path)
+                res = f'[>] successfully created folder "{target.trimmed}"'.encode()
             else:
                 res = ERR.ALREADY_EXISTS
         else:
@@ -119,16 +251,18 @@ class UserCommands:
         '''
 
         if packet.cmd_tail:
-            path = Path(utility.define_path(packet.cmd_tail[0], packet.user.current_path))
-            if not utility.is_allowed(path, packet.user.permissions['x']):
+            target = packet.user.resolve(packet.cmd_tail[0])
+            path = target.path
+            if not packet.user.allowed(target, 'x'):
                 return ERR.PERMISSION_DENIED
-            if Path(packet.user.current_path).is_relative_to(path):
+            if packet.user.resolve().path.is_relative_to(path):
                 return f'[!] can not delete - use jump to change you folder up '.encode()
             try:
-                Path(path).rmdir()
+                path.rmdir()
             except Exception as E:
                 return ERR.NOT_FOUND(packet.cmd_tail[0])
-            res = f'[>] successfully deleted folder "{utility.trim_path(path=path.__str__(),user_home_folder=packet.user.home_path)}"'
+            changed(path, tree=True)
+            res = f'[>] successfully deleted folder "{target.trimmed}"'
         else:
             res = ERR.EMPTY_PATH
         return res.encode()
@@ -142,41 +276,57 @@ class UserCommands:
         '''
 
         if packet.cmd_tail:
-            path = Path(utility.define_path(packet.cmd_tail[0], packet.user.current_path))
-            if not utility.is_allowed(path, packet.user.permissions['x']):
+            target = packet.user.resolve(packet.cmd_tail[0])
+            path = target.path
+            if not packet.user.allowed(target, 'x'):
                 return ERR.PERMISSION_DENIED
             try:
-                Path(path).unlink()
+                with quotas.tracked(path):
+                    path.unlink()
             except Exception as E:
                 return ERR.NOT_FOUND(packet.cmd_tail[0])
-            res = f'[>] successfully deleted file "{utility.trim_path(path=path.__str__(),user_home_folder=packet.user.home_path)}"'
+            changed(path)
+            res = f'[>] successfully deleted file "{target.trimmed}"'
         else:
             res = ERR.EMPTY_PATH
         return res.encode()
 
     @staticmethod
-    async def send(packet: Packet, check_fragmentation: bool) -> Tuple[Callable, int] | Tuple[bool, bytes]:
+    async def send(packet: Packet, check_fragmentation: bool) -> Tuple[Callable, bytes] | Tuple[bool, bytes]:
         '''
         send - send file to file server.
                 "send > here" - send file to your current path
                 "send > home"
+                "send file > here -z zlib" (or lzma) - send file compressed. Server answers with codec id it accepts
+                in acknowledge (0 - none, 1 - zlib, 2 - lzma) after size of saved part of file.
+                "send file > here -h sha256" - if storage is deduplicated and you can read file with this sha256
+                (hashed by server when it was uploaded or by 'hash') server links it and answers with its size
+                as size of saved part, so file data is not sent (TCD8 client adds '-h' by itself).
+                Without it deduplicated storage saves disk space only: file is received in full and then linked.
+        Returns: saver and acknowledge reply (size of saved part of file [8 bytes] + codec id [1 byte] if asked)
         '''
+        if not packet.cmd_tail:
+            return False, ERR.EMPTY_PATH
 
         cursor_position = 0
         mode = 'wb'
+        linked = False
 
         _from, _to = packet.cmd_tail
-        if _to is None or _to == 'home':
-            path_to_save = Path().joinpath(packet.user.home_path, Path(_from).name)
-        elif _to == 'here':
-            path_to_save = Path().joinpath(packet.user.current_path, Path(_from).name)
+        if _to is None:
+            _from, options = utility.extract_options(_from, options=('z', 'h'))
         else:
-            path_to_save = Path().joinpath(_to, Path(_from).name)
+            _to, options = utility.extract_options(_to, options=('z', 'h'))
+        codec = choose_codec(options.get('z'), _from)
+        target = packet.user.resolve_save(_from, _to)
+        path_to_save = target.path
 
         if not path_to_save.parent.exists():
-            return False, ERR.NOT_FOUND(path_to_save.__str__())
-        elif not utility.is_allowed(path_to_save, packet.user.permissions['w']):
+            return False, ERR.NOT_FOUND(target.trimmed)
+        elif not packet.user.allowed(target, 'w'):
             return False, ERR.PERMISSION_DENIED
+        elif not quotas.allows(path_to_save, 1):
+            return False, ERR.QUOTA_EXCEEDED(quotas.report(path_to_save))
         else:  # try to find parts of file
             if check_fragmentation:
                 fragmented_path = Path(path_to_save.__str__() + '.part')
@@ -184,8 +334,23 @@ class UserCommands:
                     cursor_position = fragmented_path.stat().st_size
                     path_to_save = fragmented_path
                     mode = 'ab'
-
-        async def saver(packet: Packet, chunk: int = 8192) -> bytes:
+            if mode == 'wb' and 'h' in options:
+                sha256 = options['h'].lower()
+                size = blobs.size(sha256)
+                # stored file is linked only if user can read file with it, files of others are not given by hash
+                if size is not None and \
+                        any(packet.user.allowed(packet.user.resolve(held), 'r') for held in digests.holders(sha256)):
+                    # linked file is charged as any other one, if it does not fit quota file is sent as usual
+                    with quotas.reserved(path_to_save, quotas.size_of(path_to_save)) as reserve:
+                        if reserve(size):
+                            with quotas.tracked(path_to_save):
+                                size = blobs.link(sha256, path_to_save)
+                            if size is not None:
+                                cursor_position = size
+                                linked = True
+                                changed(path_to_save)
+
+        async def saver(packet: Packet) -> bytes:
             '''
             'saver' function implements saving whole file or part of it.
             If there is no part of file - open file with mode 'wb' and write file data.
@@ -193,36 +358,275 @@ class UserCommands:
             If we got part of file - just open existing file in 'ab' mode add data there
 
             When the whole file is downloaded - trim '.part' from file name
+            Data is written to disk by writer thread (see Transfer.DiskWriter.receive_to_file)
+            In deduplicated storage received file is stored in blob store (see Storage.BlobStore)
+            File is refused if its data does not fit quota of owner of folder: space is reserved before data
+            is received, compressed file is stopped when its decompressed data exceeds quota (received part is kept)
             '''
             saved_to = path_to_save.__str__()
-            parted = False
+            if linked:  # data sent anyway is not written over linked file
+                await skip_data(packet.user.sock.reader, packet.data_length, packet.user.chunk_sizer)
+                return f'[>] file was successfully saved to "{packet.user.trim(saved_to)}" (deduplicated)'.encode()
+            file_path = path_to_save if mode == 'wb' else Path(saved_to[:-5])
+            decoder = Decoder(codec) if codec != 'none' else None
+            digest = hashlib.sha256() if mode == 'wb' else None  # for blob store and digest cache
+            deduplicated = False
+            # overwritten file is freed, size of compressed file is known when it is decompressed
+            with quotas.reserved(file_path, quotas.size_of(file_path) if mode == 'wb' else 0) as reserve, \
+                    quotas.tracked(file_path, f'{file_path}.part'):  # detached link is freed too
+                if not reserve(0 if decoder else packet.data_length):
+                    await skip_data(packet.user.sock.reader, packet.data_length, packet.user.chunk_sizer)
+                    return ERR.QUOTA_EXCEEDED(quotas.report(file_path))
+                try:
+                    blobs.detach(path_to_save)
+                    with open(path_to_save, mode) as f, bandwidth.transfer(packet.user) as throttle:
+                        received, error = await receive_to_file(packet.user.sock.reader, f, packet.data_length,
+                                                                packet.user.chunk_sizer, decoder, throttle, digest,
+                                                                reserve if decoder else None)
+                    if error is not None:
+                        if path_to_save.suffix != '.part':
+                            path_to_save.rename(path_to_save.__str__() + '.part')
+                            saved_to = path_to_save.__str__() + '.part'
+                        if isinstance(error, QuotaExceeded):
+                            return ERR.QUOTA_EXCEEDED(f'{error}, received part is kept in '
+                                                      f'"{packet.user.trim(saved_to)}"')
+                    else:
+                        if mode == 'ab':
+                            path_to_save.rename(path_to_save.__str__()[:-5])
+                            saved_to = path_to_save.__str__()[:-5]
+                        deduplicated = await blobs.store(saved_to, digest and digest.hexdigest())
+                        if digest:
+                            digests.put(saved_to, 'sha256', digest.hexdigest())
+                except Exception as E:
+                    return ERR.OTHER(E)
+                finally:
+                    changed(path_to_save, saved_to)
+            return (f'[>] file was successfully saved to "{packet.user.trim(saved_to)}" '
+                    f'{decoder.report() if decoder else ""}{"(deduplicated)" if deduplicated else ""}').encode()
+
+        ack = struct.pack('>Q', cursor_position) + (bytes([CODECS.index(codec)]) if 'z' in options else b'')
+        return saver, ack
+
+    @staticmethod
+    async def psend(packet: Packet) -> Tuple[Callable, bytes] | Tuple[bool, bytes]:
+        '''
+        psend - send range of file. Ranges of one file can be sent by several connections at the same time.
+                "psend file > here -o 0 -l 1048576 -s 4194304" - send bytes [0, 1048576) of file of 4194304 bytes.
+                Ranges are written at their offsets into "file.ppart", when all of them are received
+                it is renamed to "file". File size is limited by max_size of [uploads] section of config.
+        Returns: saver and acknowledge reply (amount of already received bytes of range [8 bytes])
+        '''
+        if not packet.cmd_tail:
+            return False, ERR.EMPTY_PATH
+        _from, _to = packet.cmd_tail
+        if _to is None:
+            _from, options = utility.extract_options(_from, options=('o', 'l', 's'))
+        else:
+            _to, options = utility.extract_options(_to, options=('o', 'l', 's'))
+        try:
+            offset, length, size = int(options['o']), int(options['l']), int(options['s'])
+            if offset < 0 or length < 0 or offset + length > size:
+                raise ValueError
+        except (KeyError, ValueError):
+            return False, ERR.WRONG_VALUE('use "psend file > path -o offset -l length -s file size"')
+        target = packet.user.resolve_save(_from, _to)
+        path_to_save = target.path
+
+        if not path_to_save.parent.exists():
+            return False, ERR.NOT_FOUND(target.trimmed)
+        elif not packet.user.allowed(target, 'w'):
+            return False, ERR.PERMISSION_DENIED
+        elif not quotas.allows(path_to_save, size - quotas.size_of(path_to_save, f'{path_to_save}.ppart')):
+            return False, ERR.QUOTA_EXCEEDED(quotas.report(path_to_save))
+        try:
+            with quotas.tracked(path_to_save, f'{path_to_save}.ppart'):  # part is preallocated
+                upload = uploads.open(path_to_save, size)
+        except (ValueError, OSError) as E:
+            return False, ERR.OTHER(E)
+        received = min(upload.received_from(offset), length)
+        upload.writers += 1
+
+        async def saver(packet: Packet) -> bytes:
+            '''
+            write range at its offset. If connection fails received part of range is kept
+            and will not be asked again. Data longer than the rest of range is refused
+            '''
+            start = offset + received
+            written = 0
+            finished = False
             try:
-                with open(path_to_save, mode) as f:
-                    already_read = 0
-                    while already_read < packet.data_length:
-                        to_read = packet.data_length - already_read
-                        try:
-                            data = await asyncio.wait_for(
-                                packet.user.sock.reader.read(chunk if to_read > chunk else to_read), timeout=5)
-                            f.write(data)
-                            already_read += len(data)
-                            if data == b'' and to_read > 0:
-                                raise Exception
-                        except:
-                            f.close()
-                            if path_to_save.suffix != '.part':
-                                path_to_save.rename(path_to_save.__str__() + '.part')
-                                saved_to = path_to_save.__str__() + '.part'
-                            parted = True
-                            break
-                if mode == 'ab' and parted is False:
-                    path_to_save.rename(path_to_save.__str__()[:-5])
-                    saved_to = path_to_save.__str__()[:-5]
+                if packet.data_length > length - received:  # past the range (and maybe past the end of file)
+                    await skip_data(packet.user.sock.reader, packet.data_length, packet.user.chunk_sizer)
+                    return ERR.WRONG_VALUE(f'{length - received} bytes of range are left, '
+                                           f'{packet.data_length} bytes were sent')
+                with open(upload.part_path, 'r+b') as f, bandwidth.transfer(packet.user) as throttle:
+                    f.seek(start)
+                    written, error = await receive_to_file(packet.user.sock.reader, f, packet.data_length,
+                                                           packet.user.chunk_sizer, throttle=throttle)
             except Exception as E:
                 return ERR.OTHER(E)
-            return f'[>] file was successfully saved to "{utility.trim_path(path=saved_to.__str__(),user_home_folder=packet.user.home_path)}" '.encode()
+            finally:
+                upload.mark(start, start + written)
+                upload.writers -= 1
+                finished = not upload.writers and upload.complete
+                with quotas.tracked(upload.path, upload.part_path):
+                    uploads.close(upload)
+                changed(upload.part_path, upload.path)
+            if finished:
+                await blobs.store(upload.path)
+            if upload.complete:
+                return f'[>] file was successfully saved to "{packet.user.trim(upload.path)}" '.encode()
+            return f'[>] range saved, {upload.received} of {upload.size} bytes received'.encode()
+
+        return saver, struct.pack('>Q', received)
 
-        return saver, cursor_position
+    @staticmethod
+    async def sign(packet: Packet) -> bytes:
+        '''
+        sign - signature of file for delta update: 'sign file' or 'sign file -b 65536' (block size).
+               Reply is binary: block size [4 bytes] + file size [8 bytes]
+               + adler32 [4 bytes] and blake2b [16 bytes] of every block (see Transfer.Delta)
+        '''
+        if not packet.cmd_tail:
+            return ERR.EMPTY_PATH
+        arg, options = utility.extract_options(packet.cmd_tail[0], options=('b',))
+        target = packet.user.resolve(arg)
+        path = target.path
+        if not path.is_file():
+            return ERR.NOT_FOUND(arg)
+        if not packet.user.allowed(target, 'r'):
+            return ERR.PERMISSION_DENIED
+        try:
+            block_size = int(options.get('b', 0)) or block_size_for(path.stat().st_size)
+            if not 512 <= block_size <= 1 << 24:
+                raise ValueError
+        except ValueError:
+            return ERR.WRONG_VALUE('block size must be from 512 to 16777216')
+        return await asyncio.to_thread(signature, path, block_size)
+
+    @staticmethod
+    async def delta(packet: Packet) -> Tuple[Callable, bytes] | Tuple[bool, bytes]:
+        '''
+        delta - update existing file by its changes only (like rsync).
+                "delta file > here" - server answers with signature of its file (see sign),
+                client sends delta: new data and references to blocks of existing file (see Transfer.Delta).
+                New file is built in temporary file and replaces old one when it is checked by sha256.
+                "delta file > here -b 65536" - block size of signature
+        Returns: saver and acknowledge reply (signature of existing file)
+        '''
+        if not packet.cmd_tail:
+            return False, ERR.EMPTY_PATH
+        _from, _to = packet.cmd_tail
+        if _to is None:
+            _from, options = utility.extract_options(_from, options=('b',))
+        else:
+            _to, options = utility.extract_options(_to, options=('b',))
+        target = packet.user.resolve_save(_from, _to)
+        path_to_save = target.path
+
+        if not path_to_save.is_file():
+            return False, ERR.NOT_FOUND(target.trimmed)
+        elif not (packet.user.allowed(target, 'w') and packet.user.allowed(target, 'r')):
+            return False, ERR.PERMISSION_DENIED
+        elif not quotas.allows(path_to_save, 1):
+            return False, ERR.QUOTA_EXCEEDED(quotas.report(path_to_save))
+        try:
+            block_size = int(options.get('b', 0)) or block_size_for(path_to_save.stat().st_size)
+            if not 512 <= block_size <= 1 << 24:
+                raise ValueError
+        except ValueError:
+            return False, ERR.WRONG_VALUE('block size must be from 512 to 16777216')
+        file_signature = await asyncio.to_thread(signature, path_to_save, block_size)
+
+        async def saver(packet: Packet) -> bytes:
+            '''
+            build new file from delta next to old one and replace old file with it,
+            growth of file is reserved in quota of owner while new file is written
+            '''
+            tmp_path = Path(path_to_save.parent, f'.{path_to_save.name}.delta')
+            try:
+                with quotas.reserved(path_to_save, quotas.size_of(path_to_save)) as reserve:
+                    with open(path_to_save, 'rb') as old, open(tmp_path, 'wb') as f, \
+                            bandwidth.transfer(packet.user) as throttle:
+                        received, error, digest = await apply_delta(packet.user.sock.reader, old, f,
+                                                                    packet.data_length, block_size,
+                                                                    packet.user.chunk_sizer, throttle, reserve)
+                    if error is not None:
+                        tmp_path.unlink(missing_ok=True)
+                        if isinstance(error, QuotaExceeded):
+                            return ERR.QUOTA_EXCEEDED(error)
+                        return ERR.OTHER(error)
+                    with quotas.tracked(path_to_save):
+                        os.replace(tmp_path, path_to_save)
+                changed(path_to_save)
+                await blobs.store(path_to_save, digest)
+                digests.put(path_to_save, 'sha256', digest)
+            except Exception as E:
+                tmp_path.unlink(missing_ok=True)
+                return ERR.OTHER(E)
+            return (f'[>] file was successfully updated "{target.trimmed}" '
+                    f'({received} bytes of delta received)').encode()
+
+        return saver, file_signature
+
+    @staticmethod
+    async def push(packet: Packet) -> Tuple[Callable, bytes] | Tuple[bool, bytes]:
+        '''
+        push - upload local folder as tar archive: "push folder > here", "push folder > path to folder"
+               or "push folder -z zlib" (tar.gz, '-z lzma' - tar.xz) to home folder.
+               Archive is extracted while it is received, members you have no permission to write,
+               members leading out of target folder, links and devices are skipped
+        Returns: saver and acknowledge reply
+        '''
+        if not packet.cmd_tail:
+            return False, ERR.EMPTY_PATH
+        _from, _to = packet.cmd_tail
+        if _to is None:
+            _from, _ = utility.extract_options(_from, options=('z',))
+        else:
+            _to, _ = utility.extract_options(_to, options=('z',))
+        target = packet.user.resolve_folder(_to)
+        folder = target.path
+
+        if not folder.is_dir():
+            return False, ERR.NOT_FOUND(target.trimmed)
+        elif not packet.user.allowed(target, 'w'):
+            return False, ERR.PERMISSION_DENIED
+        elif not quotas.allows(folder, 1):
+            return False, ERR.QUOTA_EXCEEDED(quotas.report(folder))
+        permissions = packet.user.grants['w']
+
+        async def saver(packet: Packet) -> bytes:
+            '''
+            extract archive into folder while it is received,
+            space of every file is reserved in quota of owner of folder before it is extracted,
+            files which do not fit quota are skipped
+            '''
+            with quotas.reserved(folder) as reserve:
+                try:
+                    with bandwidth.transfer(packet.user) as throttle:
+                        received, error, extracted = await receive_tar(packet.user.sock.reader, folder,
+                                                                       packet.data_length,
+                                                                       lambda path: utility.is_allowed(path,
+                                                                                                       permissions),
+                                                                       packet.user.chunk_sizer, throttle, reserve)
+                except Exception as E:
+                    return ERR.OTHER(E)
+                finally:
+                    changed(folder, tree=True)
+                if extracted is None:
+                    return ERR.OTHER(error)
+                quotas.charge(folder, extracted.grown)
+            reply = (f'[>] {extracted.files} files and {extracted.folders} folders extracted to '
+                     f'"{target.trimmed}"')
+            if extracted.skipped:
+                reply += f', skipped {len(extracted.skipped)}: {", ".join(extracted.skipped[:10])}'
+                reply += ' ...' if len(extracted.skipped) > 10 else ''
+            if error is not None:
+                reply += f' (archive is not complete: {error})'
+            return reply.encode()
+
+        return saver, struct.pack('>Q', 0)
 
     @staticmethod
     async def jump(packet: Packet) -> bytes:
@@ -233,18 +637,18 @@ class UserCommands:
                'jump -home' moves you to your home directory
         '''
         if not packet.cmd_tail:
-            path = Path(packet.user.current_path).parent
+            target = packet.user.resolve('..')
         else:
             if packet.cmd_tail[0].startswith('-home'):
-                path = Path(packet.user.home_path)
+                target = packet.user.resolve(packet.user.home_path)
             else:
-                path = Path(utility.define_path(packet.cmd_tail[0], packet.user.current_path))
-        if Path(path).exists() and Path(path).is_dir():
-            if not utility.is_allowed(path, packet.user.permissions['x']):
+                target = packet.user.resolve(packet.cmd_tail[0])
+        if metadata.is_dir(target.text):
+            if not packet.user.allowed(target, 'x'):
                 return ERR.PERMISSION_DENIED
 
-            packet.user.current_path = path.__str__()
-            res = f'[>] path changed to {utility.trim_path(path=path.__str__(),user_home_folder=packet.user.home_path)}'.encode()
+            packet.user.current_path = target.text
+            res = f'[>] path changed to {target.trimmed}'.encode()
         else:
             res = ERR.NOT_FOUND(packet.cmd_tail[0])
         return res
@@ -258,12 +662,12 @@ class UserCommands:
         if not packet.cmd_tail:
             res = ERR.EMPTY_PATH
         else:
-            path = Path(utility.define_path(packet.cmd_tail[0], packet.user.current_path))
-            if not utility.is_allowed(path, packet.user.permissions['x']):
+            target = packet.user.resolve(packet.cmd_tail[0])
+            if not packet.user.allowed(target, 'x'):
                 return ERR.PERMISSION_DENIED
             try:
-                status = Path(path).stat()
-                res = (f'[>] {utility.trim_path(path=path.__str__(),user_home_folder=packet.user.home_path)} info:\n\t'
+                status = metadata.stat(target.text)
+                res = (f'[>] {target.trimmed} info:\n\t'
                        f'Size: {status.st_size} bytes\n\t'
                        f'Permissions:{stat.filemode(status.st_mode)}\n\t'
                        # f'Owner:{status.st_uid}\n\t'
@@ -275,6 +679,36 @@ class UserCommands:
                 res = ERR.NOT_FOUND(packet.cmd_tail[0])
         return res
 
+    @staticmethod
+    async def du(packet: Packet) -> bytes:
+        '''
+        du - space used in your home and your quota (counted as files are written, no folder is walked)
+        '''
+        return f'[>] {quotas.report(packet.user.home_path)}'.encode()
+
+    @staticmethod
+    async def hash(packet: Packet) -> bytes:
+        '''
+        hash - show digest of file: 'hash file' (sha256) or 'hash file -a blake2b'.
+               Digests are cached until file is changed, digest of uploaded file is counted while it is received
+        '''
+        if not packet.cmd_tail:
+            return ERR.EMPTY_PATH
+        arg, options = utility.extract_options(packet.cmd_tail[0], options=('a',))
+        algorithm = options.get('a', 'sha256')
+        if algorithm not in ALGORITHMS:
+            return ERR.WRONG_VALUE(f'use one of {", ".join(ALGORITHMS)}')
+        target = packet.user.resolve(arg)
+        if not target.path.is_file():
+            return ERR.NOT_FOUND(arg)
+        if not packet.user.allowed(target, 'r'):
+            return ERR.PERMISSION_DENIED
+        try:
+            digest = await digests.digest(target.path, algorithm)
+        except OSError as E:
+            return ERR.OTHER(E)
+        return f'[>] {algorithm} {digest} "{target.trimmed}"'.encode()
+
     @staticmethod
     async def whoami(packet: Packet) -> bytes:
         '''
@@ -283,48 +717,61 @@ class UserCommands:
         return packet.user.get_full_info().encode()
 
     @staticmethod
-    async def rawsend(packet: Packet, check_fragmentation=True, chunk=4096) -> bytes:
+    async def rawsend(packet: Packet, check_fragmentation=True) -> bytes:
         '''
         rawsend - ...
+                  'rawsend file size -z zlib' (or lzma) - data is compressed by client
         '''
         mode = 'wb'
-        parted = False
         file_name = packet.cmd_tail[0]
         timeout_err = ''
-
-        path_to_save = Path(packet.user.current_path, file_name)
+        _, options = utility.extract_options(' '.join(packet.cmd_tail[1:]), options=('z',))
+        decoder = Decoder(options['z']) if options.get('z') in CODECS[1:] else None
+
+        target = packet.user.resolve(file_name)
+        if not packet.user.allowed(target, 'w'):  # links leading out of home are refused too
+            await skip_data(packet.user.sock.reader, packet.data_length, packet.user.chunk_sizer)
+            return ERR.PERMISSION_DENIED
+        path_to_save = target.path
         saved_to = path_to_save.__str__()
         if check_fragmentation:
             fragmented_path = Path(path_to_save.__str__() + '.part')
             if fragmented_path.exists():
                 path_to_save = fragmented_path
                 mode = 'ab'
-            try:
-                with open(path_to_save, mode) as f:
-                    already_read = 0
-                    while already_read < packet.data_length:
-                        to_read = packet.data_length - already_read
-                        try:
-                            data = await asyncio.wait_for(
-                                packet.user.sock.reader.read(chunk if to_read > chunk else to_read), timeout=5)
-                            f.write(data)
-                            already_read += len(data)
-                            if not data and to_read > 0:
-                                raise Exception
-                        except Exception as E:
-                            if isinstance(E, asyncio.TimeoutError):
-                                timeout_err = '(5 sec data timeout expired) '
-                            f.close()
-                            if path_to_save.suffix != '.part':
-                                path_to_save.rename(path_to_save.__str__() + '.part')
-                                saved_to = path_to_save.__str__() + '.part'
-                            else:
-                                saved_to = path_to_save.__str__()
-                            parted = True
-                            break
-                if mode == 'ab' and parted is False:
-                    path_to_save.rename(path_to_save.__str__()[:-5])
-                    saved_to = path_to_save.__str__()[:-5]
-            except Exception as E:
-                return ERR.OTHER(': use correct input')
-        return f'{timeout_err}{file_name} was successfully saved to {utility.trim_path(path=saved_to.__str__(),user_home_folder=packet.user.home_path)}'.encode()
+            file_path = Path(saved_to)
+            digest = hashlib.sha256() if mode == 'wb' else None  # for blob store and digest cache
+            with quotas.reserved(file_path, quotas.size_of(file_path) if mode == 'wb' else 0) as reserve, \
+                    quotas.tracked(file_path, f'{file_path}.part'):
+                if not reserve(0 if decoder else packet.data_length):
+                    await skip_data(packet.user.sock.reader, packet.data_length, packet.user.chunk_sizer)
+                    return ERR.QUOTA_EXCEEDED(quotas.report(file_path))
+                try:
+                    blobs.detach(path_to_save)
+                    with open(path_to_save, mode) as f, bandwidth.transfer(packet.user) as throttle:
+                        received, error = await receive_to_file(packet.user.sock.reader, f, packet.data_length,
+                                                                packet.user.chunk_sizer, decoder, throttle, digest,
+                                                                reserve if decoder else None)
+                    if error is not None:
+                        if isinstance(error, asyncio.TimeoutError):
+                            timeout_err = f'({error}) '
+                        if path_to_save.suffix != '.part':
+                            path_to_save.rename(path_to_save.__str__() + '.part')
+                            saved_to = path_to_save.__str__() + '.part'
+                        else:
+                            saved_to = path_to_save.__str__()
+                        if isinstance(error, QuotaExceeded):
+                            return ERR.QUOTA_EXCEEDED(f'{error}, received part is kept in {packet.user.trim(saved_to)}')
+                    else:
+                        if mode == 'ab':
+                            path_to_save.rename(path_to_save.__str__()[:-5])
+                            saved_to = path_to_save.__str__()[:-5]
+                        await blobs.store(saved_to, digest and digest.hexdigest())
+                        if digest:
+                            digests.put(saved_to, 'sha256', digest.hexdigest())
+                except Exception as E:
+                    return ERR.OTHER(': use correct input')
+                finally:
+                    changed(path_to_save, saved_to)
+        return (f'{timeout_err}{file_name} was successfully saved to {packet.user.trim(saved_to)}'
+                f'{" " + decoder.report() if decoder else ""}').encode()
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+
+class Histogram:
+    '''
+    cumulative histogram of command latencies (seconds) with fixed buckets
+    '''
+    buckets: Tuple[float, ...] = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.
+        self.count = 0
+        self.max = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        '''
+        upper bound of bucket which contains q-quantile
+        '''
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.max
+
+
+class MetricsCollector:
+    '''
+    Server metrics:
+    - count and latency histogram of every command
+    - received and sent bytes
+    - active sessions and file transfers in progress
+    - hits and misses of metadata cache
+
+    render() - text for 'mets' command
+    render_prometheus() - text in Prometheus exposition format (for serve_metrics endpoint)
+    '''
+
+    def __init__(self):
+        self.commands: Dict[str, Histogram] = dict()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active_sessions = 0
+        self.transfers_in_flight = 0
+        self.cache_hits = 0  # metadata cache of list, info and jump
+        self.cache_misses = 0
+        self.started = time.time()
+
+    def observe(self, command: str, seconds: float):
+        if command not in self.commands:
+            self.commands[command] = Histogram()
+        self.commands[command].observe(seconds)
+
+    @contextmanager
+    def transfer(self):
+        self.transfers_in_flight += 1
+        try:
+            yield
+        finally:
+            self.transfers_in_flight -= 1
+
+    def render(self) -> str:
+        res = (f'Uptime: {int(time.time() - self.started)} sec\n'
+               f'Active sessions: {self.active_sessions}\n'
+               f'Transfers in flight: {self.transfers_in_flight}\n'
+               f'Bytes in: {self.bytes_in}\n'
+               f'Bytes out: {self.bytes_out}\n'
+               f'Metadata cache: {self.cache_hits} hits, {self.cache_misses} misses\n'
+               f'Commands:\n')
+        for command, hist in sorted(self.commands.items()):
+            res += (f'\t{command}: count {hist.count}, avg {hist.sum / hist.count * 1000:.2f} ms, '
+                    f'p50 <= {hist.quantile(.5) * 1000:g} ms, p95 <= {hist.quantile(.95) * 1000:g} ms, '
+                    f'max {hist.max * 1000:.2f} ms\n')
+        return res
+
+    def render_prometheus(self) -> str:
+        lines = ['# HELP rub_command_duration_seconds Time of command execution including answer sending',
+                 '# TYPE rub_command_duration_seconds histogram']
+        for command, hist in sorted(self.commands.items()):
+            cumulative = 0
+            for bound, count in zip(hist.buckets + (float('inf'),), hist.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'rub_command_duration_seconds_bucket{{command="{command}",le="{le}"}} {cumulative}')
+            lines.append(f'rub_command_duration_seconds_sum{{command="{command}"}} {hist.sum}')
+            lines.append(f'rub_command_duration_seconds_count{{command="{command}"}} {hist.count}')
+        for name, kind, value, doc in (
+                ('rub_received_bytes_total', 'counter', self.bytes_in, 'Bytes received from users'),
+                ('rub_sent_bytes_total', 'counter', self.bytes_out, 'Bytes sent to users'),
+                ('rub_active_sessions', 'gauge', self.active_sessions, 'Connected users'),
+                ('rub_transfers_in_flight', 'gauge', self.transfers_in_flight, 'File transfers in progress'),
+                ('rub_metadata_cache_hits_total', 'counter', self.cache_hits, 'Metadata cache hits'),
+                ('rub_metadata_cache_misses_total', 'counter', self.cache_misses, 'Metadata cache misses')):
+            lines += [f'# HELP {name} {doc}', f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsCollector()
+
+
+async def serve_metrics(host: str, port: int) -> asyncio.AbstractServer:
+    '''
+    start local http endpoint which answers any request with metrics in Prometheus exposition format
+    '''
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = metrics.render_prometheus().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -1,11 +1,30 @@
+import asyncio
 import socket
 import struct
+import weakref
 from abc import abstractmethod
+from contextvars import ContextVar
 from pathlib import Path
-from typing import Tuple
+from typing import AsyncGenerator, Dict, Iterable, List, Tuple
+
+from Storage.BlobStore import file_digest
+from Transfer.Archive import tar_payload
+from Transfer.Bandwidth import UNLIMITED, Throttle
+from Transfer.ChunkSizer import ChunkSizer
+from Transfer.Compression import CODECS, compress_bytes
+from Transfer.Delta import DeltaPayload, delta_payload
+from utility import CHUNKED, FileSlice, extract_options, gen_chunk_read
+
+
+class FrameError(Exception):
+    '''
+    raised when incoming packet header breaks protocol limits
+    '''
+    pass
 
 
 class BaseProtocol(object):
+    multiplexed = False  # True if protocol allows to process several requests of one session concurrently
     # SERVER SIDE
     @abstractmethod
     async def handshake(self, reader, writer) -> str:
@@ -25,9 +44,63 @@ class BaseProtocol(object):
         pass
 
     @abstractmethod
-    async def send_file(self, reader, writer, data: bytes):
+    async def send_file(self, reader, writer, data: Tuple[FileSlice | AsyncGenerator, int],
+                        sizer: ChunkSizer = None, throttle: Throttle = UNLIMITED) -> int:
+        '''
+        sizer: chunk size of user session
+        throttle: bandwidth limit of transfer (see Transfer.Bandwidth)
+        Returns: amount of sent bytes of file
+        '''
         pass
 
+    @staticmethod
+    async def stream_file(writer, source: FileSlice | AsyncGenerator, sizer: ChunkSizer = None,
+                          throttle: Throttle = UNLIMITED) -> int:
+        '''
+        write file body to socket.
+        FileSlice is sent by loop.sendfile (os.sendfile) straight from file descriptor to socket,
+        by one call or chunk by chunk if transfer is throttled.
+        If transport does not support it (ssl, windows selector loop) - the rest of file
+        is sent chunk by chunk by gen_chunk_read.
+        Measured throughput adjusts chunk size of session (see Transfer.ChunkSizer)
+
+        Returns: amount of sent bytes
+        '''
+        sizer = sizer or ChunkSizer()
+        loop = asyncio.get_running_loop()
+        sent = 0
+        started = loop.time()
+        if isinstance(source, FileSlice):
+            if source.count == 0:
+                return 0
+            with open(source.path, 'rb') as f:
+                try:
+                    if not throttle.limited:
+                        sent = await loop.sendfile(writer.transport, f, source.offset, source.count, fallback=False)
+                        sizer.update(sent, loop.time() - started)
+                        return sent
+                    while sent < source.count:
+                        count = min(sizer.size, source.count - sent)
+                        await throttle.consume(count)
+                        sent += await loop.sendfile(writer.transport, f, source.offset + sent, count, fallback=False)
+                        now = loop.time()
+                        sizer.update(count, now - started, writer.transport.get_write_buffer_size())
+                        started = now
+                    return sent
+                except (asyncio.SendfileNotAvailableError, RuntimeError):
+                    sent = max(f.tell() - source.offset, 0)
+            source = gen_chunk_read(source.path, chunk_size=sizer.size, offset=source.offset + sent,
+                                    count=source.count - sent)
+        async for chunk in source:
+            await throttle.consume(len(chunk))
+            writer.write(chunk)
+            sent += len(chunk)
+            await writer.drain()
+            now = loop.time()
+            sizer.update(len(chunk), now - started, writer.transport.get_write_buffer_size())
+            started = now
+        return sent
+
     # client side
     @abstractmethod
     def send_request(self, csock: socket.socket, request: str):
@@ -52,33 +125,62 @@ class BaseProtocol(object):
 
 
 class TCD8(BaseProtocol):
+    header = struct.Struct('>QQQ')  # total length + command length + other data length
 
-    async def receive_data(self, reader, writer) -> Tuple[bytes, int]:
+    def __init__(self, max_command_length: int = 4096, max_data_length: int = 1 << 40):
+        self.max_command_length = max_command_length
+        self.max_data_length = max_data_length
+
+    def check_header(self, length: int, cmd_length: int, data_length: int):
         '''
-        receive data according to protocol:
-        total length [8 bytes] + command length [8 bytes] + other data length [8 bytes] + data if data length != 0
+        validate header fields before reading anything else from socket
+        '''
+        if cmd_length > self.max_command_length:
+            raise FrameError(f'command length {cmd_length} exceeds limit {self.max_command_length}')
+        if data_length > self.max_data_length:
+            raise FrameError(f'data length {data_length} exceeds limit {self.max_data_length}')
+        if length < cmd_length:
+            raise FrameError(f'total length {length} is less than command length {cmd_length}')
+
+    async def receive_packet(self, reader, writer) -> Tuple[Tuple[int, ...], bytes]:
+        '''
+        receive header fields and command according to protocol.
+        The whole header is read by single readexactly, so short reads can not desynchronize the stream.
+        Requests sent back to back (pipelined) are taken from StreamReader buffer one after another.
+        If header breaks limits connection is closed - there is no way to find next packet boundary.
 
+        Returns: (header fields, command) or ((), b'') if receiving failed
         '''
         addr = writer.get_extra_info("peername")
-        failed_recv = (b'', 0)
+        failed_recv = ((), b'')
         try:
-            r_total_len = await reader.read(8)
-            r_c_length = await reader.read(8)
-            r_data_len = await reader.read(8)
-            (length,) = struct.unpack('>Q', r_total_len)
-            (cmd_length,) = struct.unpack('>Q', r_c_length)
-            (data_length,) = struct.unpack('>Q', r_data_len)
-            command = await reader.read(cmd_length)
-        except Exception as E:
-            print(f'[x] something went wrong {E}')
+            fields = self.header.unpack(await reader.readexactly(self.header.size))
+            self.check_header(*fields[:3])
+            command = await reader.readexactly(fields[1])
+        except asyncio.IncompleteReadError:
+            print(f'[x] disconnected by, {addr}')
             return failed_recv
         except ConnectionError:
             print(f'[x] client suddenly closed connection')
             return failed_recv
-        print(f'<<... {command} from: {addr} length: {length}')
+        except FrameError as E:
+            print(f'[x] bad packet from {addr}: {E}')
+            return failed_recv
+        except Exception as E:
+            print(f'[x] something went wrong {E}')
+            return failed_recv
+        print(f'<<... {command} from: {addr} length: {fields[0]}')
         if not command:
             print(f'[x] disconnected by, {addr}')
-        return command, data_length
+        return fields, command
+
+    async def receive_data(self, reader, writer) -> Tuple[bytes, int]:
+        '''
+        receive data according to protocol:
+        total length [8 bytes] + command length [8 bytes] + other data length [8 bytes] + data if data length != 0
+        '''
+        fields, command = await self.receive_packet(reader, writer)
+        return command, fields[2] if fields else 0
 
     async def send_data(self, reader, writer, data: bytes, with_ack=False, ack=False):
         '''
@@ -106,28 +208,27 @@ class TCD8(BaseProtocol):
             print(f'[x] client suddenly closed, can not send')
         print(f'...>> {data} to: {addr}')
 
-    async def send_file(self, reader, writer, data: bytes):
+    async def send_file(self, reader, writer, data: Tuple[FileSlice | AsyncGenerator, int],
+                        sizer: ChunkSizer = None, throttle: Throttle = UNLIMITED) -> int:
         '''
-        send file as bytes to user by generator
+        send file as bytes to user (see BaseProtocol.stream_file)
         protocol:
-        total length [8 bytes] + data chunk by chunk
+        total length [8 bytes] + file data
+        total length is utility.CHUNKED if file is sent by blocks (e.g. compressed)
         '''
         addr = writer.get_extra_info("peername")
-        print(data)
+        sent = 0
         try:
-            gen, file_size = data
+            source, file_size = data
             length: bytes = struct.pack('>Q', file_size)
             writer.write(length)
-            await writer.drain()
-            async for chunk in gen:
-                writer.write(chunk)
-                await writer.drain()
-                print(chunk)
+            sent = await self.stream_file(writer, source, sizer, throttle)
         except StopIteration:
             print(f'[i] EOF')
         except ConnectionError:
             print(f'[x] client suddenly closed, can not send')
         print(f'...>> {data} to: {addr}')
+        return sent
 
     def send_request(self, csock: socket.socket, request: str):
         cmd_length: bytes = struct.pack('>Q', len(request))
@@ -145,6 +246,8 @@ class TCD8(BaseProtocol):
             to_read -= 1
         else:
             (to_read,) = struct.unpack('>Q', rdata)
+        if to_read == CHUNKED:
+            return self.receive_blocks(csock)
         data = b''
         while to_read:
             try:
@@ -155,31 +258,288 @@ class TCD8(BaseProtocol):
                 break
         return (data, ack) if with_ack else data
 
+    @staticmethod
+    def recv_exactly(csock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            try:
+                rdata = csock.recv(size - len(data))
+            except socket.timeout:
+                continue
+            if not rdata:
+                raise ConnectionError('server closed connection')
+            data += rdata
+        return bytes(data)
+
+    def receive_blocks(self, csock: socket.socket) -> bytes:
+        '''
+        receive reply sent by blocks (see utility.CHUNKED) till empty block.
+        Returns: blocks with their lengths (see Transfer.Compression.decompress_blocks)
+        '''
+        data = b''
+        while True:
+            header = self.recv_exactly(csock, 4)
+            (length,) = struct.unpack('>I', header)
+            data += header + self.recv_exactly(csock, length)
+            if not length:
+                return data
+
+    @staticmethod
+    def file_payload(_from: str, ack_reply: bytes) -> bytes:
+        '''
+        part of file which server asked for (compressed if server accepted codec)
+        ack_reply: size of saved part of file [8 bytes] + codec id [1 byte] if codec was asked by '-z codec'
+        '''
+        (_cursor,) = struct.unpack('>Q', ack_reply[:8])
+        file_size = Path(_from).stat().st_size
+        if _cursor == file_size:  # whole file is saved (or linked by hash), even compressed empty data is not sent
+            return b''
+        if _cursor > file_size:
+            _cursor = 0
+        with open(_from, 'rb') as f:
+            f.seek(_cursor)
+            data = f.read()
+        codec = CODECS[ack_reply[8]] if len(ack_reply) > 8 else 'none'
+        return compress_bytes(data, codec) if codec != 'none' else data
+
+    @staticmethod
+    def send_payload(csock: socket.socket, payload: bytes | Iterable[bytes]):
+        '''
+        payload made while it is sent (see Transfer.Delta.DeltaPayload) is sent by pieces
+        '''
+        if isinstance(payload, (bytes, bytearray)):
+            csock.sendall(payload)
+            return
+        for piece in payload:
+            csock.sendall(piece)
+
+    def request_payload(self, request: str, _from: str, ack_reply: bytes) -> bytes | DeltaPayload:
+        '''
+        data which follows acknowledge: delta of file for 'delta' (ack_reply is signature),
+        tar of folder for 'push', otherwise file
+        '''
+        if request.startswith('delta'):
+            return delta_payload(_from, ack_reply)
+        if request.startswith('push'):
+            return tar_payload(_from, extract_options(request, options=('z',))[1].get('z', 'none'))
+        return self.file_payload(_from, ack_reply)
+
+    @staticmethod
+    def with_digest(request: str, _from: str) -> str:
+        '''
+        hash first: sha256 of file is added to 'send' as '-h sha256', so server links file with the same content
+        which user can read instead of receiving it again (see UserCommands.send), otherwise file is sent as usual
+        '''
+        if not request.startswith('send ') or 'h' in extract_options(request, options=('z', 'h', 'b'))[1] \
+                or not Path(_from).is_file():
+            return request
+        return f'{request} -h {file_digest(Path(_from))}'
+
     def file_send_request(self, csock: socket.socket, request: str):
-        _, _from, *_to = request.split()
+        _, _from, *_to = extract_options(request, options=('z', 'h', 'b'))[0].split()
+        request = self.with_digest(request, _from)
 
         def pre_send_request():
             self.send_request(csock, request)
             return self.receive_reply(csock, with_ack=True)
 
-        def send_file(_from, cursor):
-            (_cursor,) = struct.unpack('>Q', cursor)
-            file_size = Path(_from).stat().st_size
-            if _cursor > file_size:
-                _cursor = 0
+        def send_file(_from, ack_reply):
+            payload = self.request_payload(request, _from, ack_reply)
             t_length = struct.pack('>Q', len(request) + 8)
             req_length = struct.pack('>Q', len(request))
-            data_length = struct.pack('>Q', file_size - _cursor)
+            data_length = struct.pack('>Q', len(payload))
             packet = t_length + req_length + data_length + request.encode()
             csock.sendall(packet)
-            with open(_from, 'rb') as f:
-                f.seek(_cursor)
-                csock.sendall(f.read())
+            self.send_payload(csock, payload)
 
         data, ack = pre_send_request()
         if ack:
             send_file(_from, data)
 
+    def parallel_file_send_request(self, csocks: List[socket.socket], request: str) -> List[bytes]:
+        '''
+        send file by ranges through several connections at the same time (see UserCommands.psend)
+        request: 'psend file > path', range options are added for every connection
+        Returns: replies of every connection
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        _from = request.split()[1]
+        size = Path(_from).stat().st_size
+        step = max(-(-size // len(csocks)), 1)
+
+        def send_range(csock: socket.socket, offset: int) -> bytes:
+            length = min(step, size - offset)
+            range_request = f'{request} -o {offset} -l {length} -s {size}'
+            self.send_request(csock, range_request)
+            ack_reply, ack = self.receive_reply(csock, with_ack=True)
+            if ack:
+                (received,) = struct.unpack('>Q', ack_reply)
+                with open(_from, 'rb') as f:
+                    f.seek(offset + received)
+                    payload = f.read(length - received)
+                csock.sendall(self.header.pack(len(range_request) + 8, len(range_request), len(payload))
+                              + range_request.encode())
+                csock.sendall(payload)
+            return self.receive_reply(csock)
+
+        with ThreadPoolExecutor(len(csocks)) as pool:
+            return list(pool.map(send_range, csocks, range(0, max(size, 1), step)))
+
+
+class TCD8Mux(TCD8):
+    '''
+    TCD8 with request id in every packet. Server runs requests of one session concurrently,
+    so replies and file chunks of different requests are interleaved in one connection.
+    request: total length [8 bytes] + command length [8 bytes] + other data length [8 bytes] + request id [4 bytes]
+             + command + data if data length != 0
+    reply: payload length [8 bytes] + request id [4 bytes] + flags [1 byte] + payload
+
+    flags:
+    END - last frame of reply
+    ACK - acknowledge of 'send' request, ACK_OK - request is accepted
+    HEAD - first frame of file reply, payload is file size [8 bytes]. Then file is sent by frames
+           with no flags and reply ends with empty END frame
+    '''
+    multiplexed = True
+    header = struct.Struct('>QQQI')
+    reply_header = struct.Struct('>QIB')
+    END, ACK, ACK_OK, HEAD = 1, 2, 4, 8
+    request_id: ContextVar = ContextVar('request_id', default=0)  # id of request processed in current task
+
+    def __init__(self, max_command_length: int = 4096, max_data_length: int = 1 << 40):
+        super().__init__(max_command_length, max_data_length)
+        self.__locks = weakref.WeakKeyDictionary()  # writer -> lock, frame is written to socket as a whole
+        # client side
+        self.last_request_id = 0
+        self.__pending: Dict[int, List[Tuple[int, bytes]]] = dict()
+
+    def lock(self, writer) -> asyncio.Lock:
+        if writer not in self.__locks:
+            self.__locks[writer] = asyncio.Lock()
+        return self.__locks[writer]
+
+    async def receive_frame(self, reader, writer) -> Tuple[int, bytes, int]:
+        '''
+        Returns: (request id, command, data length)
+        '''
+        fields, command = await self.receive_packet(reader, writer)
+        return (fields[3], command, fields[2]) if fields else (0, b'', 0)
+
+    async def send_frame(self, writer, flags: int, payload: bytes = b''):
+        async with self.lock(writer):
+            writer.write(self.reply_header.pack(len(payload), self.request_id.get(), flags))
+            writer.write(payload)
+            await writer.drain()
+
+    async def send_data(self, reader, writer, data: bytes, with_ack=False, ack=False):
+        '''
+        send text as bytes to user in one frame.
+        reply with ack does not end request - result of 'send' follows it
+        '''
+        addr = writer.get_extra_info("peername")
+        try:
+            await self.send_frame(writer, (self.ACK | (self.ACK_OK if ack else 0)) if with_ack else self.END, data)
+        except ConnectionError:
+            print(f'[x] client suddenly closed, can not send')
+        print(f'...>> {data} to: {addr} request: {self.request_id.get()}')
+
+    async def send_file(self, reader, writer, data: Tuple[FileSlice | AsyncGenerator, int],
+                        sizer: ChunkSizer = None, throttle: Throttle = UNLIMITED) -> int:
+        '''
+        send file by frames of session chunk size. Every chunk of FileSlice is sent by loop.sendfile right after
+        its frame header, other requests can write their frames between chunks
+        '''
+        addr = writer.get_extra_info("peername")
+        sizer = sizer or ChunkSizer()
+        loop = asyncio.get_running_loop()
+        sent = 0
+        try:
+            source, file_size = data
+            await self.send_frame(writer, self.HEAD, struct.pack('>Q', file_size))
+            started = loop.time()
+            if isinstance(source, FileSlice):
+                with open(source.path, 'rb') as f:
+                    offset, left = source.offset, source.count
+                    while left > 0:
+                        count = min(sizer.size, left)
+                        await throttle.consume(count)
+                        async with self.lock(writer):
+                            writer.write(self.reply_header.pack(count, self.request_id.get(), 0))
+                            await loop.sendfile(writer.transport, f, offset, count)
+                        offset += count
+                        left -= count
+                        sent += count
+                        now = loop.time()
+                        sizer.update(count, now - started, writer.transport.get_write_buffer_size())
+                        started = now
+            else:
+                async for chunk in source:
+                    await throttle.consume(len(chunk))
+                    await self.send_frame(writer, 0, chunk)
+                    sent += len(chunk)
+                    now = loop.time()
+                    sizer.update(len(chunk), now - started, writer.transport.get_write_buffer_size())
+                    started = now
+            await self.send_frame(writer, self.END)
+        except ConnectionError:
+            print(f'[x] client suddenly closed, can not send')
+        print(f'...>> {data} to: {addr} request: {self.request_id.get()}')
+        return sent
+
+    # CLIENT SIDE
+    def send_request(self, csock: socket.socket, request: str, data_length: int = 0, request_id: int = None) -> int:
+        '''
+        send request with new id (or with request_id if it is continuation of request)
+        Returns: request id
+        '''
+        if request_id is None:
+            self.last_request_id += 1
+            request_id = self.last_request_id
+        _request = request.encode()
+        csock.sendall(self.header.pack(len(_request) + 8, len(_request), data_length, request_id) + _request)
+        return request_id
+
+    def receive_frame_reply(self, csock: socket.socket, request_id: int) -> Tuple[int, bytes]:
+        '''
+        get next frame of request. Frames of other requests are kept until they are asked for
+        Returns: (flags, payload)
+        '''
+        if self.__pending.get(request_id):
+            return self.__pending[request_id].pop(0)
+        while True:
+            length, _request_id, flags = self.reply_header.unpack(self.recv_exactly(csock, self.reply_header.size))
+            payload = self.recv_exactly(csock, length)
+            if _request_id == request_id:
+                return flags, payload
+            self.__pending.setdefault(_request_id, []).append((flags, payload))
+
+    def receive_reply(self, csock: socket.socket, with_ack=False, request_id: int = None) -> Tuple[bytes, bool] | bytes:
+        '''
+        collect reply of request (last sent by default)
+        '''
+        request_id = self.last_request_id if request_id is None else request_id
+        data = b''
+        while True:
+            flags, payload = self.receive_frame_reply(csock, request_id)
+            if flags & self.ACK:
+                return payload, bool(flags & self.ACK_OK)
+            if flags & self.HEAD:
+                continue
+            data += payload
+            if flags & self.END:
+                return data
+
+    def file_send_request(self, csock: socket.socket, request: str):
+        _, _from, *_to = extract_options(request, options=('z', 'h', 'b'))[0].split()
+        request = self.with_digest(request, _from)
+        request_id = self.send_request(csock, request)
+        ack_reply, ack = self.receive_reply(csock, with_ack=True, request_id=request_id)
+        if ack:
+            payload = self.request_payload(request, _from, ack_reply)
+            self.send_request(csock, request, data_length=len(payload), request_id=request_id)
+            self.send_payload(csock, payload)
+
 
 class SimpleProto(BaseProtocol):
     # SERVER SIDE
@@ -217,18 +577,16 @@ class SimpleProto(BaseProtocol):
             print(f'[x] client suddenly closed, can not send')
         print(f'...>> {data} to: {addr}')
 
-    async def send_file(self, reader, writer, data: bytes):
+    async def send_file(self, reader, writer, data: Tuple[FileSlice | AsyncGenerator, int],
+                        sizer: ChunkSizer = None, throttle: Throttle = UNLIMITED) -> int:
         '''
-        send file as bytes to user by generator
+        send file as bytes to user (see BaseProtocol.stream_file)
         '''
         addr = writer.get_extra_info("peername")
+        sent = 0
         try:
-            gen, file_size = data
-            await writer.drain()
-            async for chunk in gen:
-                writer.write(chunk)
-                await writer.drain()
-                print(chunk)
+            source, file_size = data
+            sent = await self.stream_file(writer, source, sizer, throttle)
             writer.write(b'\x04')
             await writer.drain()
         except StopIteration:
@@ -236,6 +594,7 @@ class SimpleProto(BaseProtocol):
         except ConnectionError:
             print(f'[x] client suddenly closed, can not send')
         print(f'...>> {data} to: {addr}')
+        return sent
 
     # CLIENT SIDE
     def send_request(self, csock: socket.socket, request: str):
@@ -0,0 +1,153 @@
+import os
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Set, Tuple
+
+from Storage.Mutations import on_change
+from utility import trim_path
+
+
+class Resolved(NamedTuple):
+    '''
+    path asked by user resolved once for the whole command
+    path: canonical absolute path (links and '..' resolved), inside home it starts with home path as it is stored
+    text: str of path for os functions and keys of caches
+    trimmed: path shown to user ('..' + path inside home, absolute path outside of it)
+    escaped: path is inside home by its name, but links lead out of home
+    '''
+    path: Path
+    text: str
+    trimmed: str
+    escaped: bool
+
+
+def is_inside(path: str, folder: str) -> bool:
+    return path == folder or path.startswith(folder.rstrip(os.sep) + os.sep)
+
+
+def folders_of(text: str) -> List[str]:
+    '''
+    path and folders it is inside of: resolution is indexed by all of them, so it is found by any changed one
+    '''
+    path = Path(text)
+    return [str(folder) for folder in (path, *path.parents)]
+
+
+class PathResolver:
+    '''
+    Resolver of paths of one session: path is canonicalized by os.path.realpath once per command
+    instead of building Path of argument again and again. Recent resolutions are memoized,
+    they are dropped when user jumps (see users.User.current_path)
+    and when server changes resolved path or folder on the way to it (see Storage.Mutations).
+    Resolutions are indexed by folders they are inside of, here and in watchers of all sessions,
+    so change of path touches only resolutions inside it
+    '''
+    ENTRIES = 256  # memoized resolutions of session
+
+    def __init__(self, home_path: str):
+        self.home = os.path.abspath(home_path)
+        self.real_home = os.path.realpath(self.home)
+        self.__resolved: OrderedDict[Tuple[str, str], Resolved] = OrderedDict()
+        self.__inside: Dict[str, Set[Tuple[str, str]]] = dict()  # folder -> keys of resolutions inside it
+        weakref.finalize(self, release, self.__inside)
+
+    def resolve(self, path: str, current_path: str) -> Resolved:
+        '''
+        path is absolute or relative to current path
+        '''
+        key = (current_path, path)
+        resolved = self.__resolved.get(key)
+        if resolved is not None:
+            self.__resolved.move_to_end(key)
+            return resolved
+        resolved = self.__resolved[key] = self.__resolve(os.path.join(current_path, path))
+        for folder in folders_of(resolved.text):
+            keys = self.__inside.get(folder)
+            if keys is None:
+                keys = self.__inside[folder] = set()
+                watchers.setdefault(folder, weakref.WeakSet()).add(self)
+            keys.add(key)
+        while len(self.__resolved) > self.ENTRIES:
+            self.__drop(next(iter(self.__resolved)))
+        return resolved
+
+    def resolve_folder(self, _to: str | None, current_path: str) -> Resolved:
+        '''
+        folder to save data sent by user: "> home" (or nothing), "> here" or "> path to folder"
+        '''
+        if _to is None or _to == 'home':
+            return self.resolve(self.home, current_path)
+        return self.resolve('' if _to == 'here' else _to, current_path)
+
+    def resolve_save(self, _from: str, _to: str | None, current_path: str) -> Resolved:
+        '''
+        path to save file sent by user: name of sent file in folder of resolve_folder
+        '''
+        folder = self.resolve_folder(_to, current_path)
+        return self.resolve(os.path.join(folder.text, Path(_from).name), current_path)
+
+    def trim(self, path: str | Path) -> str:
+        path = str(path)
+        return trim_path(path, self.home) if is_inside(path, self.home) else path
+
+    def __resolve(self, joined: str) -> Resolved:
+        real = os.path.realpath(joined)
+        if is_inside(real, self.real_home):
+            text = self.home + real[len(self.real_home):]  # the same path as stored paths of user
+        else:
+            text = real
+        escaped = not is_inside(text, self.home) and is_inside(os.path.normpath(joined), self.home)
+        return Resolved(Path(text), text, self.trim(text), escaped)
+
+    def __drop(self, key: Tuple[str, str]):
+        resolved = self.__resolved.pop(key)
+        for folder in folders_of(resolved.text):
+            keys = self.__inside[folder]
+            keys.discard(key)
+            if not keys:
+                del self.__inside[folder]
+                unwatch(folder, self)
+
+    def clear(self):
+        for folder in self.__inside:
+            unwatch(folder, self)
+        self.__inside.clear()
+        self.__resolved.clear()
+
+    def forget(self, path: str, tree: bool):
+        '''
+        drop resolutions of changed path and of paths inside it (resolution goes through it)
+        '''
+        for key in list(self.__inside.get(path, ())):
+            self.__drop(key)
+
+
+# folder -> resolvers of active sessions which have resolutions inside it
+watchers: Dict[str, weakref.WeakSet[PathResolver]] = dict()
+
+
+def unwatch(folder: str, resolver: PathResolver | None = None):
+    resolvers = watchers.get(folder)
+    if resolvers is not None:
+        if resolver is not None:
+            resolvers.discard(resolver)
+        if not resolvers:
+            del watchers[folder]
+
+
+def release(inside: Dict[str, Set[Tuple[str, str]]]):
+    '''
+    resolver of ended session is gone: folders watched only by it are not kept
+    '''
+    for folder in inside:
+        unwatch(folder)
+
+
+@on_change
+def forget(path: Path, tree: bool):
+    '''
+    listener of Storage.Mutations
+    '''
+    for resolver in list(watchers.get(str(path), ())):
+        resolver.forget(str(path), tree)
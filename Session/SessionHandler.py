@@ -1,8 +1,10 @@
 import asyncio
 from typing import Dict, NamedTuple, Tuple
 
+from Storage.Quotas import quotas
 from UserDataHandle.BaseSaveLoader import BaseSaveLoader, UserData
-from users import User, SuperUser
+from users import Account, User, SuperUser
+from utility import is_valid_uid
 
 
 class URW(NamedTuple):
@@ -21,6 +23,8 @@ class UsersSessionHandler:
                                                        user path in folder 'storage/user id'
                                                        return instance of class User with parameters from json file
         <function '__add_user_to_session'> - adds user to  dict  __active_users = Dict[addr, User object]
+    Connections are indexed by uid too (<function 'sessions_of'>): connections of one user share
+    its state (users.Account), user data is loaded by the first connection only
 
     <function '__UserDataHandler.save_user_data'> - if session is closed - delete user from __active_users and save user data
                                                     to json file
@@ -30,6 +34,8 @@ class UsersSessionHandler:
         if super_users is None:
             super_users = set()
         self.__active_sessions: Dict[Tuple[str], User] = dict()
+        self.__sessions_of: Dict[str, Dict[Tuple[str], User]] = dict()  # uid -> connections of user
+        self.__accounts: Dict[str, Account] = dict()  # uid -> state shared by connections of user
         self.__UserDataHandler = UserDataHandler
         self.__super_users = super_users
 
@@ -52,52 +58,101 @@ class UsersSessionHandler:
         '''
         return self.__active_sessions[addr]
 
+    def sessions_of(self, uid: str) -> Dict[Tuple[str], User]:
+        '''
+        connections of user by their addresses
+        '''
+        return self.__sessions_of.get(uid, {})
+
+    def account(self, uid: str) -> Account | None:
+        '''
+        state of connected user
+        '''
+        return self.__accounts.get(uid)
+
+    def user_data(self, uid: str) -> UserData | None:
+        '''
+        data of connected user to be saved
+        '''
+        account = self.__accounts.get(uid)
+        if account is None:
+            return None
+        usage = quotas.usage(uid)
+        return UserData(uid, account.current_path, account.permissions, account.home_path, usage.quota, usage.used)
+
+    def kick(self, uid: str, addr: Tuple = None) -> int:
+        '''
+        close connections of user (only one of them if addr - (ip, port)), sessions are ended by their handlers
+
+        Returns: amount of closed connections
+        '''
+        sessions = self.sessions_of(uid)
+        kicked = [user for user_addr, user in sessions.items() if addr is None or user_addr[:2] == addr]
+        for user in kicked:
+            user.sock.writer.close()
+        return len(kicked)
+
     async def check_user(self, reader, writer, uid: str):
         '''
         Read Class doc
+        Raises: ValueError if uid is not valid name of home folder (hidden name or path, see utility.is_valid_uid)
         '''
+        if not is_valid_uid(uid):
+            raise ValueError(f'wrong user id "{uid}"')
         addr = writer.get_extra_info("peername")
         if addr not in self.__active_sessions:
-            if await self.__UserDataHandler.is_new_user(uid):
-                udata = await self.__UserDataHandler.create_user(uid)
-            else:
-                udata = await self.__UserDataHandler.load_user(uid)
-            self.__add_user_to_session(addr, reader, writer, udata)
-
-    def __add_user_to_session(self, addr: Tuple, reader, writer, udata: UserData):
+            account = self.__accounts.get(uid)
+            if account is None:  # the first connection of user
+                if await self.__UserDataHandler.is_new_user(uid):
+                    udata = await self.__UserDataHandler.create_user(uid)
+                else:
+                    udata = await self.__UserDataHandler.load_user(uid)
+                quotas.track(udata)
+                account = self.__accounts.setdefault(uid, Account(udata.uid, udata.current_path, udata.permissions,
+                                                                  udata.home_path))
+            self.__add_user_to_session(addr, reader, writer, account)
+
+    def __add_user_to_session(self, addr: Tuple, reader, writer, account: Account):
         '''
-        Add User or SuperUser object (depends on uid) to session
+        Add User or SuperUser object (depends on uid) to session and to connections of user
         '''
-        if udata.uid in self.__super_users:
+        if account.uid in self.__super_users:
             user = SuperUser(DataHandler=self.__UserDataHandler,
                              SessionHandler=self,
-                             permissions=udata.permissions,
-                             uid=udata.uid,
-                             current_path=udata.current_path,
-                             home_path=udata.home_path,
+                             permissions=account.permissions,
+                             uid=account.uid,
+                             current_path=account.current_path,
+                             home_path=account.home_path,
                              sock=URW(reader=reader, writer=writer),
-                             addr=addr)
+                             addr=addr,
+                             account=account)
         else:
-            user = User(uid=udata.uid,
-                        permissions=udata.permissions,
-                        current_path=udata.current_path,
-                        home_path=udata.home_path,
+            user = User(uid=account.uid,
+                        permissions=account.permissions,
+                        current_path=account.current_path,
+                        home_path=account.home_path,
                         sock=URW(reader=reader, writer=writer),
-                        addr=addr)
+                        addr=addr,
+                        account=account)
 
         self.__active_sessions[addr] = user
+        self.__sessions_of.setdefault(account.uid, dict())[addr] = user
 
     async def end_user_session(self, addr: Tuple):
         '''
         In the end of session:
         - save user data
-        - delete user from session
+        - delete user from session, state of user is dropped with the last connection
         '''
         user = self.__active_sessions[addr]
-        udata = UserData(user.uid, user.current_path, user.permissions, user.home_path)
-        await self.__UserDataHandler.save_user_data(udata)
+        await self.__UserDataHandler.save_user_data(self.user_data(user.uid))
         user.sock.writer.close()
         self.__active_sessions.pop(addr)
+        sessions = self.__sessions_of.get(user.uid, {})
+        sessions.pop(addr, None)
+        if not sessions:
+            self.__sessions_of.pop(user.uid, None)
+            self.__accounts.pop(user.uid, None)
 
     def __str__(self):
         sessions = 'Active users:\n'
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    '''
+    Content addressed storage of uploaded files ([storage] section of config.toml, dedup = true).
+    Every uploaded file is stored once as blob ".blobs/ab/abcdef..." named by its sha256,
+    folder of blobs is next to storage folder (hard links need the same file system), never inside it:
+    names in storage are homes of users.
+    files in user homes are hard links to blobs, so all commands work with them as with usual files.
+    Amount of links of blob is its reference count: 'defi' removes link and decrements it,
+    blobs without links to them are removed by garbage collector.
+    Links are never written through: file is unlinked (detach) before it is overwritten
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.root = Path('.blobs')
+        self.gc_interval = 3600  # seconds between garbage collections, 0 - only by 'gc' command
+
+    def configure(self, config: Dict[str, Any], storage: str):
+        self.enabled = config.get('dedup', False)
+        self.root = Path(config.get('blobs', '.blobs'))
+        self.gc_interval = config.get('gc_interval', self.gc_interval)
+        if self.root.resolve().is_relative_to(Path(storage).resolve()):
+            raise ValueError(f'folder of blobs "{self.root}" must not be inside storage folder "{storage}"')
+        legacy = Path(storage, '.blobs')  # blobs were inside storage before
+        if self.enabled and not self.root.exists() and legacy.is_dir():
+            legacy.rename(self.root)
+        if self.enabled:
+            self.root.mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest: str) -> Path:
+        return Path(self.root, digest[:2], digest)
+
+    @staticmethod
+    def __replace_with_link(blob: Path, path: Path):
+        tmp = Path(path.parent, f'.{path.name}.{uuid.uuid4().hex}.link')
+        os.link(blob, tmp)
+        os.replace(tmp, path)
+
+    def __store(self, path: Path, digest: str | None) -> bool:
+        if path.suffix in ('.part', '.ppart'):  # parts are appended, they must stay usual files
+            return False
+        digest = digest or file_digest(path)
+        blob = self.blob_path(digest)
+        try:
+            if blob.stat().st_size == path.stat().st_size:
+                self.__replace_with_link(blob, path)
+                return True
+        except FileNotFoundError:  # no such blob yet or it was just collected
+            pass
+        blob.parent.mkdir(exist_ok=True)
+        try:
+            os.link(path, blob)
+        except FileExistsError:  # the same file was stored by other upload meanwhile
+            self.__replace_with_link(blob, path)
+            return True
+        return False
+
+    async def store(self, path: Path, digest: str = None) -> bool:
+        '''
+        store uploaded file in blob store (in thread), digest is calculated if it was not counted while receiving
+        Returns: True if the same file was already stored and path became link to it
+        '''
+        if not self.enabled:
+            return False
+        return await asyncio.to_thread(self.__store, Path(path), digest)
+
+    def size(self, digest: str) -> int | None:
+        '''
+        size of stored file with digest or None if there is no such blob
+        '''
+        if not self.enabled or len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            return None
+        try:
+            return self.blob_path(digest).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def link(self, digest: str, path: Path) -> int | None:
+        '''
+        put link to stored file with digest at path instead of receiving it
+        Returns: size of file or None if there is no such blob
+        '''
+        if self.size(digest) is None:
+            return None
+        blob = self.blob_path(digest)
+        try:
+            self.__replace_with_link(blob, Path(path))
+            return blob.stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def detach(self, path: Path):
+        '''
+        remove link before file is overwritten, so blob and other links keep their data.
+        Links stay after dedup is switched off, so it is done whether store is enabled or not
+        '''
+        try:
+            if os.stat(path).st_nlink > 1:
+                Path(path).unlink()
+        except FileNotFoundError:
+            pass
+
+    def __collect(self) -> Tuple[int, int]:
+        removed = freed = 0
+        for folder in self.root.iterdir():
+            if not folder.is_dir():
+                continue
+            for blob in folder.iterdir():
+                stat = blob.stat()
+                if stat.st_nlink == 1:  # only blob store refers to it
+                    blob.unlink()
+                    removed += 1
+                    freed += stat.st_size
+        return removed, freed
+
+    async def collect(self) -> Tuple[int, int]:
+        '''
+        remove blobs without links to them (in thread)
+        Returns: amount of removed blobs and freed bytes
+        '''
+        if not self.enabled:
+            return 0, 0
+        return await asyncio.to_thread(self.__collect)
+
+    async def run_gc(self):
+        '''
+        collect garbage every gc_interval seconds
+        '''
+        while self.enabled and self.gc_interval:
+            await asyncio.sleep(self.gc_interval)
+            await self.collect()
+
+
+blobs = BlobStore()
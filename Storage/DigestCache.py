@@ -0,0 +1,173 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+ALGORITHMS = ('sha256', 'blake2b')
+
+
+def digest_file(path: Path, algorithm: str, offset: int = 0, count: int = None, chunk_size: int = 1 << 20) -> str:
+    '''
+    digest of count bytes of file from offset (of the whole file by default)
+    '''
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        left = count
+        while left is None or left > 0:
+            chunk = f.read(chunk_size if left is None else min(chunk_size, left))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if left is not None:
+                left -= len(chunk)
+    return digest.hexdigest()
+
+
+class DigestCache:
+    '''
+    Digests of files by path, kept in sidecar "<storage>/.digests.json".
+    Digest is valid while (size, mtime, inode) of file are the same as when it was counted,
+    so changed or replaced file is hashed again. Index is written to disk a second after last change
+    by its own thread, entries of deleted and changed files are dropped then.
+    Entries are replaced, never changed, so copy of index can be written while loop changes index.
+    Paths are indexed by their sha256 too (see holders)
+    '''
+
+    def __init__(self):
+        self.path: Path | None = None  # in memory only until configured
+        self.save_delay = 1
+        self.__index: Dict[str, Dict[str, Any]] = dict()
+        self.__holders: Dict[str, Set[str]] = dict()  # sha256 -> paths
+        self.__save_handle: asyncio.TimerHandle | None = None
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='digests')
+        self.__writing = threading.Lock()  # save at stop and write of thread use the same temporary file
+
+    def configure(self, config: Dict[str, Any], storage: str):
+        self.path = Path(storage, config.get('digest_cache', '.digests.json'))
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                index = json.load(f)
+            self.__index = {path: entry for path, entry in index.items() if entry['stat'] == self.__stat(path)}
+            for path, entry in self.__index.items():
+                if 'sha256' in entry:
+                    self.__holders.setdefault(entry['sha256'], set()).add(path)
+
+    @staticmethod
+    def __stat(path: str | Path) -> List[int] | None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def get(self, path: str | Path, algorithm: str) -> str | None:
+        entry = self.__index.get(str(path))
+        if entry is None:
+            return None
+        if entry['stat'] != self.__stat(path):
+            self.__drop(str(path))
+            self.__schedule_save()
+            return None
+        return entry.get(algorithm)
+
+    def __drop(self, path: str):
+        entry = self.__index.pop(path)
+        holders = self.__holders.get(entry.get('sha256'))
+        if holders is not None:
+            holders.discard(path)
+            if not holders:
+                del self.__holders[entry['sha256']]
+
+    def holders(self, sha256: str) -> List[str]:
+        '''
+        paths of files with this sha256 (counted by server, file was not changed since)
+        '''
+        return [path for path in list(self.__holders.get(sha256, ())) if self.get(path, 'sha256') == sha256]
+
+    def put(self, path: str | Path, algorithm: str, digest: str, stat: List[int] = None):
+        '''
+        stat: (size, mtime, inode) of file when digest was counted, digest is dropped if file was changed since
+        '''
+        current = self.__stat(path)
+        if current is None or (stat is not None and stat != current):
+            return
+        entry = self.__index.get(str(path))
+        if entry is not None and entry['stat'] != current:
+            self.__drop(str(path))
+            entry = None
+        self.__index[str(path)] = {**(entry or {'stat': current}), algorithm: digest}
+        if algorithm == 'sha256':
+            self.__holders.setdefault(digest, set()).add(str(path))
+        self.__schedule_save()
+
+    async def digest(self, path: str | Path, algorithm: str = 'sha256') -> str:
+        '''
+        cached digest of file or count it in thread and cache it
+        '''
+        digest = self.get(path, algorithm)
+        if digest is None:
+            stat = self.__stat(path)
+            digest = await asyncio.to_thread(digest_file, path, algorithm)
+            self.put(path, algorithm, digest, stat)
+        return digest
+
+    async def region_digest(self, path: str | Path, algorithm: str, offset: int, count: int) -> str:
+        '''
+        digest of count bytes from offset, the whole file digest is cached
+        '''
+        if offset == 0 and count == os.stat(path).st_size:
+            return await self.digest(path, algorithm)
+        return await asyncio.to_thread(digest_file, path, algorithm, offset, count)
+
+    def __schedule_save(self):
+        if self.path is None or self.__save_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.save()
+        self.__save_handle = loop.call_later(self.save_delay, self.__save_later)
+
+    def __save_later(self):
+        self.__save_handle = None
+        written = asyncio.get_running_loop().run_in_executor(self.__executor, self.__write, dict(self.__index))
+        written.add_done_callback(self.__forget)
+
+    def __forget(self, written: asyncio.Future):
+        '''
+        drop entries of deleted and changed files found by write, unless they were put again meanwhile
+        '''
+        if written.exception() is not None:
+            print(f'[x] digests were not saved: {written.exception()}')
+            return
+        for path, entry in written.result():
+            if self.__index.get(path) is entry:
+                self.__drop(path)
+
+    def __write(self, index: Dict[str, Dict[str, Any]]) -> List[Tuple[str, Dict[str, Any]]]:
+        '''
+        write index without entries of deleted and changed files (in thread)
+        Returns: dropped entries
+        '''
+        dropped = [(path, entry) for path, entry in index.items() if entry['stat'] != self.__stat(path)]
+        for path, _ in dropped:
+            del index[path]
+        data = json.dumps(index)
+        with self.__writing:
+            tmp = Path(f'{self.path}.tmp')
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        return dropped
+
+    def save(self):
+        if self.path is not None:
+            self.__write(dict(self.__index))
+
+
+digests = DigestCache()
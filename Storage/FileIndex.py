@@ -0,0 +1,233 @@
+import asyncio
+import functools
+import itertools
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from stat import S_ISDIR
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
+
+from Storage.Mutations import on_change
+from utility import parse_size
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER,
+    mtime REAL NOT NULL,
+    generation INTEGER NOT NULL  -- scan which saw entry, older entries of scanned folder are removed
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+'''
+
+
+class Found(NamedTuple):
+    path: str
+    is_dir: bool
+    size: int | None
+    mtime: float
+
+
+def subtree(path: str) -> Tuple[str, str]:
+    '''
+    bounds of paths inside folder for range query on primary key
+    '''
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+class FileIndex:
+    '''
+    Index of all files of storage for 'find' ([index] section of config.toml) in SQLite database
+    "<storage>/.index.sqlite". It is built by scan of storage in background when server starts,
+    updated by commands which change files (see Storage.Mutations) and reconciled by scan
+    every reconcile_interval seconds to see changes made past server.
+    Database is used by one thread only, scans are done by batches, so queries are not blocked by them
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.root = os.path.abspath('storage')
+        self.path = Path('storage', '.index.sqlite')
+        self.reconcile_interval = 3600  # seconds between scans, 0 - only at start
+        self.batch = 1000  # entries written by one transaction of scan
+        self.ready = False  # the first scan is finished
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-index')
+        self.__db: sqlite3.Connection | None = None
+        self.__generation = 0
+
+    def configure(self, config: Dict[str, Any], storage: str):
+        self.enabled = config.get('enabled', False)
+        self.root = os.path.abspath(storage)
+        self.path = Path(storage, config.get('database', '.index.sqlite'))
+        self.reconcile_interval = config.get('reconcile_interval', self.reconcile_interval)
+        self.batch = config.get('batch', self.batch)
+
+    async def __run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(func, *args))
+
+    # index thread
+    def __connect(self) -> sqlite3.Connection:
+        if self.__db is None:
+            self.__db = sqlite3.connect(self.path)
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.executescript(SCHEMA)
+            self.__generation = self.__db.execute('SELECT max(generation) FROM files').fetchone()[0] or 0
+        return self.__db
+
+    def __skipped(self, folder: str, name: str) -> bool:
+        return folder == self.root and name.startswith('.')  # blob store, caches and index itself
+
+    def __entries(self, top: str, generation: int) -> Iterator[Tuple]:
+        '''
+        rows of everything inside top folder (links are not followed)
+        '''
+        folders = [top]
+        while folders:
+            folder = folders.pop()
+            try:
+                it = os.scandir(folder)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    if self.__skipped(folder, entry.name):
+                        continue
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    yield entry.path, entry.name, is_dir, None if is_dir else stat.st_size, stat.st_mtime, generation
+                    if is_dir:
+                        folders.append(entry.path)
+
+    def __next_generation(self) -> int:
+        self.__connect()
+        self.__generation += 1
+        return self.__generation
+
+    def __write_batch(self, entries: Iterator[Tuple]) -> int:
+        batch = list(itertools.islice(entries, self.batch))
+        db = self.__connect()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', batch)
+        return len(batch)
+
+    def __remove_stale(self, top: str, generation: int):
+        db = self.__connect()
+        with db:
+            db.execute('DELETE FROM files WHERE path >= ? AND path < ? AND generation < ?',
+                       (*subtree(top), generation))
+
+    def __update(self, path: str) -> bool:
+        '''
+        Returns: True if path is folder
+        '''
+        db = self.__connect()
+        with db:
+            try:
+                stat = os.stat(path, follow_symlinks=False)
+            except OSError:
+                db.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)', (path, *subtree(path)))
+                return False
+            is_dir = S_ISDIR(stat.st_mode)
+            db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                       (path, os.path.basename(path), is_dir, None if is_dir else stat.st_size, stat.st_mtime,
+                        self.__generation))
+        return is_dir
+
+    def __find(self, top: str, pattern: str | None, min_size: int | None, max_size: int | None,
+               after: float | None, before: float | None, limit: int) -> List[Found]:
+        query, args = 'SELECT path, is_dir, size, mtime FROM files WHERE path >= ? AND path < ?', list(subtree(top))
+        for condition, value in (('name GLOB ?', pattern), ('size >= ?', min_size), ('size <= ?', max_size),
+                                 ('mtime >= ?', after), ('mtime <= ?', before)):
+            if value is not None:
+                query += f' AND {condition}'
+                args.append(value)
+        rows = self.__connect().execute(query + ' ORDER BY path LIMIT ?', (*args, limit)).fetchall()
+        return [Found(path, bool(is_dir), size, mtime) for path, is_dir, size, mtime in rows]
+
+    def __close(self):
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    # event loop
+    async def reconcile(self, top: str = None):
+        '''
+        scan folder (the whole storage by default): add and update entries, remove entries which are not found
+        '''
+        top = top or self.root
+        generation = await self.__run(self.__next_generation)
+        entries = self.__entries(top, generation)
+        while await self.__run(self.__write_batch, entries):
+            pass
+        await self.__run(self.__remove_stale, top, generation)
+
+    async def update(self, path: str, tree: bool = False):
+        if await self.__run(self.__update, path) and tree:
+            await self.reconcile(path)
+
+    def changed(self, path: Path, tree: bool):
+        '''
+        listener of Storage.Mutations
+        '''
+        if not self.enabled:
+            return
+        task = asyncio.ensure_future(self.update(os.path.abspath(path), tree))
+        task.add_done_callback(self.__report)
+
+    @staticmethod
+    def __report(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f'[x] file index was not updated: {task.exception()}')
+
+    async def find(self, top: str, pattern: str = None, min_size: int = None, max_size: int = None,
+                   after: float = None, before: float = None, limit: int = 100) -> List[Found]:
+        '''
+        entries inside top folder: name matches glob pattern, size and mtime are in bounds, ordered by path
+        '''
+        return await self.__run(self.__find, os.path.abspath(top), pattern, min_size, max_size, after, before, limit)
+
+    async def run(self):
+        '''
+        build index and reconcile it every reconcile_interval seconds
+        '''
+        while self.enabled:
+            try:
+                await self.reconcile()
+            except (sqlite3.Error, OSError) as E:
+                print(f'[x] scan of storage for file index failed: {E}')
+            self.ready = True
+            if not self.reconcile_interval:
+                break
+            await asyncio.sleep(self.reconcile_interval)
+
+    def close(self):
+        self.__executor.submit(self.__close).result()
+
+
+index = FileIndex()
+on_change(index.changed)
+
+
+def size_bounds(value: str) -> Tuple[int | None, int | None]:
+    '''
+    '+1M' - not smaller than 1 MiB, '-10K' - not larger than 10 KiB, '100' - exactly 100 bytes
+    '''
+    sign, number = (value[0], value[1:]) if value[:1] in ('+', '-') else ('', value)
+    size = parse_size(number)
+    return (size if sign != '-' else None), (size if sign != '+' else None)
+
+
+def mtime_bounds(value: str, now: float) -> Tuple[float | None, float | None]:
+    '''
+    '-7' - changed within 7 days, '+30' - changed earlier than 30 days ago
+    '''
+    sign, days = (value[0], value[1:]) if value[:1] in ('+', '-') else ('-', value)
+    moment = now - float(days) * 86400
+    return (moment, None) if sign == '-' else (None, moment)
@@ -0,0 +1,139 @@
+import base64
+import fnmatch
+import heapq
+import itertools
+import json
+import os
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
+
+SORT_KEYS = ('name', 'size', 'mtime', 'none')
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+# types of position in cursor by sorting: sort key of the last entry of page (see sort_key), offset without sorting
+CURSOR_TYPES = {'name': (bool, str), 'size': (int, str), 'mtime': ((int, float), str), 'none': (int,)}
+
+
+class ListEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int | None = None
+    mtime: float | None = None
+
+
+class ListPage(NamedTuple):
+    entries: List[ListEntry]
+    next_cursor: str | None  # cursor of the next page or None if it is the last one
+
+
+def scan_entries(path: str, pattern: str = None, with_stat: bool = False) -> Iterator[ListEntry]:
+    '''
+    entries of folder by os.scandir: type is taken from directory entry,
+    size and mtime from stat cached in DirEntry (only if with_stat)
+    '''
+    with os.scandir(path) as it:
+        for entry in it:
+            if pattern is not None and not fnmatch.fnmatch(entry.name, pattern):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                if with_stat:
+                    stat = entry.stat()
+                    yield ListEntry(entry.name, is_dir, None if is_dir else stat.st_size, stat.st_mtime)
+                else:
+                    yield ListEntry(entry.name, is_dir)
+            except OSError:  # removed while folder was read
+                continue
+
+
+def sort_key(sort: str) -> Callable[[ListEntry], Tuple]:
+    if sort == 'size':
+        return lambda entry: (entry.size or 0, entry.name)
+    if sort == 'mtime':
+        return lambda entry: (entry.mtime, entry.name)
+    return lambda entry: (not entry.is_dir, entry.name)  # folders first as before
+
+
+def make_cursor(sort: str, position: Tuple) -> str:
+    '''
+    cursor given to user: sorting and position of the last entry of page, base64 so it is one word of command
+    '''
+    return base64.urlsafe_b64encode(json.dumps([sort, *position], separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def read_cursor(cursor: str, sort: str) -> Tuple:
+    '''
+    position from cursor of page, ValueError if cursor is broken or was given for other sorting
+    '''
+    try:
+        cursor_sort, *position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError(f'wrong cursor {cursor}')
+    if cursor_sort != sort:
+        raise ValueError(f'cursor is given for sorting by {cursor_sort}')
+    types = CURSOR_TYPES[sort]
+    if len(position) != len(types) or not all(isinstance(value, kind) for value, kind in zip(position, types)):
+        raise ValueError(f'wrong cursor {cursor}')
+    return tuple(position)
+
+
+def list_page(path: str, cursor: str = None, limit: int = DEFAULT_LIMIT, sort: str = 'name', reverse: bool = False,
+              pattern: str = None, with_stat: bool = False) -> ListPage:
+    '''
+    one page of folder: limit entries after cursor (see make_cursor).
+    Without sorting entries go in order of directory (cursor is amount of entries of previous pages)
+    and scan stops at the end of page, with sorting cursor is sort key of the last entry of previous page:
+    entries up to it are skipped and only limit + 1 entries are kept (heap),
+    so memory does not depend on size of folder or number of page
+    '''
+    entries = scan_entries(path, pattern, with_stat or sort in ('size', 'mtime'))
+    if sort == 'none':
+        offset, = read_cursor(cursor, sort) if cursor else (0,)
+        if offset < 0:
+            raise ValueError(f'wrong cursor {cursor}')
+        page = list(itertools.islice(entries, offset, offset + limit + 1))
+        position = (offset + limit,)
+    else:
+        key = sort_key(sort)
+        if cursor:
+            last = read_cursor(cursor, sort)
+            if reverse:
+                entries = (entry for entry in entries if key(entry) < last)
+            else:
+                entries = (entry for entry in entries if key(entry) > last)
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        page = select(limit + 1, entries, key=key)
+        position = key(page[limit - 1]) if len(page) > limit else None
+    has_more = len(page) > limit
+    return ListPage(page[:limit], make_cursor(sort, position) if has_more else None)
+
+
+def format_page(page: ListPage, trimmed_path: str, with_stat: bool = False) -> str:
+    '''
+    text of page as 'list' showed it before, with size and mtime columns if with_stat
+    '''
+    lines = [f'[>] {trimmed_path} ']
+    for entry in page.entries:
+        columns = ''
+        if with_stat:
+            size = '' if entry.size is None else entry.size
+            columns = f'{size:>12} {time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.mtime))} '
+        lines.append(f'{"folder>" if entry.is_dir else ">      "} .. {columns}{entry.name}')
+    if not page.entries:
+        lines.append('...')
+    if page.next_cursor is not None:
+        lines.append(f'[i] more entries, next page: -c {page.next_cursor}')
+    return '\n'.join(lines)
+
+
+def page_json(page: ListPage, trimmed_path: str) -> str:
+    '''
+    machine readable page: {"path": .., "entries": [{"name", "type", "size", "mtime"}], "next": cursor or null}
+    '''
+    entries: List[Dict] = list()
+    for entry in page.entries:
+        item = {'name': entry.name, 'type': 'folder' if entry.is_dir else 'file'}
+        if entry.mtime is not None:
+            item.update(size=entry.size, mtime=entry.mtime)
+        entries.append(item)
+    return json.dumps({'path': trimmed_path, 'entries': entries, 'next': page.next_cursor})
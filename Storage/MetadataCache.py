@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from stat import S_ISDIR
+from typing import Any, Dict, Set, Tuple
+
+from Metrics.MetricsCollector import metrics
+from Storage.Listing import ListPage, list_page
+from Storage.Mutations import on_change
+
+
+class MetadataCache:
+    '''
+    LRU caches of stat results (info, jump) and pages of list ([cache] section of config.toml).
+    Page is valid while mtime of its folder is the same (entry added, removed or renamed changes it),
+    stat of path is trusted for stat_ttl seconds. Both are dropped at once when server changes path itself
+    (see Storage.Mutations), so only changes made past server are seen with delay:
+    sizes of files in page and stat results up to stat_ttl
+    '''
+
+    def __init__(self):
+        self.enabled = True
+        self.stat_entries = 65536
+        self.listings = 256
+        self.stat_ttl = 1.
+        self.__stats: OrderedDict[str, Tuple[float, os.stat_result]] = OrderedDict()
+        self.__pages: OrderedDict[Tuple, Tuple[int, ListPage]] = OrderedDict()
+        self.__pages_of: Dict[str, Set[Tuple]] = dict()  # folder -> keys of its pages
+
+    def configure(self, config: Dict[str, Any]):
+        for key, value in config.items():
+            if not hasattr(self, key):
+                raise KeyError(f'unknown cache setting "{key}"')
+            setattr(self, key, value)
+        self.clear()
+
+    def clear(self):
+        self.__stats.clear()
+        self.__pages.clear()
+        self.__pages_of.clear()
+
+    def stat(self, path: str | Path) -> os.stat_result:
+        '''
+        cached os.stat, raises OSError as os.stat does
+        '''
+        key = str(path)
+        cached = self.__stats.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.stat_ttl:
+            self.__stats.move_to_end(key)
+            metrics.cache_hits += 1
+            return cached[1]
+        metrics.cache_misses += 1
+        result = os.stat(path)
+        if self.enabled:
+            self.__stats[key] = (time.monotonic(), result)
+            self.__stats.move_to_end(key)
+            while len(self.__stats) > self.stat_entries:
+                self.__stats.popitem(last=False)
+        return result
+
+    def is_dir(self, path: str | Path) -> bool:
+        try:
+            return S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    async def list_page(self, path: str, *args) -> ListPage:
+        '''
+        cached Storage.Listing.list_page, folder is read in thread on miss
+        '''
+        mtime = os.stat(path).st_mtime_ns
+        key = (path, *args)
+        cached = self.__pages.get(key)
+        if cached is not None and cached[0] == mtime:
+            self.__pages.move_to_end(key)
+            metrics.cache_hits += 1
+            return cached[1]
+        metrics.cache_misses += 1
+        page = await asyncio.to_thread(list_page, path, *args)
+        if self.enabled and os.stat(path).st_mtime_ns == mtime:  # folder was not changed while it was read
+            self.__pages[key] = (mtime, page)
+            self.__pages.move_to_end(key)
+            self.__pages_of.setdefault(path, set()).add(key)
+            while len(self.__pages) > self.listings:
+                self.__drop_page(next(iter(self.__pages)))
+        return page
+
+    def __drop_page(self, key: Tuple):
+        self.__pages.pop(key, None)
+        keys = self.__pages_of.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.__pages_of[key[0]]
+
+    def __drop_pages_of(self, folder: str):
+        for key in list(self.__pages_of.get(folder, ())):
+            self.__drop_page(key)
+
+    def invalidate(self, path: Path, tree: bool = False):
+        '''
+        path was created, changed or removed: drop its stat, stat and pages of its folder
+        and everything inside it if tree
+        '''
+        for folder in (str(path), str(path.parent)):
+            self.__stats.pop(folder, None)
+            self.__drop_pages_of(folder)
+        if tree:
+            prefix = os.path.join(str(path), '')
+            for key in [key for key in self.__stats if key.startswith(prefix)]:
+                del self.__stats[key]
+            for folder in [folder for folder in self.__pages_of if folder.startswith(prefix)]:
+                self.__drop_pages_of(folder)
+
+
+metadata = MetadataCache()
+on_change(metadata.invalidate)
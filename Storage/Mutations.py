@@ -0,0 +1,18 @@
+from pathlib import Path
+from typing import Callable, List
+
+# commands which change files notify listeners (caches and indexes of storage) about changed paths.
+# listener(path, tree): tree is True if everything inside path could be changed (folder removed or extracted)
+Listener = Callable[[Path, bool], None]
+listeners: List[Listener] = list()
+
+
+def on_change(listener: Listener) -> Listener:
+    listeners.append(listener)
+    return listener
+
+
+def changed(*paths: str | Path, tree: bool = False):
+    for path in paths:
+        for listener in listeners:
+            listener(Path(path), tree)
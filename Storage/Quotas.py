@@ -0,0 +1,221 @@
+import asyncio
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator
+
+from UserDataHandle.BaseSaveLoader import UserData
+from utility import format_size
+
+
+@dataclass
+class Usage:
+    home: Path
+    quota: int | None  # bytes, 0 - unlimited, None - default quota of server
+    used: int | None  # bytes in files of home, None - not counted yet
+    reserved: int = 0  # bytes taken by uploads in progress and not charged yet (see QuotaTracker.reserved)
+    drift: int | None = None  # charges made while home is walked by reconcile, None - it is not walked now
+
+
+class QuotaExceeded(Exception):
+    '''
+    upload is stopped: its data does not fit quota of owner of file
+    '''
+
+
+def folder_size(path: str | Path) -> int:
+    '''
+    size of all files inside folder (links are not followed)
+    '''
+    size = 0
+    folders = [path]
+    while folders:
+        try:
+            it = os.scandir(folders.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        size += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    return size
+
+
+class QuotaTracker:
+    '''
+    Quotas of users ([quota] section of config.toml) and space used in their homes.
+    Quota and used space are kept in UserData. Used space is changed by commands which write or delete files
+    (see tracked), so it is known without walking home, and counted again by reconciler
+    every reconcile_interval seconds and when user without counted usage is loaded.
+    Usage stays tracked after session of user is ended, other users can write to the home.
+    Uploads take space they need before it is written (see reserved), so uploads running at the same time
+    can not pass one quota together
+    '''
+
+    def __init__(self):
+        self.default = 0  # quota of users without their own one, bytes, 0 - unlimited
+        self.reconcile_interval = 3600  # seconds between recounts of used space, 0 - only for new users
+        self.__usage: Dict[str, Usage] = dict()
+        self.__homes: Dict[Path, Usage] = dict()  # home -> usage, owner is found by parents of path
+
+    def configure(self, config: Dict[str, Any]):
+        for key, value in config.items():
+            if not hasattr(self, key):
+                raise KeyError(f'unknown quota setting "{key}"')
+            setattr(self, key, value)
+
+    def track(self, udata: UserData) -> Usage:
+        '''
+        start tracking usage of loaded user, usage is counted in background if it was not saved
+        '''
+        usage = self.__usage.get(udata.uid)
+        if usage is None:
+            usage = self.__usage[udata.uid] = Usage(Path(udata.home_path), udata.quota, udata.used)
+            self.__homes[usage.home] = usage
+            if usage.used is None:
+                asyncio.ensure_future(self.reconcile(udata.uid))
+        return usage
+
+    def usage(self, uid: str) -> Usage | None:
+        return self.__usage.get(uid)
+
+    def limit(self, usage: Usage) -> int:
+        return self.default if usage.quota is None else usage.quota
+
+    def set_quota(self, uid: str, quota: int | None):
+        if uid in self.__usage:
+            self.__usage[uid].quota = quota
+
+    def owner(self, path: str | Path) -> Usage | None:
+        '''
+        usage of user which home contains path: one lookup per part of path whatever amount of users is,
+        the nearest home wins (home inside other home)
+        '''
+        path = Path(path)
+        for folder in (path, *path.parents):
+            usage = self.__homes.get(folder)
+            if usage is not None:
+                return usage
+        return None
+
+    def limited(self, path: str | Path) -> bool:
+        '''
+        is space of owner of path limited by quota
+        '''
+        usage = self.owner(path)
+        return usage is not None and bool(self.limit(usage))
+
+    def allows(self, path: str | Path, incoming: int) -> bool:
+        '''
+        can incoming bytes be written to path (with space reserved by uploads in progress)
+        '''
+        usage = self.owner(path)
+        if usage is None or usage.used is None or not self.limit(usage):
+            return True
+        return usage.used + usage.reserved + incoming <= self.limit(usage)
+
+    def report(self, path: str | Path) -> str:
+        '''
+        used space and quota of owner of path
+        '''
+        usage = self.owner(path)
+        if usage is None or usage.used is None:
+            return 'usage is not counted yet'
+        limit = self.limit(usage)
+        return f'{format_size(usage.used)} of {format_size(limit) if limit else "unlimited"} used'
+
+    def charge(self, path: str | Path, delta: int):
+        usage = self.owner(path)
+        if usage is None:
+            return
+        if usage.drift is not None:
+            usage.drift += delta
+        if usage.used is not None:
+            usage.used = max(usage.used + delta, 0)
+
+    @staticmethod
+    def size_of(*paths: str | Path) -> int:
+        size = 0
+        for path in paths:
+            try:
+                size += os.stat(path).st_size
+            except OSError:
+                pass
+        return size
+
+    @contextmanager
+    def reserved(self, path: str | Path, credit: int = 0) -> Iterator[Callable[[int], bool]]:
+        '''
+        space for upload to path taken from quota of owner while upload is in progress.
+        Yields take(amount): reserve amount more bytes, False if they do not fit quota
+        (nothing is reserved then). Check and reservation are one step of event loop, so they are not raced
+        by other uploads. credit - bytes which upload frees (size of overwritten file).
+        Reservation is dropped at exit, written data is charged by tracked
+        '''
+        usage = self.owner(path)
+        taken = 0  # bytes asked by upload, reserved are the ones above credit
+
+        def take(amount: int) -> bool:
+            nonlocal taken
+            if usage is None:
+                return True
+            added = max(taken + amount - credit, 0) - max(taken - credit, 0)
+            if usage.used is not None and self.limit(usage) and \
+                    usage.used + usage.reserved + added > self.limit(usage):
+                return False
+            taken += amount
+            usage.reserved += added
+            return True
+
+        try:
+            yield take
+        finally:
+            if usage is not None:
+                usage.reserved -= max(taken - credit, 0)
+
+    @contextmanager
+    def tracked(self, *paths: str | Path):
+        '''
+        charge owner of paths with change of their total size made inside (file and its parts)
+        '''
+        before = self.size_of(*paths)
+        try:
+            yield
+        finally:
+            self.charge(paths[0], self.size_of(*paths) - before)
+
+    async def reconcile(self, uid: str):
+        '''
+        count used space of user again (in thread).
+        Charges made while home is walked are added to counted size, so they are not lost
+        '''
+        usage = self.__usage.get(uid)
+        if usage is None or usage.drift is not None:  # it is counted already
+            return
+        usage.drift = 0
+        try:
+            size = await asyncio.to_thread(folder_size, usage.home)
+            usage.used = max(size + usage.drift, 0)
+        finally:
+            usage.drift = None
+
+    async def run(self):
+        '''
+        recount used space of all tracked users every reconcile_interval seconds
+        '''
+        while self.reconcile_interval:
+            await asyncio.sleep(self.reconcile_interval)
+            for uid in list(self.__usage):
+                try:
+                    await self.reconcile(uid)
+                except OSError as E:
+                    print(f'[x] used space of {uid} was not counted: {E}')
+
+
+quotas = QuotaTracker()
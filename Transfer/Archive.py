@@ -0,0 +1,282 @@
+import asyncio
+import io
+import os
+import shutil
+import struct
+import tarfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import AsyncGenerator, Callable, List, NamedTuple, Tuple
+
+from Metrics.MetricsCollector import metrics
+from Transfer.Bandwidth import UNLIMITED, Throttle
+from Transfer.ChunkSizer import ChunkSizer, tuning
+from Transfer.DiskWriter import IdleWatchdog
+from utility import frame_block
+
+TAR_MODES = {'none': 'w|', 'zlib': 'w|gz', 'lzma': 'w|xz'}  # stream modes of tarfile by codec
+ARCHIVE_THREADS = 8  # archives made (pull) and extracted (push) at the same time, the next ones wait for thread
+# archive thread waits for user as long as transfer lasts, so it must not take threads of default executor
+builders = ThreadPoolExecutor(max_workers=ARCHIVE_THREADS, thread_name_prefix='tar-builder')
+extractors = ThreadPoolExecutor(max_workers=ARCHIVE_THREADS, thread_name_prefix='tar-extractor')
+
+
+class ArchiveStopped(Exception):
+    '''
+    raised in archive thread when user is not reading archive anymore
+    '''
+    pass
+
+
+class BlockQueueWriter:
+    '''
+    file object for tarfile working in thread: data is cut into blocks of chunk size and put into bounded
+    asyncio.Queue of event loop, so thread waits while socket is busy and memory does not grow with archive size
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, block_size: int):
+        self.stopped = False
+        self.__loop = loop
+        self.__queue = queue
+        self.__block_size = block_size
+        self.__buffer = bytearray()
+
+    def put(self, item: bytes | Exception | None):
+        if self.stopped:
+            raise ArchiveStopped
+        asyncio.run_coroutine_threadsafe(self.__queue.put(item), self.__loop).result()
+
+    def write(self, data: bytes) -> int:
+        self.__buffer += data
+        while len(self.__buffer) >= self.__block_size:
+            self.put(frame_block(bytes(self.__buffer[:self.__block_size])))
+            del self.__buffer[:self.__block_size]
+        return len(data)
+
+    def close(self):
+        if self.__buffer:
+            self.put(frame_block(bytes(self.__buffer)))
+            self.__buffer.clear()
+        self.put(None)
+
+
+def write_tar(writer: BlockQueueWriter, path: Path, is_readable: Callable[[Path], bool], codec: str):
+    '''
+    walk the tree and add every readable entry to tar (runs in thread).
+    Folders which can not be read are not entered, symlinks are stored as links
+    '''
+    try:
+        with tarfile.open(fileobj=writer, mode=TAR_MODES[codec]) as tar:
+            for root, folders, files in os.walk(path):
+                tar.add(root, arcname=Path(root).relative_to(path.parent).as_posix(), recursive=False)
+                folders[:] = sorted(folder for folder in folders if is_readable(Path(root, folder)))
+                for name in sorted(files):
+                    file_path = Path(root, name)
+                    if is_readable(file_path):
+                        tar.add(file_path, arcname=file_path.relative_to(path.parent).as_posix(), recursive=False)
+        writer.close()
+    except ArchiveStopped:
+        pass
+    except Exception as E:
+        try:
+            writer.put(E)
+        except ArchiveStopped:
+            pass
+
+
+async def tar_directory(path: Path, is_readable: Callable[[Path], bool], codec: str = 'none',
+                        sizer: ChunkSizer = None) -> AsyncGenerator:
+    '''
+    tar of folder (compressed by gzip or xz for codec zlib or lzma) made while it is sent.
+    Yields blocks (see utility.frame_block), empty block ends archive.
+    If archive can not be finished (e.g. file was removed while it was read) it is ended at once
+    '''
+    sizer = sizer or ChunkSizer()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=4)
+    writer = BlockQueueWriter(loop, queue, sizer.size)
+    builder = loop.run_in_executor(builders, write_tar, writer, path, is_readable, codec)
+    try:
+        while (block := await queue.get()) is not None:
+            if isinstance(block, Exception):
+                print(f'[x] archive of {path} is broken: {block}')
+                break
+            yield block
+        yield frame_block(b'')
+    finally:
+        writer.stopped = True
+        while not queue.empty():  # let thread see that archive is not read anymore
+            queue.get_nowait()
+        await builder
+
+
+class BlockQueueReader:
+    '''
+    file object for tarfile working in thread: data received by event loop is taken from asyncio.Queue,
+    None in queue is end of archive
+    '''
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue):
+        self.__loop = loop
+        self.__queue = queue
+        self.__buffer = bytearray()
+        self.__eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.__eof and (size < 0 or len(self.__buffer) < size):
+            block = asyncio.run_coroutine_threadsafe(self.__queue.get(), self.__loop).result()
+            if block is None:
+                self.__eof = True
+            else:
+                self.__buffer += block
+        size = len(self.__buffer) if size < 0 else min(size, len(self.__buffer))
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+
+
+class Extracted(NamedTuple):
+    files: int
+    folders: int
+    skipped: List[str]
+    grown: int  # change of size of files in folder (replaced files are subtracted)
+
+
+def member_target(folder: Path, name: str) -> Path | None:
+    '''
+    path to extract archive member to or None if it leads out of folder
+    '''
+    member_path = PurePosixPath(name)
+    if member_path.is_absolute() or '..' in member_path.parts:
+        return None
+    target = Path(folder, *member_path.parts)
+    if not target.resolve().is_relative_to(folder.resolve()):  # through symlink
+        return None
+    return target
+
+
+def in_loop(loop: asyncio.AbstractEventLoop, func: Callable) -> Callable:
+    '''
+    func for thread: it is called by event loop and thread waits for result, so state of loop is not raced
+    '''
+    def call(*args):
+        result = Future()
+
+        def run():
+            try:
+                result.set_result(func(*args))
+            except Exception as E:
+                result.set_exception(E)
+
+        loop.call_soon_threadsafe(run)
+        return result.result()
+
+    return call
+
+
+def extract_tar(source: BlockQueueReader, folder: Path, is_writable: Callable[[Path], bool],
+                reserve: Callable[[int], bool] = None) -> Extracted:
+    '''
+    extract files and folders of (compressed) tar stream member by member (runs in thread).
+    Members leading out of folder, not allowed for writing, links and devices are skipped.
+    File is written next to its target and renamed when it is complete.
+    Growth of folder by file is asked from reserve (see Storage.Quotas.QuotaTracker.reserved) before
+    it is extracted, file is skipped if it does not fit quota
+    '''
+    files, folders, skipped, grown = 0, 0, list(), 0
+    with tarfile.open(fileobj=source, mode='r|*') as tar:
+        for member in tar:
+            target = member_target(folder, member.name)
+            if target is None or not is_writable(target) or not (member.isfile() or member.isdir()):
+                skipped.append(member.name)
+                continue
+            try:
+                if member.isdir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    folders += 1
+                    continue
+                growth = member.size - (target.stat().st_size if target.is_file() else 0)
+                if reserve is not None and not reserve(max(growth, 0)):
+                    skipped.append(f'{member.name} (quota exceeded)')
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = Path(target.parent, f'.{target.name}.push')
+                with tar.extractfile(member) as src, open(tmp_path, 'wb') as f:
+                    shutil.copyfileobj(src, f, 1 << 20)
+                grown += growth
+                os.replace(tmp_path, target)
+                os.utime(target, (member.mtime, member.mtime))
+                files += 1
+            except OSError:
+                skipped.append(member.name)
+    return Extracted(files, folders, skipped, grown)
+
+
+async def receive_tar(reader: asyncio.StreamReader, folder: Path, length: int, is_writable: Callable[[Path], bool],
+                      sizer: ChunkSizer = None, throttle: Throttle = UNLIMITED,
+                      reserve: Callable[[int], bool] = None) -> Tuple[int, Exception | None, Extracted | None]:
+    '''
+    receive tar stream of length bytes and extract it into folder while it is received (see extract_tar).
+    If archive is broken the rest of data is received and dropped, so next request can be read.
+    reserve is called by event loop for extractor thread
+
+    Returns: (amount of received bytes, None or error, extracted members or None)
+    '''
+    sizer = sizer or ChunkSizer()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=8)
+    extractor = loop.run_in_executor(extractors, extract_tar, BlockQueueReader(loop, queue), folder, is_writable,
+                                     reserve and in_loop(loop, reserve))
+
+    def drop_queue(_):
+        while not queue.empty():  # release loop if it waits for place in queue
+            queue.get_nowait()
+
+    extractor.add_done_callback(drop_queue)
+    received = 0
+    error = None
+    try:
+        with IdleWatchdog(tuning.idle_timeout) as watchdog:
+            while received < length:
+                data = await reader.read(min(sizer.size, length - received))
+                if not data:
+                    raise ConnectionError('connection closed by user')
+                watchdog.touch()
+                received += len(data)
+                metrics.bytes_in += len(data)
+                with watchdog.suspended():  # waiting for extractor and for bandwidth is not idle time of user
+                    if not extractor.done():
+                        await queue.put(data)
+                    await throttle.consume(len(data))
+    except (asyncio.TimeoutError, ConnectionError) as E:
+        error = E
+    if not extractor.done():
+        await queue.put(None)
+    try:
+        extracted = await extractor
+    except (tarfile.TarError, EOFError, OSError) as E:
+        return received, error or E, None
+    return received, error, extracted
+
+
+# CLIENT SIDE
+def tar_payload(folder: str, codec: str = 'none') -> bytes:
+    '''
+    tar of local folder for 'push'
+    '''
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=TAR_MODES[codec]) as tar:
+        tar.add(folder, arcname=Path(folder).name)
+    return buffer.getvalue()
+
+
+def join_blocks(data: bytes) -> bytes:
+    '''
+    archive from blocks of chunked reply
+    '''
+    res, position = bytearray(), 0
+    while position < len(data):
+        (length,) = struct.unpack('>I', data[position:position + 4])
+        res += data[position + 4:position + 4 + length]
+        position += 4 + length
+    return bytes(res)
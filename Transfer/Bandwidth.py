@@ -0,0 +1,132 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+from users import User, SuperUser
+
+
+class TokenBucket:
+    '''
+    rate bytes per second, up to burst bytes can be taken at once.
+    Bucket may go into debt: chunk bigger than burst is allowed, next chunks wait until debt is paid
+    '''
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.__stamp = time.monotonic()
+
+    def reserve(self, nbytes: int) -> float:
+        '''
+        take nbytes from bucket
+        Returns: seconds to wait before sending them
+        '''
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.__stamp) * self.rate, self.burst)
+        self.__stamp = now
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Throttle:
+    '''
+    Pace of one transfer: waits for tokens of user bucket (shared by all transfers of uid)
+    and of its share of global rate
+    '''
+
+    def __init__(self, user_bucket: TokenBucket | None, weight: float, burst: float):
+        self.user_bucket = user_bucket
+        self.weight = weight
+        self.share = TokenBucket(0, 0)
+        self.__burst = burst
+
+    @property
+    def limited(self) -> bool:
+        return bool(self.share.rate or (self.user_bucket and self.user_bucket.rate))
+
+    def set_share(self, rate: float):
+        self.share.rate = rate
+        self.share.burst = rate * self.__burst
+        self.share.tokens = min(self.share.tokens, self.share.burst)
+
+    async def consume(self, nbytes: int):
+        delay = self.share.reserve(nbytes)
+        if self.user_bucket is not None:
+            delay = max(delay, self.user_bucket.reserve(nbytes))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+UNLIMITED = Throttle(None, 0, 0)
+
+
+class BandwidthScheduler:
+    '''
+    Bandwidth limits from [bandwidth] section of config.toml.
+    Global rate is split between active transfers in proportion to their weight (fair sharing),
+    all transfers of one uid are additionally limited by rate of that uid.
+    Superusers are exempt from limits or get priority_weight share of global rate without user limit.
+    Rates are in bytes per second, 0 - unlimited
+    '''
+
+    def __init__(self):
+        self.rate = 0
+        self.user_rate = 0
+        self.burst = .25  # seconds of rate which can be sent at once
+        self.superusers = 'exempt'  # exempt | priority
+        self.priority_weight = 4
+        self.users: Dict[str, int] = {}  # rate of uid
+        self.__active: Dict[Throttle, str] = {}
+        self.__buckets: Dict[str, TokenBucket] = {}
+
+    def configure(self, config: Dict[str, Any]):
+        for key, value in config.items():
+            if not hasattr(self, key) or key.startswith('_'):
+                raise KeyError(f'unknown bandwidth setting "{key}"')
+            setattr(self, key, value)
+        if self.superusers not in ('exempt', 'priority'):
+            raise ValueError('bandwidth.superusers must be "exempt" or "priority"')
+
+    @property
+    def active(self) -> int:
+        return len(self.__active)
+
+    def __rebalance(self):
+        total = sum(throttle.weight for throttle in self.__active)
+        for throttle in self.__active:
+            throttle.set_share(self.rate * throttle.weight / total if self.rate else 0)
+
+    @contextmanager
+    def transfer(self, user: User):
+        '''
+        register transfer of user for the time of with block
+        Returns: Throttle of transfer, its consume(nbytes) must be awaited before sending or after receiving data
+        '''
+        superuser = isinstance(user, SuperUser)
+        if superuser and self.superusers == 'exempt':
+            yield UNLIMITED
+            return
+        uid = user.uid
+        user_rate = 0 if superuser else self.users.get(uid, self.user_rate)
+        bucket = None
+        if user_rate:
+            bucket = self.__buckets.get(uid)
+            if bucket is None:
+                bucket = self.__buckets[uid] = TokenBucket(user_rate, user_rate * self.burst)
+        throttle = Throttle(bucket, self.priority_weight if superuser else 1, self.burst)
+        self.__active[throttle] = uid
+        self.__rebalance()
+        try:
+            yield throttle
+        finally:
+            del self.__active[throttle]
+            if uid not in self.__active.values():
+                self.__buckets.pop(uid, None)
+            self.__rebalance()
+
+
+bandwidth = BandwidthScheduler()
@@ -0,0 +1,51 @@
+from typing import Any, Dict
+
+
+class TransferTuning:
+    '''
+    transfer settings from [transfer] section of config.toml
+    '''
+
+    def __init__(self):
+        self.chunk_size = 65536  # initial chunk size of session
+        self.min_chunk_size = 16384
+        self.max_chunk_size = 4194304
+        self.adaptive = True  # grow or shrink chunk size by measured throughput of session
+        self.chunk_interval = .05  # adaptive chunk holds about this many seconds of transfer
+        self.idle_timeout = 5  # seconds without data from user before upload is stopped
+
+    def configure(self, config: Dict[str, Any]):
+        for key, value in config.items():
+            if not hasattr(self, key):
+                raise KeyError(f'unknown transfer setting "{key}"')
+            setattr(self, key, value)
+
+
+tuning = TransferTuning()
+
+
+class ChunkSizer:
+    '''
+    Chunk size of one session.
+    In adaptive mode chunk is sized to carry chunk_interval seconds of transfer at measured throughput:
+    LAN clients get large chunks, slow WAN clients get small ones.
+    If socket write buffer is not drained (client reads slower than we send) chunk is halved.
+    Chunk changes at most twice per update and is kept between min_chunk_size and max_chunk_size
+    '''
+
+    def __init__(self):
+        self.size = tuning.chunk_size
+
+    def update(self, nbytes: int, seconds: float, backlog: int = 0):
+        '''
+        nbytes: amount of bytes transferred in seconds
+        backlog: bytes left in socket write buffer after transfer
+        '''
+        if not tuning.adaptive or nbytes <= 0:
+            return
+        target = nbytes / max(seconds, 1e-6) * tuning.chunk_interval
+        if backlog > self.size:
+            target = min(target, self.size / 2)
+        target = min(max(target, self.size / 2), self.size * 2)
+        target = min(max(target, tuning.min_chunk_size), tuning.max_chunk_size)
+        self.size = max(int(target) // 4096 * 4096, tuning.min_chunk_size)
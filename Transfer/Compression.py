@@ -0,0 +1,148 @@
+import asyncio
+import lzma
+import struct
+import zlib
+from pathlib import Path
+from typing import AsyncGenerator, BinaryIO, Iterator
+
+from Transfer.ChunkSizer import ChunkSizer
+from utility import FileSlice, frame_block
+
+CODECS = ('none', 'zlib', 'lzma')  # codec id is index in tuple
+# there is no use to compress these files again
+COMPRESSED_SUFFIXES = {'.gz', '.tgz', '.bz2', '.xz', '.txz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.jar', '.apk',
+                       '.png', '.jpg', '.jpeg', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.flac', '.mp4',
+                       '.mkv', '.avi', '.mov', '.webm', '.pdf', '.docx', '.xlsx', '.pptx', '.odt', '.epub'}
+
+
+def choose_codec(requested: str | None, path: str | Path) -> str:
+    '''
+    codec for transfer of file: requested one if server knows it and file is not compressed already, otherwise 'none'
+    '''
+    if requested not in CODECS or Path(path).suffix.lower() in COMPRESSED_SUFFIXES:
+        return 'none'
+    return requested
+
+
+class Encoder:
+    '''
+    streaming compressor, counts raw and compressed bytes
+    '''
+
+    def __init__(self, codec: str, level: int = 6):
+        self.codec = codec
+        self.__compressor = zlib.compressobj(level) if codec == 'zlib' else lzma.LZMACompressor(preset=level)
+        self.raw = 0
+        self.compressed = 0
+
+    def compress(self, data: bytes) -> bytes:
+        self.raw += len(data)
+        res = self.__compressor.compress(data)
+        self.compressed += len(res)
+        return res
+
+    def read_block(self, f: BinaryIO, size: int) -> bytes:
+        '''
+        read and compress next part of file (runs in thread)
+        '''
+        return self.compress(f.read(size))
+
+    def flush(self) -> bytes:
+        res = self.__compressor.flush()
+        self.compressed += len(res)
+        return res
+
+    def report(self) -> str:
+        ratio = self.raw / self.compressed if self.compressed else 0
+        return f'({self.codec}: {self.raw} -> {self.compressed} bytes, ratio {ratio:.2f})'
+
+
+class Decoder:
+    '''
+    streaming decompressor, counts raw and compressed bytes
+    '''
+
+    def __init__(self, codec: str):
+        self.codec = codec
+        self.__decompressor = zlib.decompressobj() if codec == 'zlib' else lzma.LZMADecompressor()
+        self.raw = 0
+        self.compressed = 0
+
+    def decompress(self, data: bytes) -> bytes:
+        if not data:
+            return b''
+        self.compressed += len(data)
+        res = self.__decompressor.decompress(data)
+        self.raw += len(res)
+        return res
+
+    def pieces(self, data: bytes, max_length: int) -> Iterator[bytes]:
+        '''
+        decompressed data by pieces of max_length bytes at most: small compressed data can expand
+        to gigabytes, so it is never decompressed at once (next piece is made when previous one is taken)
+        '''
+        if not data:
+            return
+        self.compressed += len(data)
+        decompressor = self.__decompressor
+        while True:
+            res = decompressor.decompress(data, max_length)
+            self.raw += len(res)
+            if res:
+                yield res
+            if self.codec == 'zlib':
+                data = decompressor.unconsumed_tail
+                more = data or len(res) == max_length  # output can be left in decompressor too
+            else:
+                data = b''
+                more = not decompressor.needs_input and not decompressor.eof
+            if not more:
+                return
+
+    def flush(self) -> bytes:
+        res = self.__decompressor.flush() if self.codec == 'zlib' else b''
+        self.raw += len(res)
+        return res
+
+    def report(self) -> str:
+        ratio = self.raw / self.compressed if self.compressed else 0
+        return f'({self.codec}: {self.raw} -> {self.compressed} bytes, ratio {ratio:.2f})'
+
+
+async def compress_file(source: FileSlice, codec: str, sizer: ChunkSizer = None) -> AsyncGenerator:
+    '''
+    read and compress file region chunk by chunk (of session chunk size) in thread,
+    yield compressed data as blocks (see utility.frame_block)
+    '''
+    sizer = sizer or ChunkSizer()
+    encoder = Encoder(codec)
+    with open(source.path, 'rb') as f:
+        f.seek(source.offset)
+        left = source.count
+        while left > 0:
+            size = min(sizer.size, left)
+            block = await asyncio.to_thread(encoder.read_block, f, size)
+            left -= size
+            if block:
+                yield frame_block(block)
+    yield frame_block(encoder.flush())
+    yield frame_block(b'')
+    print(f'[i] {source.path} was sent {encoder.report()}')
+
+
+# CLIENT SIDE
+def compress_bytes(data: bytes, codec: str) -> bytes:
+    encoder = Encoder(codec)
+    return encoder.compress(data) + encoder.flush()
+
+
+def decompress_blocks(data: bytes, codec: str) -> bytes:
+    '''
+    join blocks of chunked reply and decompress them
+    '''
+    decoder, res, position = Decoder(codec), b'', 0
+    while position < len(data):
+        (length,) = struct.unpack('>I', data[position:position + 4])
+        res += decoder.decompress(data[position + 4:position + 4 + length])
+        position += 4 + length
+    return res + decoder.flush()
@@ -0,0 +1,323 @@
+import asyncio
+import hashlib
+import math
+import os
+import struct
+import zlib
+from itertools import accumulate, compress, count, repeat, tee
+from operator import mod, mul, sub
+from typing import BinaryIO, Callable, Dict, Iterator, List, Tuple
+
+from Metrics.MetricsCollector import metrics
+from Storage.Quotas import QuotaExceeded
+from Transfer.Bandwidth import UNLIMITED, Throttle
+from Transfer.ChunkSizer import ChunkSizer, tuning
+from Transfer.DiskWriter import DoubleBufferedWriter, IdleWatchdog, skip_data
+
+# rsync-like update of existing file.
+# signature of file: block size [4 bytes] + file size [8 bytes]
+#                    + for every block: adler32 of block [4 bytes] + blake2b of block [16 bytes]
+# delta - sequence of operations:
+#     b'L' + length [4 bytes] + literal data
+#     b'C' + index of first block [8 bytes] + amount of blocks [4 bytes] - copy blocks of existing file
+#     b'E' + size of new file [8 bytes] + sha256 of new file [32 bytes] - end of delta
+SIGNATURE_HEADER = struct.Struct('>IQ')
+BLOCK = struct.Struct('>I16s')
+LITERAL = struct.Struct('>I')
+COPY = struct.Struct('>QI')
+END = struct.Struct('>Q32s')
+MOD_ADLER = 65521
+
+
+class DeltaError(Exception):
+    '''
+    raised when delta breaks format or does not give the file client has
+    '''
+    pass
+
+
+def block_size_for(file_size: int) -> int:
+    '''
+    about square root of file size (as rsync does), so signature and amount of blocks grow slowly
+    '''
+    return min(max(math.isqrt(file_size) & ~1023, 4096), 1 << 20)
+
+
+def strong_digest(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def signature(path: str, block_size: int) -> bytes:
+    '''
+    signature of existing file (server side, run in thread)
+    '''
+    parts = [SIGNATURE_HEADER.pack(block_size, os.stat(path).st_size)]
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            parts.append(BLOCK.pack(zlib.adler32(block), strong_digest(block)))
+    return b''.join(parts)
+
+
+def parse_signature(data: bytes) -> Tuple[int, int, List[Tuple[int, bytes]]]:
+    '''
+    Returns: block size, file size, [(adler32, blake2b) of every block]
+    '''
+    block_size, file_size = SIGNATURE_HEADER.unpack_from(data)
+    return block_size, file_size, list(BLOCK.iter_unpack(data[SIGNATURE_HEADER.size:]))
+
+
+def weak_key(weak: int, block_size: int) -> Tuple[int, int]:
+    '''
+    adler32 of block as (b, a) without their initial values (n and 1), as weak_keys gives them
+    '''
+    return ((weak >> 16) - block_size) % MOD_ADLER, ((weak & 0xffff) - 1) % MOD_ADLER
+
+
+def weak_keys(window: bytes | memoryview, block_size: int) -> Iterator[Tuple[int, int]]:
+    '''
+    weak_key of every block_size bytes of window at every offset (len(window) - block_size + 1 of them).
+    Checksum is rolled by chains of itertools and operator iterators, so bytes are not looped over in Python:
+        a[i + 1] = a[i] - x[i] + x[i + n]
+        b[i + 1] = b[i] - n * x[i] + a[i + 1]
+    where a is sum of block, b is sum of its prefix sums
+    '''
+    n = block_size
+    first = window[:n]
+    outgoing, incoming = window[:-n], window[n:]
+    sums, next_sums = tee(accumulate(map(sub, incoming, outgoing), initial=sum(first)))
+    next(next_sums, None)
+    prefix_sums = accumulate(map(sub, next_sums, map(mul, outgoing, repeat(n))),
+                             initial=sum(map(mul, range(n, 0, -1), first)))
+    return zip(map(mod, prefix_sums, repeat(MOD_ADLER)), map(mod, sums, repeat(MOD_ADLER)))
+
+
+class DeltaPayload:
+    '''
+    client side: delta which turns file of server (by its signature) into local file.
+    Made by two passes over file without reading it into memory:
+    - plan: file is read through window of block size + SCAN bytes, matched blocks go on by one checksum per block.
+      After mismatch the next matching offset is searched by rolling adler32 over SCAN offsets at once
+      (see weak_keys), candidates are checked by blake2b. Only operations are kept, literal data is not
+    - iteration: delta is made from operations by pieces, literal data is read from file again,
+      so length of delta is known before it is sent (it is announced in header of request)
+    '''
+    SCAN = 1 << 20  # offsets searched at once after mismatch
+    READ = 1 << 20
+    LITERAL_MAX = 1 << 24  # literal data of one operation
+
+    def __init__(self, path: str, signature_reply: bytes):
+        self.path = path
+        self.block_size, old_size, self.__blocks = parse_signature(signature_reply)
+        self.__table: Dict[int, List[Tuple[bytes, int]]] = dict()
+        for index, (weak, strong) in enumerate(self.__blocks):
+            self.__table.setdefault(weak, []).append((strong, index))
+        self.__keys = set(weak_key(weak, self.block_size) for weak in self.__table)  # for search after mismatch
+        self.__last_size = old_size - (len(self.__blocks) - 1) * self.block_size if self.__blocks else 0
+        self.operations: List[Tuple[bytes, int, int]] = list()  # (b'L', start, end) or (b'C', first, amount)
+        self.size = 0
+        self.sha256 = b''
+        with open(path, 'rb') as f:
+            self.__plan(f)
+        self.length = sum(self.__length(operation) for operation in self.operations) + 1 + END.size
+
+    def __match(self, block: bytes | memoryview, weak: int) -> int | None:
+        for strong, index in self.__table.get(weak, ()):
+            if (self.__last_size if index == len(self.__blocks) - 1 else self.block_size) == len(block) \
+                    and strong == strong_digest(block):
+                return index
+        return None
+
+    def __literal(self, start: int, end: int):
+        if start >= end:
+            return
+        if self.operations and self.operations[-1][0] == b'L' and self.operations[-1][2] == start:
+            self.operations[-1] = (b'L', self.operations[-1][1], end)
+        else:
+            self.operations.append((b'L', start, end))
+
+    def __copy(self, index: int):
+        last = self.operations[-1] if self.operations else None
+        if last is not None and last[0] == b'C' and last[1] + last[2] == index:
+            self.operations[-1] = (b'C', last[1], last[2] + 1)
+        else:
+            self.operations.append((b'C', index, 1))
+
+    def __plan(self, f: BinaryIO):
+        n = self.block_size
+        digest = hashlib.sha256()
+        buffer, base = b'', 0  # window of file and position of its first byte in file
+
+        def fill(end: int) -> int:
+            '''
+            read file till end (or till its end), bytes before pos are dropped
+            Returns: position of the end of window
+            '''
+            nonlocal buffer, base
+            if base + len(buffer) < end:
+                data = f.read(max(end - base - len(buffer), self.READ))
+                digest.update(data)
+                buffer, base = buffer[pos - base:] + data, pos
+            return base + len(buffer)
+
+        pos = literal_start = 0
+        while fill(pos + n) - pos >= n:
+            block = memoryview(buffer)[pos - base:pos - base + n]
+            index = self.__match(block, zlib.adler32(block))
+            if index is None:  # search the next block of server file at every offset after pos
+                end = fill(pos + 1 + self.SCAN + n - 1)
+                window = memoryview(buffer)[pos + 1 - base:end - base]
+                offsets = len(window) - n + 1
+                if offsets <= 0:
+                    break
+                candidates = compress(count(), map(self.__keys.__contains__, weak_keys(window, n)))
+                for offset in candidates:
+                    block = window[offset:offset + n]
+                    index = self.__match(block, zlib.adler32(block))
+                    if index is not None:
+                        pos += 1 + offset
+                        break
+                else:
+                    pos += 1 + offsets
+                    continue
+            self.__literal(literal_start, pos)
+            self.__copy(index)
+            pos += n
+            literal_start = pos
+        while fill(pos + self.READ) > pos:  # the rest of file is read for sha256
+            pos = base + len(buffer)
+        self.size = base + len(buffer)
+        if 0 < self.__last_size < n and self.size - literal_start >= self.__last_size:  # short last block of server
+            start = self.size - self.__last_size
+            f.seek(start)
+            block = f.read(self.__last_size)
+            index = self.__match(block, zlib.adler32(block))
+            if index is not None:
+                self.__literal(literal_start, start)
+                self.__copy(index)
+                literal_start = self.size
+        self.__literal(literal_start, self.size)
+        self.sha256 = digest.digest()
+
+    def __length(self, operation: Tuple[bytes, int, int]) -> int:
+        if operation[0] == b'C':
+            return 1 + COPY.size
+        size = operation[2] - operation[1]
+        return size + -(-size // self.LITERAL_MAX) * (1 + LITERAL.size)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator[bytes]:
+        '''
+        delta by pieces of at most READ bytes
+        '''
+        with open(self.path, 'rb') as f:
+            for kind, first, second in self.operations:
+                if kind == b'C':
+                    yield b'C' + COPY.pack(first, second)
+                    continue
+                f.seek(first)
+                while first < second:
+                    left = min(second - first, self.LITERAL_MAX)
+                    yield b'L' + LITERAL.pack(left)
+                    first += left
+                    while left:
+                        data = f.read(min(left, self.READ))
+                        if not data:
+                            raise DeltaError('file was changed while delta was made')
+                        left -= len(data)
+                        yield data
+        yield b'E' + END.pack(self.size, self.sha256)
+
+
+def delta_payload(path: str, signature_reply: bytes) -> DeltaPayload:
+    '''
+    client side: delta which turns file of server (by its signature) into local file (see DeltaPayload)
+    '''
+    return DeltaPayload(path, signature_reply)
+
+
+async def apply_delta(reader: asyncio.StreamReader, old: BinaryIO, f: BinaryIO, length: int, block_size: int,
+                      sizer: ChunkSizer = None, throttle: Throttle = UNLIMITED,
+                      reserve: Callable[[int], bool] = None) -> Tuple[int, Exception | None, str]:
+    '''
+    server side: receive delta of length bytes and write new file into f,
+    blocks are copied from old file by reader thread, literal data is taken from socket.
+    New file is checked by size and sha256 from the end of delta.
+    reserve (see Storage.Quotas.QuotaTracker.reserved) is asked for every piece of new file before it is written,
+    delta is stopped with QuotaExceeded when new file does not fit quota
+
+    Returns: (amount of received bytes, None or error, sha256 of new file)
+    '''
+    sizer = sizer or ChunkSizer()
+    digest = hashlib.sha256()
+    watchdog = IdleWatchdog(tuning.idle_timeout)
+    writer = DoubleBufferedWriter(f, sizer.size, digest, watchdog)
+    old_size = os.fstat(old.fileno()).st_size
+    received = written = 0
+    error = None
+
+    async def read(size: int) -> bytes:
+        nonlocal received
+        if received + size > length:
+            raise DeltaError('delta is longer than announced')
+        data = await reader.readexactly(size)
+        received += size
+        return data
+
+    async def write(data: bytes):
+        nonlocal written
+        if reserve is not None and not reserve(len(data)):
+            raise QuotaExceeded('new file does not fit quota')
+        written += len(data)
+        await writer.write(data)
+
+    try:
+        with watchdog:
+            while True:
+                op = await read(1)
+                if op == b'L':
+                    (left,) = LITERAL.unpack(await read(LITERAL.size))
+                    while left:
+                        data = await read(min(sizer.size, left))
+                        left -= len(data)
+                        metrics.bytes_in += len(data)
+                        await write(data)
+                        with watchdog.suspended():  # waiting for bandwidth is not idle time of user
+                            await throttle.consume(len(data))
+                elif op == b'C':
+                    first, count = COPY.unpack(await read(COPY.size))
+                    offset, end = first * block_size, min((first + count) * block_size, old_size)
+                    if count == 0 or offset >= end:
+                        raise DeltaError(f'no blocks {first}..{first + count} in file')
+                    while offset < end:
+                        with watchdog.suspended():
+                            data = await asyncio.to_thread(os.pread, old.fileno(), min(sizer.size, end - offset),
+                                                           offset)
+                        if not data:
+                            raise DeltaError('file was changed while delta was made')
+                        offset += len(data)
+                        await write(data)
+                    watchdog.touch()
+                elif op == b'E':
+                    size, sha256 = END.unpack(await read(END.size))
+                    await writer.flush()
+                    if received != length:
+                        raise DeltaError('delta is shorter than announced')
+                    if size != written or sha256 != digest.digest():
+                        raise DeltaError('file differs from file of client, it was changed while delta was made')
+                    break
+                else:
+                    raise DeltaError(f'unknown operation {op}')
+    except asyncio.IncompleteReadError:
+        error = ConnectionError('connection closed by user')
+    except (asyncio.TimeoutError, ConnectionError, DeltaError, QuotaExceeded) as E:
+        error = E
+    finally:
+        try:
+            await writer.flush()
+        finally:
+            await writer.close()
+    if isinstance(error, (DeltaError, QuotaExceeded)) and received < length:  # keep protocol in sync
+        received += await skip_data(reader, length - received, sizer)
+    return received, error, digest.hexdigest()
@@ -0,0 +1,216 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import BinaryIO, Callable, Tuple
+
+from Metrics.MetricsCollector import metrics
+from Storage.Quotas import QuotaExceeded
+from Transfer.Bandwidth import UNLIMITED, Throttle
+from Transfer.ChunkSizer import ChunkSizer, tuning
+from Transfer.Compression import Decoder
+
+WRITER_THREADS = 32  # disk writes of all transfers at the same time, the next ones wait for thread
+# writer of transfer has one write in progress at most, so writes of one file keep their order in shared pool
+writers = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix='writer')
+
+
+class IdleWatchdog:
+    '''
+    One timer per transfer instead of asyncio.wait_for on every chunk.
+    Timer wakes up once per timeout, checks time of the last activity and cancels the transfer task
+    if user sent nothing for too long. Cancellation is turned into asyncio.TimeoutError.
+    Time spent by server itself (waiting for disk or for bandwidth) is not idle time of user, see suspended
+    '''
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expired = False
+        self.__loop = asyncio.get_running_loop()
+        self.__task = asyncio.current_task()
+        self.__last_activity = self.__loop.time()
+        self.__suspended = 0
+        self.__handle = None
+
+    def touch(self):
+        self.__last_activity = self.__loop.time()
+
+    @contextmanager
+    def suspended(self):
+        '''
+        user is not waited for inside, timer starts again after it
+        '''
+        self.__suspended += 1
+        try:
+            yield
+        finally:
+            self.__suspended -= 1
+            self.touch()
+
+    def __check(self):
+        idle = self.__loop.time() - self.__last_activity
+        if self.__suspended:
+            self.__handle = self.__loop.call_later(self.timeout, self.__check)
+        elif idle >= self.timeout:
+            self.expired = True
+            self.__task.cancel()
+        else:
+            self.__handle = self.__loop.call_later(self.timeout - idle, self.__check)
+
+    def __enter__(self):
+        self.__handle = self.__loop.call_later(self.timeout, self.__check)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__handle.cancel()
+        if self.expired and exc_type is asyncio.CancelledError:
+            self.__task.uncancel()
+            raise asyncio.TimeoutError(f'{self.timeout} sec data timeout expired') from None
+        return False
+
+
+class DoubleBufferedWriter:
+    '''
+    Data from socket is collected into one of two preallocated buffers.
+    When buffer is full it is handed to thread of writers pool and the other one is filled meanwhile,
+    so event loop never waits for disk unless disk is slower than network.
+    If digest (hashlib object) is given it is updated by written data in writer thread too.
+    Time of waiting for disk is not counted by watchdog of transfer
+    '''
+
+    def __init__(self, f: BinaryIO, buffer_size: int, digest=None, watchdog: IdleWatchdog = None):
+        self.__f = f
+        self.__digest = digest
+        self.__watchdog = watchdog
+        self.__size = buffer_size
+        self.__views = (memoryview(bytearray(buffer_size)), memoryview(bytearray(buffer_size)))
+        self.__current = 0
+        self.__filled = 0
+        self.__pending: asyncio.Future | None = None
+
+    async def write(self, data: bytes):
+        data = memoryview(data)
+        while data:
+            size = min(len(data), self.__size - self.__filled)
+            self.__views[self.__current][self.__filled:self.__filled + size] = data[:size]
+            self.__filled += size
+            data = data[size:]
+            if self.__filled == self.__size:
+                await self.__swap()
+
+    async def __wait(self):
+        '''
+        wait until the other buffer is written. Write is shielded: cancelled transfer does not cancel it,
+        so it can be awaited again by flush
+        '''
+        with self.__watchdog.suspended() if self.__watchdog else nullcontext():
+            await asyncio.shield(self.__pending)
+
+    async def __swap(self):
+        if self.__pending is not None:
+            await self.__wait()  # the other buffer is written, it can be filled again
+        self.__pending = asyncio.get_running_loop().run_in_executor(
+            writers, self.__write, self.__views[self.__current][:self.__filled])
+        self.__current ^= 1
+        self.__filled = 0
+
+    def __write(self, data: memoryview):
+        if self.__digest is not None:
+            self.__digest.update(data)
+        self.__f.write(data)
+
+    async def flush(self):
+        if self.__filled:
+            await self.__swap()
+        if self.__pending is not None:
+            await self.__wait()
+            self.__pending = None
+
+    async def close(self):
+        '''
+        wait for write in progress (flush could be interrupted), file must not be closed while it is written
+        '''
+        if self.__pending is not None:
+            await asyncio.gather(asyncio.shield(self.__pending), return_exceptions=True)
+            self.__pending = None
+
+
+async def receive_to_file(reader: asyncio.StreamReader, f: BinaryIO, length: int, sizer: ChunkSizer = None,
+                          decoder: Decoder = None, throttle: Throttle = UNLIMITED,
+                          digest=None, reserve: Callable[[int], bool] = None) -> Tuple[int, Exception | None]:
+    '''
+    receive length bytes from user and write them to opened file (decompressed if decoder is given).
+    Whatever was received before failure is written too, so it can be kept as part of file.
+    Buffers have session chunk size, measured throughput adjusts it for next transfers (see Transfer.ChunkSizer).
+    Upload is stopped if user sends nothing for tuning.idle_timeout seconds.
+    Throttled upload is slowed down by reading socket less often (see Transfer.Bandwidth).
+    digest (hashlib object) is updated by written data.
+    Compressed data is decompressed by pieces of buffer size (see Transfer.Compression.Decoder.pieces).
+    reserve (see Storage.Quotas.QuotaTracker.reserved) is asked for every piece of data before it is written,
+    so decompressed size is checked: if piece does not fit quota the rest of data is dropped
+
+    Returns: (amount of received bytes, None) or (amount of received bytes, error) if connection was closed,
+             user was idle for idle_timeout or quota was exceeded (QuotaExceeded).
+             Received bytes are counted when they are taken by writer, so all of them are in file when it returns
+    '''
+    sizer = sizer or ChunkSizer()
+    buffer_size = sizer.size
+    watchdog = IdleWatchdog(tuning.idle_timeout)
+    writer = DoubleBufferedWriter(f, buffer_size, digest, watchdog)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    received = 0
+    error = None
+    try:
+        with watchdog:
+            while received < length:
+                data = await reader.read(min(buffer_size, length - received))
+                if not data:
+                    raise ConnectionError('connection closed by user')
+                watchdog.touch()
+                metrics.bytes_in += len(data)
+                for piece in decoder.pieces(data, buffer_size) if decoder else (data,):
+                    if reserve is not None and not reserve(len(piece)):
+                        with watchdog.suspended():
+                            await skip_data(reader, length - received - len(data), sizer)
+                        raise QuotaExceeded('decompressed data does not fit quota')
+                    await writer.write(piece)
+                received += len(data)
+                with watchdog.suspended():  # waiting for bandwidth is not idle time of user
+                    await throttle.consume(len(data))
+            if decoder:
+                piece = decoder.flush()
+                if reserve is not None and not reserve(len(piece)):
+                    raise QuotaExceeded('decompressed data does not fit quota')
+                await writer.write(piece)
+    except (asyncio.TimeoutError, ConnectionError, QuotaExceeded) as E:
+        error = E
+    finally:
+        try:
+            await writer.flush()
+        finally:
+            await writer.close()
+    if error is None:
+        sizer.update(received, loop.time() - started)
+    return received, error
+
+
+async def skip_data(reader: asyncio.StreamReader, length: int, sizer: ChunkSizer = None) -> int:
+    '''
+    receive and drop length bytes of data which was refused, so next request can be read
+
+    Returns: amount of dropped bytes
+    '''
+    sizer = sizer or ChunkSizer()
+    skipped = 0
+    try:
+        with IdleWatchdog(tuning.idle_timeout) as watchdog:
+            while skipped < length:
+                data = await reader.read(min(sizer.size, length - skipped))
+                if not data:
+                    break
+                skipped += len(data)
+                metrics.bytes_in += len(data)
+                watchdog.touch()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    return skipped
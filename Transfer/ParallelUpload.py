@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from Storage.Mutations import changed
+from Storage.Quotas import quotas
+
+
+class ParallelUpload:
+    '''
+    File which ranges are received by several connections at the same time.
+    Ranges are written at their offsets into "file.ppart" of file size, it is preallocated if space is limited
+    by quota (otherwise it is sparse and takes only written ranges),
+    received ranges are kept in "file.ppart.ranges" (json), so upload can be resumed after server restart.
+    When the whole file is received "file.ppart" is renamed to "file"
+    '''
+
+    def __init__(self, path: Path, size: int, preallocate: bool = False):
+        self.path = path
+        self.size = size
+        self.part_path = Path(f'{path}.ppart')
+        self.ranges_path = Path(f'{path}.ppart.ranges')
+        self.ranges: List[List[int]] = list()  # sorted merged [start, end) of received bytes
+        self.writers = 0  # connections which are writing ranges now
+
+        if self.part_path.exists() and self.ranges_path.exists():
+            with open(self.ranges_path, 'r') as f:
+                saved = json.load(f)
+            if saved['size'] == size:
+                self.ranges = saved['ranges']
+                return
+        with open(self.part_path, 'wb') as f:
+            if size and preallocate:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except (AttributeError, OSError):  # no fallocate on windows or in file system
+                    f.truncate(size)
+            else:
+                f.truncate(size)
+        self.save_ranges()
+
+    def received_from(self, offset: int) -> int:
+        '''
+        amount of bytes already received continuously from offset
+        '''
+        for start, end in self.ranges:
+            if start <= offset < end:
+                return end - offset
+        return 0
+
+    def mark(self, start: int, end: int):
+        '''
+        add received range [start, end)
+        '''
+        if start >= end:
+            return
+        merged = list()
+        for _start, _end in sorted(self.ranges + [[start, end]]):
+            if merged and _start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], _end)
+            else:
+                merged.append([_start, _end])
+        self.ranges = merged
+
+    def save_ranges(self):
+        with open(self.ranges_path, 'w') as f:
+            json.dump({'size': self.size, 'ranges': self.ranges}, f)
+
+    @property
+    def received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def complete(self) -> bool:
+        return self.ranges == [[0, self.size]] or self.size == 0
+
+    def finish(self):
+        os.replace(self.part_path, self.path)
+        self.ranges_path.unlink(missing_ok=True)
+
+    def discard(self):
+        self.part_path.unlink(missing_ok=True)
+        self.ranges_path.unlink(missing_ok=True)
+
+
+class ParallelUploads:
+    '''
+    parallel uploads in progress by path of file ([uploads] section of config.toml).
+    Parts which nobody writes for part_timeout seconds are abandoned: they are removed by sweep
+    '''
+
+    def __init__(self):
+        self.__uploads: Dict[str, ParallelUpload] = dict()
+        self.max_size = 1 << 34  # largest file size of psend, 0 - unlimited
+        self.part_timeout = 86400  # seconds before part without writes is removed, 0 - parts are kept
+        self.storage: Path | None = None
+
+    def configure(self, config: Dict[str, Any], storage: str):
+        self.max_size = config.get('max_size', self.max_size)
+        self.part_timeout = config.get('part_timeout', self.part_timeout)
+        self.storage = Path(storage).resolve()
+
+    def open(self, path: Path, size: int) -> ParallelUpload:
+        '''
+        get upload of file or start new one.
+        Raise ValueError if file is larger than max_size or upload of this file with other size is in progress
+        '''
+        if self.max_size and size > self.max_size:
+            raise ValueError(f'file size {size} exceeds limit {self.max_size}')
+        upload = self.__uploads.get(path.__str__())
+        if upload is None:
+            upload = self.__uploads[path.__str__()] = ParallelUpload(path, size, quotas.limited(path))
+        elif upload.size != size:
+            raise ValueError(f'upload of {path.name} with size {upload.size} is in progress')
+        return upload
+
+    def close(self, upload: ParallelUpload):
+        '''
+        save state of upload when the last connection finished writing, rename file if it is received.
+        Part without received bytes is removed, there is nothing to resume
+        '''
+        if upload.writers:
+            return
+        if upload.complete:
+            upload.finish()
+        elif not upload.received:
+            upload.discard()
+        else:
+            upload.save_ranges()
+        self.__uploads.pop(upload.path.__str__(), None)
+
+    def __abandoned(self) -> List[Path]:
+        deadline = time.time() - self.part_timeout
+        found = list()
+        for folder, _, files in os.walk(self.storage):
+            for name in files:
+                if name.endswith('.ppart'):
+                    part = Path(folder, name)
+                    try:
+                        touched = max(os.stat(path).st_mtime for path in (part, Path(f'{part}.ranges'))
+                                      if path.exists())
+                    except (OSError, ValueError):  # removed meanwhile
+                        continue
+                    if touched < deadline:
+                        found.append(part)
+        return found
+
+    async def sweep(self) -> int:
+        '''
+        remove parts which nobody wrote for part_timeout seconds (storage is walked in thread).
+        Upload of such part is forgotten too: its connection is gone without closing it
+        Returns: amount of removed parts
+        '''
+        if self.storage is None or not self.part_timeout:
+            return 0
+        removed = 0
+        for part in await asyncio.to_thread(self.__abandoned):
+            self.__uploads.pop(part.__str__()[:-len('.ppart')], None)
+            with quotas.tracked(part):
+                for path in (part, Path(f'{part}.ranges')):
+                    path.unlink(missing_ok=True)
+            changed(part)
+            removed += 1
+        return removed
+
+    async def run(self):
+        '''
+        sweep abandoned parts every part_timeout seconds
+        '''
+        while self.storage is not None and self.part_timeout:
+            await asyncio.sleep(self.part_timeout)
+            await self.sweep()
+
+
+uploads = ParallelUploads()
@@ -7,6 +7,8 @@ class UserData(NamedTuple):
     current_path: str
     permissions: Dict[str, List[str]]
     home_path: str
+    quota: int | None = None  # bytes, 0 - unlimited, None - default quota of server
+    used: int | None = None  # bytes in files of home, None - not counted yet
 
 
 class BaseSaveLoader:
@@ -29,3 +31,13 @@ class BaseSaveLoader:
     @abstractmethod
     async def get_users(self) -> str:
         pass
+
+    async def run(self):
+        '''
+        background work of saveloader while server runs (e.g. flush of cached data)
+        '''
+
+    async def flush(self):
+        '''
+        write everything saved but not written yet, called when server stops
+        '''
@@ -1,21 +1,32 @@
+import asyncio
 import json
+import os
+from collections import OrderedDict
 from functools import reduce
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Set
 
 from UserDataHandle.BaseSaveLoader import BaseSaveLoader, UserData
-from utility import walk_around_folder, trim_path
+from utility import is_valid_uid, walk_around_folder, trim_path
 
 
 class JsonSaveLoader(BaseSaveLoader):
     '''
-    This class provides saving and loading data in json format
+    This class provides saving and loading data in json format.
+    Data of users is kept in LRU of cache_entries users. Saved data is written behind: users changed since
+    the last flush are written every flush_interval seconds by one batch in thread (temporary file + rename,
+    so file of user is never half written) and at once when server stops (see flush)
     '''
 
     def __init__(self, config: Dict[str, Any]):
         self.__config = config
         self.__storage_path = Path(Path.cwd(), self.__config['storage'])
         self.__json_config_path = Path(Path.cwd(), 'Users')
+        self.cache_entries = config.get('cache_entries', 4096)
+        self.flush_interval = config.get('flush_interval', 1.)
+        self.__cache: OrderedDict[str, UserData] = OrderedDict()
+        self.__dirty: Set[str] = set()  # users saved to cache but not written yet
+        self.__flushing = asyncio.Lock()
 
         if not Path('Users').exists():
             Path('Users').mkdir()
@@ -23,21 +34,26 @@ class JsonSaveLoader(BaseSaveLoader):
     async def create_user(self, uid: str) -> UserData:
         '''
         Firstly create new folder named "uid" in self.__storage_path
-        Then create udata.json file with user data:
+        Then save user data (file "Users/uid.json" is written by the next flush):
         {"uid": {"permissions": {"w": [],
                                   "r": [],
                                   "x": []},
         "current_path": by default "self.__storage_path\\uid",
-        "home_path": "self.__storage_path\\uid"}
+        "home_path": "self.__storage_path\\uid",
+        "quota": null, "used": null}
         }
 
         return namedtuple UserData
+        Raises: ValueError if uid is not valid name of home folder (see utility.is_valid_uid)
         '''
+        if not is_valid_uid(uid):
+            raise ValueError(f'wrong user id "{uid}"')
         spath: Path = Path(Path.cwd(), self.__storage_path, uid)  #  path to user storage
-        upath: Path = Path(self.__json_config_path, f'{uid}.json')  #  path to user json config
         udata = {uid: {'permissions': {'w': [spath.__str__()], 'r': [spath.__str__()], 'x': [spath.__str__()]},
                        'current_path': spath.__str__(),
-                       'home_path': spath.__str__()
+                       'home_path': spath.__str__(),
+                       'quota': None,
+                       'used': None
                        }
                  }
         try:
@@ -45,10 +61,10 @@ class JsonSaveLoader(BaseSaveLoader):
         except FileExistsError:
             pass
 
-        with open(upath, 'w') as f:
-            json.dump(udata, f)
-
-        return UserData(uid, udata[uid]['current_path'], udata[uid]['permissions'], udata[uid]['home_path'])
+        created = UserData(uid, udata[uid]['current_path'], udata[uid]['permissions'], udata[uid]['home_path'],
+                           udata[uid]['quota'], udata[uid]['used'])
+        await self.save_user_data(created)
+        return created
 
     async def load_user(self, uid: str) -> UserData:
         '''
@@ -56,41 +72,94 @@ class JsonSaveLoader(BaseSaveLoader):
         return namedtuple UserData
         '''
         # upath = Path(self.__storage_path, uid, 'udata.json')
+        if uid in self.__cache:
+            self.__cache.move_to_end(uid)
+            return self.__cache[uid]
         upath: Path = Path(self.__json_config_path, f'{uid}.json')  # path to json config
 
         try:
-            with open(upath, 'r') as f:
-                json_udata = json.load(f)
+            json_udata = await asyncio.to_thread(self.__read, upath)
         except FileNotFoundError:
             return await self.create_user(uid)
 
         udata = UserData(uid, json_udata[uid]['current_path'], json_udata[uid]['permissions'],
-                         json_udata[uid]['home_path'])
+                         json_udata[uid]['home_path'], json_udata[uid].get('quota'), json_udata[uid].get('used'))
+        self.__put(udata)
         return udata
 
+    @staticmethod
+    def __read(upath: Path) -> Dict:
+        with open(upath, 'r') as f:
+            return json.load(f)
+
+    def __put(self, udata: UserData):
+        self.__cache[udata.uid] = udata
+        self.__cache.move_to_end(udata.uid)
+        self.__trim()
+
+    def __trim(self):
+        '''
+        drop least recently used users, changed users are kept until they are written
+        '''
+        while len(self.__cache) > self.cache_entries and next(iter(self.__cache)) not in self.__dirty:
+            self.__cache.popitem(last=False)
+
     async def save_user_data(self, udata: UserData):
         '''
         Save user`s data in json format in "self.__storage_path\\uid as udata.json
-
+        Data is written by the next flush
         '''
-        upath: Path = Path(self.__json_config_path, f'{udata.uid}.json')  # path to json config
-        _udata = {udata.uid: {'permissions': udata.permissions,
-                              'current_path': udata.current_path,
-                              'home_path': udata.home_path
-                              }
-                  }
+        self.__dirty.add(udata.uid)
+        self.__put(udata)
 
-        try:
-            with open(upath, 'w') as f:
-                json.dump(_udata, f)
-            print(f'[i] user {udata.uid} was successfully saved')
-        except FileNotFoundError:
-            print(f'[!] foo udata.json was deleted during the session')
+    async def flush(self):
+        '''
+        write changed users by one batch in thread
+        '''
+        async with self.__flushing:
+            if not self.__dirty:
+                return
+            batch = dict()
+            for uid in self.__dirty:  # dumped here: permissions of cached data can be changed while batch is written
+                udata = self.__cache[uid]
+                batch[uid] = json.dumps({uid: {'permissions': udata.permissions,
+                                               'current_path': udata.current_path,
+                                               'home_path': udata.home_path,
+                                               'quota': udata.quota,
+                                               'used': udata.used
+                                               }
+                                         })
+            self.__dirty.clear()
+            try:
+                await asyncio.to_thread(self.__write, batch)
+                print(f'[i] {len(batch)} users were successfully saved')
+                self.__trim()
+            except OSError as E:
+                self.__dirty.update(batch)
+                print(f'[!] users were not saved: {E}')
+
+    def __write(self, batch: Dict[str, str]):
+        for uid, text in batch.items():
+            upath: Path = Path(self.__json_config_path, f'{uid}.json')  # path to json config
+            tmp_path = upath.with_name(f'.{upath.name}.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(text)
+            os.replace(tmp_path, upath)
+
+    async def run(self):
+        '''
+        flush changed users every flush_interval seconds
+        '''
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
 
     async def is_new_user(self, uid: str) -> bool:
         '''
         Check if connected user is new user or already connected before
         '''
+        if uid in self.__cache:
+            return False
         spath: Path = Path( self.__storage_path, uid)  #  path to user storage
         upath: Path = Path(self.__json_config_path, f'{uid}.json')  #  path to user json config
         return True if not Path.exists(upath) and Path.exists(spath) else False
@@ -100,5 +169,7 @@ class JsonSaveLoader(BaseSaveLoader):
         Returns: list of stored users
         '''
         path, folders, files = walk_around_folder(self.__json_config_path.__str__(), as_str=False, trimmed_path=None)
+        files = sorted(set(name for name in files if not name.startswith('.'))
+                       | set(f'{uid}.json' for uid in self.__dirty))  # not written yet
         users_list = 'Stored users:\n' + reduce(lambda x, y: f'{x}\n{y}', files)
         return users_list
@@ -5,6 +5,7 @@ from typing import Any, Dict
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from UserDataHandle.BaseSaveLoader import BaseSaveLoader, UserData
+from utility import is_valid_uid
 
 
 class MongoSaveLoader(BaseSaveLoader):
@@ -20,11 +21,15 @@ class MongoSaveLoader(BaseSaveLoader):
                        self.__cfg['storage'])
 
     async def create_user(self, uid: str) -> UserData:
+        if not is_valid_uid(uid):
+            raise ValueError(f'wrong user id "{uid}"')
         spath: Path = Path(Path.cwd(), self.__storage_path, uid)
         udata = {"_id": uid,
                  "permissions": {'w': [spath.__str__()], 'r': [spath.__str__()], 'x': [spath.__str__()]},
                  "current_path": spath.__str__(),
-                 "home_path": spath.__str__()}
+                 "home_path": spath.__str__(),
+                 "quota": None,
+                 "used": None}
 
         try:
             Path.mkdir(spath)
@@ -32,19 +37,23 @@ class MongoSaveLoader(BaseSaveLoader):
             pass
         await self.__collection.insert_one(udata)
 
-        return UserData(uid, udata['current_path'], udata['permissions'], udata['home_path'])
+        return UserData(uid, udata['current_path'], udata['permissions'], udata['home_path'], udata['quota'],
+                        udata['used'])
 
     async def load_user(self, uid: str) -> UserData:
         db_data = await self.__collection.find_one({'_id': uid})
 
-        udata = UserData(uid, db_data['current_path'], db_data['permissions'], db_data['home_path'])
+        udata = UserData(uid, db_data['current_path'], db_data['permissions'], db_data['home_path'],
+                         db_data.get('quota'), db_data.get('used'))
         return udata
 
     async def save_user_data(self, udata: UserData):
         db_data = {'_id': udata.uid,
-                   'permissions': udata.restrictions,
+                   'permissions': udata.permissions,
                    'current_path': udata.current_path,
-                   'home_path': udata.home_path}
+                   'home_path': udata.home_path,
+                   'quota': udata.quota,
+                   'used': udata.used}
 
         try:
             await self.__collection.replace_one({'_id': udata.uid}, db_data)
@@ -0,0 +1,153 @@
+import asyncio
+import functools
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from UserDataHandle.BaseSaveLoader import BaseSaveLoader, UserData
+from utility import is_valid_uid
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    uid TEXT PRIMARY KEY,
+    current_path TEXT NOT NULL,
+    permissions TEXT NOT NULL,  -- json {"w": [...], "r": [...], "x": [...]}
+    home_path TEXT NOT NULL,
+    quota INTEGER,  -- bytes, 0 - unlimited, NULL - default quota of server
+    used INTEGER  -- bytes in files of home, NULL - not counted yet
+) WITHOUT ROWID;
+'''
+# the same statements every time: sqlite3 keeps them prepared in statement cache of connection
+SELECT_USER = 'SELECT current_path, permissions, home_path, quota, used FROM users WHERE uid = ?'
+SAVE_USER = 'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)'
+SELECT_UIDS = 'SELECT uid FROM users ORDER BY uid'
+
+
+class SqliteSaveLoader(BaseSaveLoader):
+    '''
+    This class provides saving and loading data in SQLite database (type = 'sqlite' in [saveloader]),
+    one table for all users instead of file of every user.
+    Database is used by one thread only in WAL mode. Users saved at the same time (e.g. many clients
+    disconnected at once) are written by one transaction: saves wait for the write which includes them.
+    Rows of failed write stay pending and are written with the next save or flush
+    '''
+
+    def __init__(self, config: Dict[str, Any]):
+        self.__storage_path = Path(Path.cwd(), config['storage'])
+        self.__path = Path(Path.cwd(), config.get('database', 'users.sqlite'))
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='users-db')
+        self.__db: sqlite3.Connection | None = None
+        self.__pending: Dict[str, Tuple] = dict()  # uid -> row waiting for write
+        self.__writer: asyncio.Task | None = None
+
+    async def __run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(func, *args))
+
+    # database thread
+    def __connect(self) -> sqlite3.Connection:
+        if self.__db is None:
+            self.__db = sqlite3.connect(self.__path)
+            self.__db.execute('PRAGMA journal_mode=WAL')
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.executescript(SCHEMA)
+        return self.__db
+
+    def __select(self, uid: str) -> Tuple | None:
+        return self.__connect().execute(SELECT_USER, (uid,)).fetchone()
+
+    def __select_uids(self) -> List[str]:
+        return [uid for uid, in self.__connect().execute(SELECT_UIDS)]
+
+    def __write(self, rows: List[Tuple]):
+        db = self.__connect()
+        with db:
+            db.executemany(SAVE_USER, rows)
+
+    # event loop
+    @staticmethod
+    def __row(udata: UserData) -> Tuple:
+        return (udata.uid, udata.current_path, json.dumps(udata.permissions), udata.home_path, udata.quota,
+                udata.used)
+
+    async def __write_pending(self):
+        while self.__pending:
+            batch = dict(self.__pending)
+            self.__pending.clear()
+            try:
+                await self.__run(self.__write, list(batch.values()))
+            except sqlite3.Error as E:
+                for uid, row in batch.items():  # rows saved while batch was written are newer
+                    self.__pending.setdefault(uid, row)
+                print(f'[!] users were not saved: {E}')
+                raise
+            print(f'[i] {len(batch)} users were successfully saved')
+
+    def __start_write(self) -> asyncio.Task:
+        if self.__writer is None or self.__writer.done():
+            self.__writer = asyncio.ensure_future(self.__write_pending())
+        return self.__writer
+
+    async def create_user(self, uid: str) -> UserData:
+        '''
+        Create folder named "uid" in storage and row of user:
+        permissions to home folder, current path is home folder, quota of server
+        Raises: ValueError if uid is not valid name of home folder (see utility.is_valid_uid)
+        '''
+        if not is_valid_uid(uid):
+            raise ValueError(f'wrong user id "{uid}"')
+        spath: Path = Path(self.__storage_path, uid)
+        udata = UserData(uid, spath.__str__(), {'w': [spath.__str__()], 'r': [spath.__str__()], 'x': [spath.__str__()]},
+                         spath.__str__(), None, None)
+        try:
+            Path.mkdir(spath)
+        except FileExistsError:
+            pass
+        await self.save_user_data(udata)
+        return udata
+
+    async def load_user(self, uid: str) -> UserData:
+        row = await self.__run(self.__select, uid)
+        if row is None:
+            return await self.create_user(uid)
+        current_path, permissions, home_path, quota, used = row
+        return UserData(uid, current_path, json.loads(permissions), home_path, quota, used)
+
+    async def save_user_data(self, udata: UserData):
+        '''
+        Save row of user, returns when it is written (with rows of other users saved meanwhile)
+        or when write failed (row stays pending)
+        '''
+        self.__pending[udata.uid] = self.__row(udata)
+        try:
+            await asyncio.shield(self.__start_write())
+        except sqlite3.Error:  # reported by writer
+            pass
+
+    async def is_new_user(self, uid: str) -> bool:
+        return await self.__run(self.__select, uid) is None
+
+    async def get_users(self) -> str:
+        '''
+        Returns: list of stored users
+        '''
+        users = await self.__run(self.__select_uids)
+        users_list = 'Stored users:\n' + reduce(lambda x, y: f'{x}\n{y}', users, '').lstrip('\n')
+        return users_list
+
+    async def flush(self):
+        '''
+        wait for write in progress, write rows left pending by failed write, close database
+        '''
+        if self.__writer is not None:
+            await asyncio.gather(self.__writer, return_exceptions=True)
+        if self.__pending:
+            await asyncio.gather(self.__start_write(), return_exceptions=True)
+        await self.__run(self.__close)
+
+    def __close(self):
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
@@ -0,0 +1,50 @@
+'''
+one-shot migration of users saved by JsonSaveLoader (files of Users folder) to database of SqliteSaveLoader,
+run it from folder of server while server is stopped, then set type = 'sqlite' in [saveloader]
+
+    python UserDataHandle/json_to_sqlite.py [users folder] [database]
+
+users folder is Users by default, database is [saveloader] database of cfg/config.toml.
+Users which are in database already are replaced by their json files, json files are kept
+'''
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+import toml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from UserDataHandle.BaseSaveLoader import UserData  # noqa: E402
+from UserDataHandle.SqliteSaveLoader import SqliteSaveLoader  # noqa: E402
+
+
+def read_users(folder: Path):
+    for upath in sorted(folder.glob('*.json')):  # temporary files of flush start with dot and are skipped
+        with open(upath, 'r') as f:
+            json_udata = json.load(f)
+        for uid, data in json_udata.items():
+            yield UserData(uid, data['current_path'], data['permissions'], data['home_path'], data.get('quota'),
+                           data.get('used'))
+
+
+async def migrate(folder: Path, config: dict) -> int:
+    saveloader = SqliteSaveLoader(config)
+    users = list(read_users(folder))
+    await asyncio.gather(*(saveloader.save_user_data(udata) for udata in users))  # written by one transaction
+    await saveloader.flush()
+    return len(users)
+
+
+def main(folder: str = 'Users', database: str = None):
+    config = dict(toml.load('cfg/config.toml')['saveloader'])
+    if database is not None:
+        config['database'] = database
+    migrated = asyncio.run(migrate(Path(folder), config))
+    print(f'{migrated} users were migrated from {folder} to {config.get("database", "users.sqlite")}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
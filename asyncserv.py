@@ -2,29 +2,44 @@ import asyncio
 import logging
 import os
 import sys
-from typing import Any, Dict, Union, AsyncGenerator
+import time
+from typing import Any, Dict, Set, Union, AsyncGenerator
 
 import toml
 
+from Commands.UserCommands import ERR
 from InputHandler import InputsHandler
+from Metrics.MetricsCollector import metrics, serve_metrics
 from Protocols.BaseProtocol import *
 from UserDataHandle import BaseSaveLoader
 from UserDataHandle.JsonSaveLoader import JsonSaveLoader
 from UserDataHandle.MongoSaveLoader import MongoSaveLoader
+from UserDataHandle.SqliteSaveLoader import SqliteSaveLoader
 from Session.SessionHandler import UsersSessionHandler
+from Storage.BlobStore import blobs
+from Storage.DigestCache import digests
+from Storage.FileIndex import index
+from Storage.MetadataCache import metadata
+from Storage.Quotas import quotas
+from Transfer.Bandwidth import bandwidth
+from Transfer.ChunkSizer import tuning
+from Transfer.ParallelUpload import uploads
 from users import User
+from utility import FileSlice
 
 if not os.path.exists('storage'):
     os.mkdir('storage')
 
 
 class Server:
-    def __init__(self, host: str, port: int, proto: BaseProtocol, saveloader: BaseSaveLoader,super_users=None):
+    def __init__(self, host: str, port: int, proto: BaseProtocol, saveloader: BaseSaveLoader,super_users=None,
+                 metrics_cfg: Dict[str, Any] = None):
         if super_users is None:
             super_users = {'superuser', 'admin'}
         self.host = host
         self.port = port
         self.__super_users = super_users
+        self.__metrics_cfg = metrics_cfg or {}
         self.logger = self.__init_logger()
 
         self.__InputsHandler = InputsHandler()
@@ -40,24 +55,55 @@ class Server:
         '''
         server = await asyncio.start_server(self.handle_connection, self.host, self.port)
         self.logger.info(f"Start server... {self.host}:{self.port} ({self.Proto.__class__.__name__})")
+        if self.__metrics_cfg.get('enabled'):
+            await serve_metrics(self.__metrics_cfg['host'], self.__metrics_cfg['port'])
+            self.logger.info(f"Metrics endpoint... {self.__metrics_cfg['host']}:{self.__metrics_cfg['port']}")
+        if blobs.enabled:
+            self.__gc_task = asyncio.create_task(blobs.run_gc())
+            self.logger.info(f"Deduplicated storage... {blobs.root}")
+        self.__quota_task = asyncio.create_task(quotas.run())
+        self.__uploads_task = asyncio.create_task(uploads.run())
+        self.__saveloader_task = asyncio.create_task(self.UserDataHandler.run())
+        if index.enabled:
+            self.__index_task = asyncio.create_task(index.run())
+            self.logger.info(f"File index... {index.path}")
         async with server:
             await server.serve_forever()
 
     async def handle_connection(self, reader, writer):
         addr = writer.get_extra_info("peername")
         uid = await self.Proto.handshake(reader, writer)
-        await self.UsersSessionHandler.check_user(reader, writer, uid.strip())  # check user
+        try:
+            await self.UsersSessionHandler.check_user(reader, writer, uid.strip())  # check user
+        except ValueError as E:
+            self.logger.info(f'refused {addr}: {E}')
+            writer.close()
+            return
         self.logger.info(f'connected by {addr}')
-        while True:
-            try:
-                if not await self._handle_query(self.UsersSessionHandler.from_user(addr)):
-                    await self.UsersSessionHandler.end_user_session(addr)
+        metrics.active_sessions += 1
+        in_progress: Set[asyncio.Task] = set()  # requests of multiplexed protocol
+        try:
+            while True:
+                try:
+                    user = self.UsersSessionHandler.from_user(addr)
+                    if self.Proto.multiplexed:
+                        alive = await self._handle_multiplexed_query(user, in_progress)
+                    else:
+                        alive = await self._handle_query(user)
+                    if not alive:
+                        break
+                except ConnectionError:
+                    self.logger.info(f'Client suddenly closed while receiving from {addr}')
                     break
-            except ConnectionError:
-                self.logger.info(f'Client suddenly closed while receiving from {addr}')
-                await self.UsersSessionHandler.end_user_session(addr)
-                break
-        self.logger.info(f'Disconnected by {addr}')
+        except Exception:  # state of connection is unknown, session is ended
+            self.logger.exception(f'session of {addr} failed')
+        finally:  # session is ended whatever stopped it
+            for task in list(in_progress):  # requests must not write to socket closed by end of session
+                task.cancel()
+            await asyncio.gather(*in_progress, return_exceptions=True)
+            await self.UsersSessionHandler.end_user_session(addr)
+            metrics.active_sessions -= 1
+            self.logger.info(f'Disconnected by {addr}')
 
     async def _handle_query(self, user: User) -> bool:
         '''
@@ -65,37 +111,102 @@ class Server:
         '''
         command, data_length = await self.Proto.receive_data(user.sock.reader, user.sock.writer)
         if command and not command.startswith(b'exit'):
-            if command.startswith((b'send', b'open', b'rawsend')):
-                output_data = await self.__InputsHandler.handle_files(user, command, data_length, self.Proto)
-            else:
-                output_data = await self.__InputsHandler.handle_text_command(user, command, data_length)
-            return await self.__handle_answer(user, output_data)
+            return await self._process_query(user, command, data_length)
         else:
 
             return False
 
+    async def _handle_multiplexed_query(self, user: User, in_progress: Set[asyncio.Task]) -> bool:
+        '''
+        handle queries from users of multiplexed protocol.
+        Every request is processed in its own task, so user can 'list' or 'info' while 'open' is in progress.
+        Uploads read their data from the same socket - next request is read when upload is finished.
+        On 'exit' requests in progress are finished before session is closed
+        '''
+        request_id, command, data_length = await self.Proto.receive_frame(user.sock.reader, user.sock.writer)
+        if not command or command.startswith(b'exit'):
+            if command:
+                await asyncio.gather(*in_progress, return_exceptions=True)
+            return False
+        self.Proto.request_id.set(request_id)  # copied to context of request task
+        if command.startswith((b'send', b'psend', b'rawsend', b'delta', b'push')):
+            return await self._process_query(user, command, data_length)
+        task = asyncio.create_task(self._process_request(user, command, data_length))
+        in_progress.add(task)
+        task.add_done_callback(in_progress.discard)
+        return True
+
+    async def _process_request(self, user: User, command: bytes, data_length: int) -> bool:
+        '''
+        request task of multiplexed protocol: failed request is answered with error (END frame),
+        so user waiting for reply to its id is not left hanging
+        '''
+        try:
+            return await self._process_query(user, command, data_length)
+        except Exception as E:
+            self.logger.exception(f'request {command[:64]!r} of {user.uid} failed')
+            try:
+                await self.Proto.send_data(user.sock.reader, user.sock.writer, ERR.OTHER(E))
+            except Exception:  # connection is lost, nobody waits for reply
+                pass
+            return False
+
+    async def _process_query(self, user: User, command: bytes, data_length: int) -> bool:
+        '''
+        execute command and send answer
+        '''
+        started = time.perf_counter()
+        metrics.bytes_in += len(command)
+        if command.startswith((b'send', b'psend', b'open', b'rawsend', b'delta', b'pull', b'push')):
+            with metrics.transfer():
+                output_data = await self.__InputsHandler.handle_files(user, command, data_length, self.Proto)
+                res = await self.__handle_answer(user, output_data)
+        else:
+            output_data = await self.__InputsHandler.handle_text_command(user, command, data_length)
+            res = await self.__handle_answer(user, output_data)
+        metrics.observe(self.__InputsHandler.command_name(command), time.perf_counter() - started)
+        return res
+
     async def __handle_answer(self, user: User, output_data: Union[AsyncGenerator, bytes]) -> bool:
         '''
         send text answer or file as bytes to user
         output_data is bytes for text answer
         or
-        <class 'generator'> in case of file sending
+        (FileSlice or <class 'async_generator'>, file size) in case of file sending
+        or
+        (FileSlice or <class 'async_generator'>, file size, digest task) - digest is sent as one more answer
 
         '''
+        digest = output_data[2] if isinstance(output_data, tuple) and len(output_data) > 2 else None
         try:
-            if isinstance(output_data[0], AsyncGenerator):
-                await self.Proto.send_file(user.sock.reader, user.sock.writer, output_data)
+            if isinstance(output_data[0], (FileSlice, AsyncGenerator)):
+                with bandwidth.transfer(user) as throttle:
+                    metrics.bytes_out += await self.Proto.send_file(user.sock.reader, user.sock.writer, output_data[:2],
+                                                                    sizer=user.chunk_sizer, throttle=throttle)
+                if len(output_data) > 2:
+                    trailer = await output_data[2]
+                    await self.Proto.send_data(user.sock.reader, user.sock.writer, trailer)
+                    metrics.bytes_out += len(trailer)
             else:
                 await self.Proto.send_data(user.sock.reader, user.sock.writer, output_data)
+                metrics.bytes_out += len(output_data)
             return True
         except Exception as E:
             self.logger.error(E)
             return False
+        finally:  # file was not sent: nobody needs its digest
+            if digest is not None and not digest.done():
+                digest.cancel()
+                await asyncio.gather(digest, return_exceptions=True)
 
     async def stop(self):
         sessions = set(addr for addr in self.UsersSessionHandler.active_sessions.keys())
         for addr in sessions:
             await self.UsersSessionHandler.end_user_session(addr)
+        await self.UserDataHandler.flush()
+        digests.save()
+        if index.enabled:
+            index.close()
         logging.warning('STOP')
 
     @staticmethod
@@ -110,18 +221,29 @@ class Server:
 
 if __name__ == "__main__":
     Protocols = {'simple': SimpleProto,
-                 'tcd8': TCD8}
+                 'tcd8': TCD8,
+                 'tcd8mux': TCD8Mux}
     Saveloader = {'json': JsonSaveLoader,
-                  'mongo': MongoSaveLoader}
+                  'mongo': MongoSaveLoader,
+                  'sqlite': SqliteSaveLoader}
 
     loop = asyncio.new_event_loop()  # does not work correctly
     config = toml.load('cfg/config.toml')
     host, port, proto = config['conn'].values()
     saveloader_cfg = config['saveloader']
+    tuning.configure(config.get('transfer', {}))
+    bandwidth.configure(config.get('bandwidth', {}))
+    blobs.configure(config.get('storage', {}), saveloader_cfg['storage'])
+    digests.configure(config.get('storage', {}), saveloader_cfg['storage'])
+    metadata.configure(config.get('cache', {}))
+    index.configure(config.get('index', {}), saveloader_cfg['storage'])
+    quotas.configure(config.get('quota', {}))
+    uploads.configure(config.get('uploads', {}), saveloader_cfg['storage'])
 
     # loop = asyncio.ProactorEventLoop()
     asyncio.set_event_loop(loop)
-    server = Server(host, port, proto=Protocols[proto](), saveloader=Saveloader[saveloader_cfg['type']](config=config['saveloader']))
+    server = Server(host, port, proto=Protocols[proto](**config.get(proto, {})), saveloader=Saveloader[saveloader_cfg['type']](config=config['saveloader']),
+                    metrics_cfg=config.get('metrics'))
 
     try:
         loop.run_until_complete(server.run())
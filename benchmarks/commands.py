@@ -0,0 +1,108 @@
+'''
+commands per second handled by InputsHandler (registry of commands) and by the former dispatch:
+regular expressions of arguments and getattr of command on every request.
+Parsing is measured with distinct commands (paths differ as in real traffic), handling repeats REQUESTS
+
+    python benchmarks/commands.py [requests]
+'''
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Commands.SuperUserCommands import SuperUserCommands as SUC  # noqa: E402
+from Commands.UserCommands import ERR, Packet, UserCommands as UC  # noqa: E402
+from InputHandler import InputsHandler  # noqa: E402
+from users import SuperUser, User  # noqa: E402
+
+REQUESTS = (b'where', b'whoami', b'help', b'help list', b'info folder', b'list folder -l 10',
+            b'hash "folder/file.txt"', b'nope')
+# commands with paths and arguments of every shape, {} is replaced by number of command
+TEMPLATES = ('info folder/file{}.txt', 'list folder{} -l 10 -s size', 'hash "my folder/file {}.txt"',
+             'send "file {}.txt" > folder', 'psend file{} > here -o 0 -l 10 -s 20', 'setp user{} -r /path',
+             'rawsend file{}.bin 1024', 'where')
+
+
+class Former:
+    '''
+    dispatch as it was before Commands.Registry
+    '''
+    one_arg_template = r'^((\"(.*)\")|([a-zA-z].*)|(/.*)|((.|\s+)*))'
+    send_file_template = r'^((\"(.*)\")|(/(.*))|([a-zA-z].*))\s>\s(.*)'
+    one_arg_fn = ('jump', 'list', 'where', 'open', 'nefo', 'defo', 'defi', 'info', 'hash', 'sign', 'pull', 'find')
+    send_file_fn = ('send', 'psend', 'delta', 'push')
+
+    @staticmethod
+    def parse_data(command: bytes):
+        _command = command.decode().strip()
+        command_word_length = _command.find(' ')
+        if command_word_length == -1:
+            return _command,
+        cmd = _command[:command_word_length]
+        if cmd in Former.one_arg_fn:
+            return cmd, re.search(Former.one_arg_template, _command[command_word_length + 1:]).group(1)
+        elif cmd in Former.send_file_fn:
+            groups = re.search(Former.send_file_template, _command[command_word_length + 1:])
+            return (cmd, _command[command_word_length + 1:], None) if groups is None \
+                else (cmd, groups.group(1), groups.group(7))
+        return tuple(_command.split())
+
+    @staticmethod
+    def get_help(packet: Packet) -> bytes:
+        cmd_list = SUC if isinstance(packet.user, SuperUser) else UC
+        short_help = 'Avaliable commands:\n' + '\n'.join(m for m in dir(cmd_list) if not m.startswith('__'))
+        if packet.cmd_tail:
+            command = packet.cmd_tail[0]
+            return ((getattr(cmd_list, command).__doc__ or 'No info') if hasattr(cmd_list, command)
+                    else 'no help for you').encode()
+        return short_help.encode()
+
+    @staticmethod
+    async def handle_text_command(user: User, command: bytes, data_length: int) -> bytes:
+        cmd, *cmd_tail = Former.parse_data(command)
+        packet = Packet(user=user, cmd_tail=cmd_tail, data_length=data_length)
+        if cmd == 'help':
+            return Former.get_help(packet)
+        return await getattr(UC, cmd)(packet=packet) if hasattr(UC, cmd) else ERR.UNKNOWN_COMMAND
+
+
+async def rate(handle, user: User, requests: int) -> float:
+    started = time.perf_counter()
+    for i in range(requests):
+        await handle(user, REQUESTS[i % len(REQUESTS)], 0)
+    return requests / (time.perf_counter() - started)
+
+
+def main(requests: int = 50000):
+    with tempfile.TemporaryDirectory() as home:
+        os.mkdir(os.path.join(home, 'folder'))
+        with open(os.path.join(home, 'folder', 'file.txt'), 'w') as f:
+            f.write('benchmark')
+        user = User(uid='bench', addr=('127.0.0.1', 0), sock=None, current_path=home,
+                    permissions={mode: [home] for mode in 'rwx'}, home_path=home)
+        parse = max(timeit_parse(InputsHandler.parse_data) for _ in range(3))
+        former_parse = max(timeit_parse(Former.parse_data) for _ in range(3))
+        handled = asyncio.run(rate(InputsHandler.handle_text_command, user, requests))
+        former_handled = asyncio.run(rate(Former.handle_text_command, user, requests))
+    print(f'parsing of distinct commands, {len(TEMPLATES)} shapes')
+    print(f'parsing, former:   {former_parse:12.0f} commands/s')
+    print(f'parsing, registry: {parse:12.0f} commands/s ({parse / former_parse:.1f}x)')
+    print(f'{requests} requests of {len(REQUESTS)} kinds')
+    print(f'handling, former:   {former_handled:11.0f} commands/s')
+    print(f'handling, registry: {handled:11.0f} commands/s ({handled / former_handled:.1f}x)')
+
+
+def timeit_parse(parse, rounds: int = 20000) -> float:
+    commands = [TEMPLATES[i % len(TEMPLATES)].format(i).encode() for i in range(rounds)]  # made before timing
+    started = time.perf_counter()
+    for command in commands:
+        parse(command)
+    return rounds / (time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,48 @@
+'''
+check of permissions by list of permitted paths (loop of Path.is_relative_to) and by compiled trie
+
+    python benchmarks/permissions.py [grants] [checks]
+'''
+import os
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utility import PathTrie, is_allowed  # noqa: E402
+
+
+def grants(amount: int) -> list:
+    return [f'/srv/storage/user{i}/project{i % 7}' for i in range(amount)]
+
+
+def targets(amount: int, permitted: list) -> list:
+    random.seed(0)
+    paths = list()
+    for _ in range(amount):
+        if random.random() < .5:
+            paths.append(Path(random.choice(permitted), 'src', 'module', 'file.py'))  # allowed
+        else:
+            paths.append(Path('/srv/storage/other', str(random.randrange(1000)), 'file.py'))  # denied
+    return paths
+
+
+def main(amount: int = 1000, checks: int = 2000):
+    permitted = grants(amount)
+    trie = PathTrie(permitted)
+    paths = targets(checks, permitted)
+    assert [is_allowed(path, permitted) for path in paths] == [is_allowed(path, trie) for path in paths]
+
+    linear = min(timeit.repeat(lambda: [is_allowed(path, permitted) for path in paths], number=1, repeat=3))
+    compiled = min(timeit.repeat(lambda: [is_allowed(path, trie) for path in paths], number=1, repeat=3))
+    build = min(timeit.repeat(lambda: PathTrie(permitted), number=1, repeat=3))
+    print(f'{amount} grants, {checks} checks')
+    print(f'list: {linear / checks * 1e6:10.2f} us per check')
+    print(f'trie: {compiled / checks * 1e6:10.2f} us per check ({linear / compiled:.0f}x)')
+    print(f'trie is built in {build * 1e3:.2f} ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
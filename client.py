@@ -1,4 +1,5 @@
 from Protocols.BaseProtocol import *
+from Transfer.Archive import join_blocks
 
 
 class Client:
@@ -43,7 +44,13 @@ class Client:
                 if request.startswith('exit'):
                     self.__proto.send_request(csock=self.sock, request=request)
                     break
-                elif request.startswith(('rawsend', 'send')):
+                elif request.startswith('psend') and type(self.__proto) is TCD8:
+                    try:
+                        self.parallel_send(request)
+                    except Exception as E:
+                        print(E)
+                    continue
+                elif request.startswith(('rawsend', 'send', 'delta', 'push')):
                     try:
                         # self.sock.settimeout(1)
                         self.__proto.file_send_request(csock=self.sock, request=request)
@@ -57,10 +64,42 @@ class Client:
                 except Exception as e:
                     data = b'no data'
                     print(e)
+                if request.startswith('pull') and not data.startswith(b'[x]'):
+                    data = self.save_archive(request, data)
                 Client.printer(data)
+                if request.startswith('open') and '-d' in request.split():  # digest of file follows it
+                    Client.printer(self.__proto.receive_reply(self.sock))
             self.end_connection()
             break
 
+    @staticmethod
+    def save_archive(request: str, data: bytes) -> bytes:
+        '''
+        save archive of 'pull folder' as folder.tar (.tar.gz, .tar.xz) in current folder
+        '''
+        folder, options = extract_options(request.split(maxsplit=1)[1], options=('z',))
+        suffix = {'zlib': '.tar.gz', 'lzma': '.tar.xz'}.get(options.get('z'), '.tar')
+        file_name = Path(folder.strip('"')).name + suffix
+        with open(file_name, 'wb') as f:
+            f.write(join_blocks(data))
+        return f'[i] archive saved to {file_name}'.encode()
+
+    def parallel_send(self, request: str, connections: int = 4):
+        '''
+        send file by ranges through several additional connections
+        '''
+        csocks = [socket.create_connection((self.host, self.port)) for _ in range(connections)]
+        for csock in csocks:
+            csock.recv(4)
+            csock.sendall(UUID.encode())
+        try:
+            replies = self.__proto.parallel_file_send_request(csocks, request)
+        finally:
+            for csock in csocks:
+                self.__proto.send_request(csock, 'exit')
+                csock.close()
+        Client.printer(replies[-1])
+
     def __auth(self):
         auth = self.sock.recv(4)
         print(auth.decode())
@@ -70,7 +109,8 @@ class Client:
 if __name__ == '__main__':
     import sys
     Protocols = {'simple': SimpleProto,
-                 'tcd8': TCD8}
+                 'tcd8': TCD8,
+                 'tcd8mux': TCD8Mux}
 
     try:
         host, port, proto, UUID = sys.argv[1:]
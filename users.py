@@ -1,18 +1,54 @@
+from pathlib import Path
 from typing import Dict, Tuple
 import utility
 
+from Session.PathResolver import PathResolver, Resolved
+from Transfer.ChunkSizer import ChunkSizer
 from UserDataHandle.BaseSaveLoader import BaseSaveLoader
 
 
+class Account:
+    '''
+    State of user shared by all connections of the user (see Session.SessionHandler):
+    permissions are compiled once for all of them, so setp and delp change every connection at once,
+    current path is the path of the last jump of any connection - it is saved and new connections start there.
+    Every connection keeps its own current path, jump of one connection does not move others
+    '''
+
+    def __init__(self, uid: str, current_path: str, permissions: Dict, home_path: str = None):
+        self.uid = uid
+        self.current_path = current_path
+        self.home_path = home_path
+        self.permissions = permissions
+
+    @property
+    def permissions(self) -> Dict:
+        return self.__permissions
+
+    @permissions.setter
+    def permissions(self, permissions: Dict):
+        self.__permissions = permissions
+        self.__grants = {mode: utility.PathTrie(paths) for mode, paths in permissions.items()}
+
+    @property
+    def grants(self) -> Dict[str, utility.PathTrie]:
+        '''
+        permissions compiled for utility.is_allowed, rebuilt when permissions are set
+        '''
+        return self.__grants
+
+
 class User:
     def __init__(self, uid: str, addr: Tuple, sock: Tuple, current_path: str, permissions: Dict,
-                 home_path: str = None):
+                 home_path: str = None, account: Account = None):
         self.__id = uid
         self.__current_path = current_path
         self.__home_path = home_path
-        self.__permissions = permissions
+        self.__account = account or Account(uid, current_path, permissions, home_path)
         self.__sock = sock
         self.__addr = addr
+        self.__chunk_sizer = ChunkSizer()
+        self.__resolver = PathResolver(home_path or current_path)
 
     @property
     def current_path(self):
@@ -21,14 +57,45 @@ class User:
     @current_path.setter
     def current_path(self, path: str):
         self.__current_path = path
+        self.__account.current_path = path
+        self.__resolver.clear()
+
+    @property
+    def account(self) -> Account:
+        return self.__account
 
     @property
     def permissions(self):
-        return self.__permissions
+        return self.__account.permissions
 
     @permissions.setter
     def permissions(self, permissions):
-        self.__permissions = permissions
+        self.__account.permissions = permissions
+
+    @property
+    def grants(self) -> Dict[str, utility.PathTrie]:
+        return self.__account.grants
+
+    def resolve(self, path: str = '') -> Resolved:
+        '''
+        canonical path of absolute path or path relative to current folder (see Session.PathResolver)
+        '''
+        return self.__resolver.resolve(path, self.__current_path)
+
+    def resolve_folder(self, _to: str | None) -> Resolved:
+        return self.__resolver.resolve_folder(_to, self.__current_path)
+
+    def resolve_save(self, _from: str, _to: str | None) -> Resolved:
+        return self.__resolver.resolve_save(_from, _to, self.__current_path)
+
+    def trim(self, path: str | Path) -> str:
+        return self.__resolver.trim(path)
+
+    def allowed(self, resolved: Resolved, mode: str) -> bool:
+        '''
+        user has permission (r, w or x) to resolved path, links leading out of home are refused
+        '''
+        return not resolved.escaped and utility.is_allowed(resolved.path, self.__account.grants[mode])
 
     @property
     def sock(self):
@@ -38,6 +105,10 @@ class User:
     def addr(self):
         return self.__addr
 
+    @property
+    def chunk_sizer(self):
+        return self.__chunk_sizer
+
     @property
     def uid(self):
         return self.__id
@@ -52,8 +123,8 @@ class User:
 
     def get_full_info(self):
         info = (f'id = {self.__id}\n'
-                f'current path = {utility.trim_path(self.__current_path, self.__home_path)}\n'
-                f'home path = {utility.trim_path(self.__home_path, self.__home_path)}\n'
+                f'current path = {self.trim(self.__current_path)}\n'
+                f'home path = {self.trim(self.__home_path)}\n'
                 f'address = {self.__addr}\n')
         return info
 
@@ -1,6 +1,46 @@
 import os
+import struct
 from pathlib import Path
-from typing import Generator, List, Tuple
+from typing import Dict, Generator, List, NamedTuple, Tuple
+
+# file size of stream which length is unknown before sending (e.g. compressed file):
+# data is sent by blocks [4 bytes length] + block, empty block ends the stream
+CHUNKED = (1 << 64) - 1
+
+
+class FileSlice(NamedTuple):
+    '''
+    region of file which should be sent to user as is
+    path: absolute path to file
+    offset: position of the first byte to send
+    count: amount of bytes to send
+    '''
+    path: str
+    offset: int
+    count: int
+
+
+def frame_block(data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + data
+
+
+def extract_options(arg: str, options: Tuple[str, ...] = (), flags: Tuple[str, ...] = ()) -> Tuple[str, Dict]:
+    '''
+    cut options '-name value' and flags '-name' from the end of command argument
+    e.g. extract_options('folder/file.txt -z zlib', options=('z',)) -> ('folder/file.txt', {'z': 'zlib'})
+    '''
+    found = dict()
+    words = arg.split(' ') if arg else []
+    while words:
+        if words[-1].startswith('-') and words[-1][1:] in flags:
+            found[words[-1][1:]] = True
+            words = words[:-1]
+        elif len(words) >= 2 and words[-2].startswith('-') and words[-2][1:] in options:
+            found[words[-2][1:]] = words[-1]
+            words = words[:-2]
+        else:
+            break
+    return ' '.join(words), found
 
 
 def walk_around_folder(abs_path: str, trimmed_path: str, as_str: bool = True, ) -> str | Tuple:
@@ -17,36 +57,76 @@ def walk_around_folder(abs_path: str, trimmed_path: str, as_str: bool = True, )
     return f'[>] {trimmed_path} \n{obj_list}' if as_str else (path, folders, files)
 
 
-async def gen_chunk_read(file_path: str, chunk_size: int = 4096) -> Generator:
+async def gen_chunk_read(file_path: str, chunk_size: int = 4096, offset: int = 0, count: int = None) -> Generator:
     '''
     path_to_file: asbsolute path to ile
     chunk_size: size of chunk
+    offset: position to start reading from
+    count: amount of bytes to read (till the end of file if None)
     '''
     with open(file_path, 'rb') as f:
-        while True:
-            data = f.read(chunk_size)
-            yield data
+        f.seek(offset)
+        left = count
+        while left is None or left > 0:
+            data = f.read(chunk_size if left is None else min(chunk_size, left))
             if not data:
                 break
+            if left is not None:
+                left -= len(data)
+            yield data
 
 
-def define_path(path_or_folder: str, user_path: str) -> str:
+def file_range(file_size: int, o: int = 0, l: int = None, head: int = None, tail: int = None) -> Tuple[int, int]:
     '''
-    define is path_to_folder absolute path or folder in current user directory
+    offset and amount of bytes to send by 'open' options:
+    o - offset, l - length, head - first bytes, tail - last bytes
     '''
-    if path_or_folder.find('..') != -1:
-        return user_path
-    if Path(path_or_folder).is_absolute():
-        path = path_or_folder
-    else:
-        path = Path().joinpath(user_path, path_or_folder)
-    return path
+    if min(o, l or 0, head or 0, tail or 0) < 0:
+        raise ValueError('offset and length can not be negative')
+    if head is not None:
+        return 0, min(head, file_size)
+    if tail is not None:
+        return max(file_size - tail, 0), min(tail, file_size)
+    if o > file_size:
+        raise ValueError(f'offset {o} is beyond the end of file ({file_size} bytes)')
+    return o, file_size - o if l is None else min(l, file_size - o)
 
 
-def is_allowed(path: Path, avaliable_path: List[str]) -> bool:
+class PathTrie:
     '''
-    check user permissions
+    permitted paths compiled into trie of their parts:
+    check of path takes one dict lookup per part of path whatever amount of permitted paths is
     '''
+    END = ''  # key of node where permitted path ends, empty string is never a part of path
+
+    def __init__(self, paths: List[str]):
+        self.__root: Dict[str, Dict] = dict()
+        for path in paths:
+            node = self.__root
+            for part in Path(path).parts:
+                node = node.setdefault(part, dict())
+            node[self.END] = True
+
+    def covers(self, path: str | Path) -> bool:
+        '''
+        path is one of permitted paths or inside one of them (as Path.is_relative_to)
+        '''
+        node = self.__root
+        for part in Path(path).parts:
+            if self.END in node:
+                return True
+            node = node.get(part)
+            if node is None:
+                return False
+        return self.END in node
+
+
+def is_allowed(path: Path, avaliable_path: List[str] | PathTrie) -> bool:
+    '''
+    check user permissions, compiled permissions (see users.User.grants) are checked by trie
+    '''
+    if isinstance(avaliable_path, PathTrie):
+        return avaliable_path.covers(path)
     target_path = path
 
     for path in avaliable_path:
@@ -57,3 +137,33 @@ def is_allowed(path: Path, avaliable_path: List[str]) -> bool:
 
 def trim_path(path: str, user_home_folder: str):
     return f'..' + path[len(user_home_folder):]
+
+
+def is_valid_uid(uid: str) -> bool:
+    '''
+    uid is name of home folder inside storage: one name which is not hidden (service files of server start with dot)
+    '''
+    return bool(uid) and not uid.startswith('.') and not any(c in uid for c in '/\\\0')
+
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value: str) -> int:
+    '''
+    size in bytes from '100', '64K', '1.5M', '10G' or '2T'
+    '''
+    unit = value[-1:].upper() if value[-1:].isalpha() else ''
+    if unit not in SIZE_UNITS:
+        raise ValueError(f'unknown unit {unit}')
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def format_size(size: int) -> str:
+    '''
+    size with the largest unit it has at least one of, e.g. 1.50 MiB
+    '''
+    for unit in ('T', 'G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit]:
+            return f'{size / SIZE_UNITS[unit]:.2f} {unit}iB'
+    return f'{size} bytes'